@@ -0,0 +1,217 @@
+#
+# artifacts.py
+#
+# The manifest of a job's derived artifacts: the compressed
+# image, the labels and the metadata each stage writes back to
+# the bucket. Each is recorded in the jobartifacts table as it is
+# uploaded, with its key, size, content type, SHA-256 checksum
+# and S3 ETag:
+#
+#   entry = artifacts.upload_artifact(s3, bucketname, bucketkey, 'labels', labels_txt)
+#   artifacts.record_artifact(dbConn, bucketkey, entry)
+#
+# so finalproj_download finds every result of a job with one
+# query, rather than guessing keys and probing S3, and clients
+# can tell from the ETags whether what they have is current.
+#
+
+import hashlib
+import pathlib
+import datatier
+import transfer
+
+
+#
+# artifact -> (key suffix, content type). The compressed image
+# keeps the extension of the upload (.jpg or .jpeg):
+#
+ARTIFACTS = {
+  'compressed': ("-compressed", "image/jpeg"),
+  'labels': ("-labels.txt", "text/plain"),
+  'metadata': ("-metadata.json", "application/json")
+}
+
+#
+# artifact -> its canned ACL, the same whichever stage (or the
+# fused one) writes it: the labels have always been private:
+#
+ACLS = {
+  'compressed': 'public-read',
+  'labels': None,
+  'metadata': 'public-read'
+}
+
+#
+# artifact -> the key suffix it had before: the metadata was a
+# Python repr in -metadata.txt until it became JSON, and jobs
+# completed before then only have that:
+#
+LEGACY_SUFFIXES = {
+  'metadata': "-metadata.txt"
+}
+
+
+###################################################################
+#
+# artifact_key:
+#
+# The bucket key of an artifact of an upload:
+# "u/cat-1234.jpeg" -> "u/cat-1234-labels.txt", etc. A suffix
+# other than the artifact's own gives a key it used to have.
+#
+def artifact_key(datafilekey, artifact, suffix=None):
+  if suffix is None:
+    (suffix, _) = ARTIFACTS[artifact]
+  extension = pathlib.PurePosixPath(datafilekey).suffix
+  stem = datafilekey[0:len(datafilekey) - len(extension)]
+
+  if artifact == 'compressed':
+    return stem + suffix + extension
+  return stem + suffix
+
+
+###################################################################
+#
+# is_artifact:
+#
+# Whether a bucket key is one of the images we wrote (and so not
+# an upload to process).
+#
+def is_artifact(bucketkey):
+  stem = pathlib.PurePosixPath(bucketkey).stem
+  return stem.endswith(ARTIFACTS['compressed'][0])
+
+
+###################################################################
+#
+# upload_artifact:
+#
+def upload_artifact(s3, bucketname, datafilekey, artifact, body):
+  """
+  Uploads an artifact of an upload, under its artifact_key and
+  with its ACL (ACLS)
+
+  Parameters
+  ----------
+  s3 : boto3 S3 client,
+  bucketname : the bucket (string),
+  datafilekey : bucket key of the job's uploaded image (string),
+  artifact : which artifact, a key of ARTIFACTS (string),
+  body : its contents (bytes or string)
+
+  Returns
+  -------
+  its manifest entry, for record_artifact: dictionary with the
+  artifact, key, size, content_type, checksum and etag
+  """
+  if isinstance(body, str):
+    body = body.encode()
+
+  (_, content_type) = ARTIFACTS[artifact]
+  bucketkey = artifact_key(datafilekey, artifact)
+
+  etag = transfer.put_bytes(s3, bucketname, bucketkey, body,
+                            content_type=content_type, acl=ACLS[artifact])
+
+  return {
+    'artifact': artifact,
+    'key': bucketkey,
+    'size': len(body),
+    'content_type': content_type,
+    'checksum': hashlib.sha256(body).hexdigest(),
+    'etag': etag
+  }
+
+
+###################################################################
+#
+# record_artifact:
+#
+# Adds an artifact to the manifest of the job that owns the given
+# datafilekey; like progress.record_stage, a re-run stage
+# overwrites its earlier entry.
+#
+def record_artifact(dbConn, datafilekey, entry):
+  """
+  Records an artifact in its job's manifest
+
+  Parameters
+  ----------
+  dbConn : the database connection,
+  datafilekey : bucket key of the job's uploaded image (string),
+  entry : the artifact's manifest entry, from upload_artifact
+
+  Returns
+  -------
+  number of rows modified
+  """
+  sql = """
+    INSERT INTO jobartifacts(jobid, artifact, bucketkey, size, contenttype, checksum, etag, created)
+           SELECT jobid, %s, %s, %s, %s, %s, %s, NOW(3)
+           FROM jobs
+           WHERE datafilekey = %s
+    ON DUPLICATE KEY UPDATE bucketkey = VALUES(bucketkey),
+                            size = VALUES(size),
+                            contenttype = VALUES(contenttype),
+                            checksum = VALUES(checksum),
+                            etag = VALUES(etag),
+                            created = VALUES(created);
+  """
+
+  return datatier.perform_action(dbConn, sql, [entry['artifact'], entry['key'], entry['size'],
+                                               entry['content_type'], entry['checksum'],
+                                               entry['etag'], datafilekey])
+
+
+###################################################################
+#
+# get_artifacts:
+#
+# Returns the manifest of a job, as a dictionary mapping artifact
+# name to its entry (as returned by upload_artifact).
+#
+def get_artifacts(dbConn, jobid):
+  sql = """
+    SELECT artifact, bucketkey, size, contenttype, checksum, etag
+    FROM jobartifacts
+    WHERE jobid = %s;
+  """
+
+  rows = datatier.retrieve_all_rows(dbConn, sql, [jobid])
+
+  manifest = {}
+  for row in rows:
+    manifest[row[0]] = {
+      'artifact': row[0],
+      'key': row[1],
+      'size': row[2],
+      'content_type': row[3],
+      'checksum': row[4],
+      'etag': row[5]
+    }
+
+  return manifest
+
+
+###################################################################
+#
+# artifact_keys:
+#
+# The keys to try for each artifact of a completed job, in order:
+# the one in its manifest, or for jobs that finished before there
+# were manifests, the key the stages write it under and then any
+# it had before (LEGACY_SUFFIXES), since those are the jobs that
+# wrote them.
+#
+def artifact_keys(manifest, datafilekey):
+  keys = {}
+
+  for artifact in ARTIFACTS:
+    if artifact in manifest:
+      keys[artifact] = [manifest[artifact]['key']]
+    else:
+      keys[artifact] = [artifact_key(datafilekey, artifact)]
+      if artifact in LEGACY_SUFFIXES:
+        keys[artifact].append(artifact_key(datafilekey, artifact, LEGACY_SUFFIXES[artifact]))
+
+  return keys
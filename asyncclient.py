@@ -0,0 +1,320 @@
+#
+# asyncclient.py
+#
+# asyncio client for the web service, for automation that wants
+# many requests in flight from a single process. Mirrors the
+# Client class in main.py, but every method is a coroutine:
+#
+#   async with AsyncClient(baseurl, limit=200) as client:
+#     jobid = await client.upload("photo.jpg", 80001)
+#     (status_code, body) = await client.download(jobid)
+#
+# Uploads are streamed: the JSON request body is base64 encoded
+# from the file as it is sent, so a request never holds more
+# than UPLOAD_CHUNK_SIZE of the image in memory. Back-pressure
+# comes from two places: a semaphore caps the requests in flight
+# (and so the open files), and upload_many only starts the next
+# upload as one finishes, however many files it is given.
+#
+# Run as a script to upload a directory of JPGs:
+#
+#   python asyncclient.py photos/ 80001 --limit 200
+#
+
+import asyncio
+import aiohttp
+
+import argparse
+import base64
+import json
+import os
+import pathlib
+import random
+import sys
+import time
+
+from main import User, Job, ApiError, BULK_RETRIES, TRANSIENT_STATUS_CODES, \
+                 IDEMPOTENT_METHODS, UNSENT_STATUS_CODES, LONG_POLL_RETRY_STATUSES, \
+                 DOWNLOAD_WAIT_SECS, DEFAULT_CONFIG_FILE, \
+                 read_baseurl, find_jpgs, upload_summary, \
+                 print_upload_result, print_upload_summary
+
+
+#
+# default number of requests in flight:
+#
+DEFAULT_LIMIT = 100
+
+#
+# uploads are read from disk in chunks of this size, a multiple
+# of 3 so each chunk base64 encodes on its own, without padding:
+#
+UPLOAD_CHUNK_SIZE = 48 * 1024
+
+#
+# a request that takes longer than this (including waiting for
+# a connection from the pool) fails:
+#
+REQUEST_TIMEOUT_SECS = 300
+
+
+############################################################
+#
+# upload_body
+#
+def upload_body(local_filename):
+  """
+  Returns the JSON body of an upload request, as (length, async
+  generator of bytes). The generator reads and base64 encodes
+  the file a chunk at a time, so the body is streamed rather
+  than built in memory; its length is known up front so the
+  request can be sent with a Content-Length rather than chunked.
+  """
+  prefix = (json.dumps({"filename": pathlib.Path(local_filename).name})[:-1]
+            + ', "data": "').encode()
+  suffix = b'"}'
+
+  size = os.path.getsize(local_filename)
+  length = len(prefix) + 4 * ((size + 2) // 3) + len(suffix)
+
+  async def chunks():
+    yield prefix
+    infile = open(local_filename, "rb")
+    try:
+      while True:
+        chunk = await asyncio.to_thread(infile.read, UPLOAD_CHUNK_SIZE)
+        if len(chunk) == 0:
+          break
+        yield base64.b64encode(chunk)
+    finally:
+      infile.close()
+    yield suffix
+
+  return (length, chunks)
+
+
+############################################################
+#
+# AsyncClient
+#
+class AsyncClient:
+  """
+  asyncio client for the web service. At most "limit" requests
+  are in flight at once, over a pool of at most "limit" kept-
+  alive connections; further requests wait their turn. Use as
+  an async context manager, or call close() when done.
+  """
+
+  def __init__(self, baseurl, limit=DEFAULT_LIMIT, retries=BULK_RETRIES,
+               timeout_secs=REQUEST_TIMEOUT_SECS):
+    if baseurl.endswith("/"):
+      baseurl = baseurl[:-1]
+    self.baseurl = baseurl
+    self.limit = limit
+    self.retries = retries
+    self.timeout_secs = timeout_secs
+    self.semaphore = None
+    self.session = None
+
+  async def __aenter__(self):
+    await self.open()
+    return self
+
+  async def __aexit__(self, exc_type, exc, tb):
+    await self.close()
+
+  async def open(self):
+    if self.session is None:
+      self.semaphore = asyncio.Semaphore(self.limit)
+      connector = aiohttp.TCPConnector(limit=self.limit)
+      timeout = aiohttp.ClientTimeout(total=self.timeout_secs)
+      self.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+  async def close(self):
+    if self.session is not None:
+      await self.session.close()
+      self.session = None
+
+  async def request(self, method, api, ok=[200], body=None,
+                    idempotent=None, retry_statuses=None, **kwargs):
+    """
+    Sends a request, retrying connection failures and transient
+    (429 / 5xx) responses with exponential backoff and jitter,
+    and returns (status code, JSON body). As in main.py's
+    request_with_retries, a request that isn't idempotent (by
+    default, anything but a GET) is only retried on a 429 or a
+    failure to connect, since it may have run.
+
+    body, if given, is a function returning (length, async
+    generator factory) as upload_body does; it is called again
+    for each retry, since a streamed body can only be sent once.
+    """
+    await self.open()
+    url = self.baseurl + api
+    attempt = 0
+
+    if idempotent is None:
+      idempotent = method.upper() in IDEMPOTENT_METHODS
+    if retry_statuses is None:
+      retry_statuses = TRANSIENT_STATUS_CODES if idempotent else UNSENT_STATUS_CODES
+
+    while True:
+      try:
+        if body is not None:
+          (length, chunks) = body()
+          kwargs["data"] = chunks()
+          kwargs["headers"] = {"Content-Type": "application/json",
+                               "Content-Length": str(length)}
+
+        async with self.semaphore:
+          async with self.session.request(method, url, **kwargs) as res:
+            status_code = res.status
+            try:
+              result = await res.json(content_type=None)
+            except ValueError:
+              result = await res.text()
+
+        if status_code not in retry_statuses or attempt >= self.retries:
+          break
+
+      except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+        # a ClientConnectorError is a connection never made:
+        if attempt >= self.retries \
+           or not (idempotent or isinstance(e, aiohttp.ClientConnectorError)):
+          raise
+
+      await asyncio.sleep((0.5 * 2 ** attempt) * (0.5 + random.random()))
+      attempt += 1
+
+    if status_code not in ok:
+      raise ApiError(url, status_code, result)
+
+    return (status_code, result)
+
+  async def users(self):
+    """
+    Returns all the users, as a list of User objects.
+    """
+    (status_code, rows) = await self.request("GET", "/users")
+    return [User(row) for row in rows]
+
+  async def jobs(self):
+    """
+    Returns all the jobs, as a list of Job objects.
+    """
+    (status_code, rows) = await self.request("GET", "/jobs")
+    return [Job(row) for row in rows]
+
+  async def upload(self, local_filename, userid):
+    """
+    Uploads a JPG for processing, streaming it from disk, and
+    returns its job id.
+    """
+    (status_code, jobid) = await self.request("POST", "/upload/" + str(userid),
+                                              body=lambda: upload_body(local_filename))
+    return jobid
+
+  async def download(self, jobid, wait=DOWNLOAD_WAIT_SECS):
+    """
+    Downloads the results of a job, asking the server to wait
+    up to "wait" seconds for a pending job to finish. Returns
+    (status code, body): 200 with all the results, or 202 if
+    the job is still pending, with whatever results are ready.
+    """
+    return await self.request("GET", "/download/" + str(jobid), ok=[200, 202],
+                              retry_statuses=LONG_POLL_RETRY_STATUSES,
+                              params={"wait": str(wait)})
+
+  async def hist_match(self, source, target):
+    """
+    Histogram-matches the source job's image to the target's,
+    and returns the body: {'data', 'source', 'target'}.
+    """
+    (status_code, body) = await self.request("GET", "/hist_match/" + str(source) + "/" + str(target))
+    return body
+
+  async def upload_one(self, local_filename, userid):
+    """
+    Uploads one JPG for upload_many, returning a manifest entry
+    (as Client.upload_one does) rather than raising.
+    """
+    start = time.time()
+    result = {"file": local_filename, "jobid": None, "error": None,
+              "latency": 0.0, "bytes": 0}
+
+    try:
+      result["bytes"] = os.path.getsize(local_filename)
+      result["jobid"] = await self.upload(local_filename, userid)
+    except Exception as e:
+      result["error"] = str(e)
+
+    result["latency"] = time.time() - start
+    return result
+
+  async def upload_many(self, filenames, userid):
+    """
+    Uploads many JPGs, keeping up to "limit" uploads in flight;
+    the next upload starts only as one finishes, so the number
+    of pending tasks stays bounded however many files there are.
+    Async generator yielding manifest entries as they complete.
+    """
+    pending = set()
+    remaining = iter(filenames)
+
+    while True:
+      while len(pending) < self.limit:
+        local_filename = next(remaining, None)
+        if local_filename is None:
+          break
+        pending.add(asyncio.ensure_future(self.upload_one(local_filename, userid)))
+
+      if len(pending) == 0:
+        break
+
+      done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+      for task in done:
+        yield task.result()
+
+
+############################################################
+#
+# main
+#
+async def upload_directory(baseurl, pattern, userid, limit, manifest_filename):
+  filenames = find_jpgs(pattern)
+  results = []
+
+  start = time.time()
+  async with AsyncClient(baseurl, limit) as client:
+    async for result in client.upload_many(filenames, userid):
+      print_upload_result(result)
+      results.append(result)
+  elapsed = time.time() - start
+
+  outfile = open(manifest_filename, "w")
+  json.dump({"userid": userid, "uploads": results}, outfile, indent=2)
+  outfile.close()
+
+  print_upload_summary(upload_summary(results, elapsed))
+  print("  manifest written to", manifest_filename)
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(
+    description="Upload a directory (or glob) of JPGs with many uploads in flight.")
+  parser.add_argument("pattern")
+  parser.add_argument("userid")
+  parser.add_argument("--config", default=DEFAULT_CONFIG_FILE)
+  parser.add_argument("--limit", type=int, default=DEFAULT_LIMIT,
+                      help="uploads in flight (default: %(default)s)")
+  parser.add_argument("--manifest", default="upload-manifest.json")
+  args = parser.parse_args(argv)
+
+  asyncio.run(upload_directory(read_baseurl(args.config), args.pattern,
+                               args.userid, max(args.limit, 1), args.manifest))
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
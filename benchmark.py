@@ -0,0 +1,459 @@
+#
+# benchmark.py
+#
+# End-to-end latency and throughput benchmark of the image
+# pipeline, run entirely on this machine. Each image goes
+# through the same lambda handlers as in AWS:
+#
+#   finalproj_upload -> finalproj_pipeline (compress, rekognition,
+#   metadata, or fused) -> finalproj_download
+#
+# against local stand-ins: S3 is moto's in-memory fake,
+# Rekognition is FakeRekognition (with a configurable latency),
+# and every function is invoked in-process by localruntime's
+# LocalLambdaRuntime. With --trigger notification, uploads start
+# the pipeline through emulated S3 event notifications, as in
+# AWS, rather than the benchmark invoking it. The database
+# is a real MySQL server, since the schema and queries are MySQL
+# specific (spatial index, ON DUPLICATE KEY); point --rds-config
+# at a config.ini whose [rds] section names a scratch database
+# created from finalproj-database.sql, e.g. a local mysql:8
+# container.
+#
+# Reports p50/p95/p99 latencies of upload, pipeline, download and
+# end-to-end, and of each stage (as recorded in jobstages), as
+# JSON for regression tracking:
+#
+#   python benchmark.py --rds-config config.ini --images 200 \
+#     --concurrency 8 --sizes 640x480:5,1920x1080:3,4000x3000:1 \
+#     --mode staged --rekognition-ms 150 --out results.json
+#
+
+import argparse
+import base64
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from configparser import ConfigParser
+
+import boto3
+from moto import mock_aws
+from PIL import Image
+
+#
+# the handlers import these from the working directory, so make
+# sure this directory is on the path before we chdir away:
+#
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, REPO_DIR)
+
+import datatier
+import pipeline
+import progress
+import localruntime
+
+
+BENCHMARK_BUCKET = "finalproj-benchmark"
+BENCHMARK_REGION = "us-east-2"
+BENCHMARK_USER = "benchmark"
+
+PERCENTILES = [50, 95, 99]
+
+#
+# with --trigger notification, how often to check whether the
+# pipeline has finished a job:
+#
+POLL_SECS = 0.01
+
+
+###################################################################
+#
+# FakeRekognition:
+#
+# Stands in for the boto3 rekognition client: detect_labels
+# sleeps for the configured latency and returns fixed labels.
+#
+class FakeRekognition:
+
+  def __init__(self, latency_ms):
+    self.latency_ms = latency_ms
+
+  def detect_labels(self, Image, **kwargs):
+    time.sleep(self.latency_ms / 1000)
+    return {
+      'Labels': [{'Name': 'Benchmark', 'Confidence': 99.0},
+                 {'Name': 'Gradient', 'Confidence': 90.0}]
+    }
+
+
+###################################################################
+#
+# parse_sizes:
+#
+# "640x480:5,1920x1080:3" -> [((640, 480), 5.0), ((1920, 1080), 3.0)];
+# the weight is optional and defaults to 1.
+#
+def parse_sizes(s):
+  sizes = []
+  for item in s.split(","):
+    (dims, _, weight) = item.partition(":")
+    (width, height) = dims.lower().split("x")
+    sizes.append(((int(width), int(height)), float(weight) if weight != "" else 1.0))
+  return sizes
+
+
+###################################################################
+#
+# make_jpeg:
+#
+# A synthetic photo: a colour gradient with noise, so it neither
+# compresses to nothing nor is incompressible.
+#
+def make_jpeg(width, height, seed):
+  rng = random.Random(seed)
+  gradient = Image.linear_gradient('L').resize((width, height))
+  noise = Image.effect_noise((width, height), rng.uniform(16, 64))
+  bands = [gradient, noise, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT)]
+  rng.shuffle(bands)
+  img = Image.merge('RGB', bands)
+
+  buffer = io.BytesIO()
+  img.save(buffer, format="JPEG", quality=90)
+  return buffer.getvalue()
+
+
+###################################################################
+#
+# percentiles:
+#
+# Nearest-rank percentiles of a list of latencies (ms), as
+# progress.stage_latency_percentiles computes them.
+#
+def percentiles(values):
+  stats = {'count': len(values)}
+  if len(values) == 0:
+    return stats
+
+  values = sorted(values)
+  for p in PERCENTILES:
+    rank = max(1, -(-p * len(values) // 100))
+    stats['p' + str(p)] = round(values[rank - 1], 1)
+  stats['max'] = round(values[-1], 1)
+  return stats
+
+
+###################################################################
+#
+# write_config:
+#
+# Writes the config.ini the handlers will read: the [rds] section
+# copied from the given config, our fake bucket, dummy
+# credentials for the profiles the handlers ask for, and the
+# pipeline settings.
+#
+def write_config(workdir, rds_config, mode):
+  source = ConfigParser()
+  source.read(rds_config)
+
+  if not source.has_section('rds'):
+    raise Exception("'" + rds_config + "' has no [rds] section")
+
+  configur = ConfigParser()
+  configur['rds'] = dict(source['rds'])
+  configur['s3'] = {'bucket_name': BENCHMARK_BUCKET, 'region_name': BENCHMARK_REGION}
+  for profile in ['s3readwrite', 's3readonly']:
+    configur[profile] = {'aws_access_key_id': 'benchmark',
+                         'aws_secret_access_key': 'benchmark',
+                         'region': BENCHMARK_REGION}
+  configur['pipeline'] = {'mode': mode}
+
+  outfile = open(os.path.join(workdir, 'config.ini'), 'w')
+  configur.write(outfile)
+  outfile.close()
+
+  return configur
+
+
+###################################################################
+#
+# get_dbConn:
+#
+def get_dbConn(configur):
+  return datatier.get_dbConn(configur.get('rds', 'endpoint'),
+                             int(configur.get('rds', 'port_number')),
+                             configur.get('rds', 'user_name'),
+                             configur.get('rds', 'user_pwd'),
+                             configur.get('rds', 'db_name'))
+
+
+###################################################################
+#
+# Benchmark:
+#
+class Benchmark:
+
+  def __init__(self, configur, runtime, userid, trigger):
+    self.configur = configur
+    self.runtime = runtime
+    self.userid = userid
+    self.trigger = trigger
+
+  def invoke(self, name, event):
+    response = self.runtime.invoke(FunctionName=name, Payload=json.dumps(event))
+    result = json.loads(response['Payload'].read())
+    if 'FunctionError' in response:
+      raise Exception(name + " failed: " + result['errorMessage'])
+    return result
+
+  #
+  # wait_for_job: waits for the pipeline to finish a job that S3
+  # notification started.
+  #
+  def wait_for_job(self, dbConn, jobid):
+    sql = "SELECT status FROM jobs WHERE jobid = %s;"
+    while True:
+      # see fresh data, not our own transaction's snapshot:
+      dbConn.commit()
+      row = datatier.retrieve_one_row(dbConn, sql, [jobid])
+      if row[0] != 'pending':
+        return row[0]
+      time.sleep(POLL_SECS)
+
+  #
+  # run_one: pushes one image through the whole pipeline, and
+  # returns its latencies (ms), or the error that stopped it.
+  #
+  def run_one(self, i, image):
+    result = {'image': i, 'bytes': len(image), 'error': None}
+    start = time.time()
+
+    try:
+      event = {
+        'userid': self.userid,
+        'body': json.dumps({'filename': 'bench-' + str(i) + '.jpg',
+                            'data': base64.b64encode(image).decode()})
+      }
+      response = self.invoke('finalproj_upload', event)
+      if response['statusCode'] != 200:
+        raise Exception("upload failed: " + response['body'])
+
+      jobid = int(json.loads(response['body']))
+      uploaded = time.time()
+
+      dbConn = get_dbConn(self.configur)
+
+      if self.trigger == 'notification':
+        # the upload's S3 notification has started the pipeline:
+        status = self.wait_for_job(dbConn, jobid)
+        if status != 'completed':
+          raise Exception("pipeline failed: " + status)
+      else:
+        #
+        # what S3 would send finalproj_pipeline for the upload:
+        #
+        row = datatier.retrieve_one_row(dbConn, "SELECT datafilekey FROM jobs WHERE jobid = %s;", [jobid])
+        event = localruntime.s3_event('ObjectCreated:Put', BENCHMARK_BUCKET, row[0])
+        response = self.invoke('finalproj_pipeline', event)
+        if response['statusCode'] != 200:
+          raise Exception("pipeline failed: " + response['body'])
+      processed = time.time()
+
+      response = self.invoke('finalproj_download', {'jobid': jobid})
+      if response['statusCode'] != 200:
+        raise Exception("download failed: " + str(response['body'])[0:256])
+      downloaded = time.time()
+
+      result.update({
+        'jobid': jobid,
+        'upload': (uploaded - start) * 1000,
+        'pipeline': (processed - uploaded) * 1000,
+        'download': (downloaded - processed) * 1000,
+        'end_to_end': (downloaded - start) * 1000,
+        'stages': {stage: info['durationms']
+                   for (stage, info) in progress.get_stages(dbConn, jobid).items()}
+      })
+
+      dbConn.close()
+
+    except Exception as err:
+      result['error'] = str(err)
+
+    return result
+
+
+###################################################################
+#
+# summarize:
+#
+def summarize(args, results, elapsed):
+  succeeded = [r for r in results if r['error'] is None]
+
+  latencies = {}
+  for name in ['upload', 'pipeline', 'download', 'end_to_end']:
+    latencies[name] = percentiles([r[name] for r in succeeded])
+
+  stages = {}
+  for r in succeeded:
+    for (stage, durationms) in r['stages'].items():
+      stages.setdefault(stage, []).append(durationms)
+
+  return {
+    'config': {
+      'images': args.images,
+      'concurrency': args.concurrency,
+      'sizes': args.sizes,
+      'mode': args.mode,
+      'trigger': args.trigger,
+      'rekognition_ms': args.rekognition_ms,
+      'seed': args.seed
+    },
+    'succeeded': len(succeeded),
+    'failed': len(results) - len(succeeded),
+    'errors': sorted(set(r['error'] for r in results if r['error'] is not None))[0:10],
+    'secs': round(elapsed, 3),
+    'images_per_sec': round(len(succeeded) / elapsed, 2) if elapsed > 0 else 0,
+    'mb_per_sec': round(sum(r['bytes'] for r in succeeded) / (1024 * 1024) / elapsed, 2)
+                  if elapsed > 0 else 0,
+    'latency_ms': latencies,
+    'stage_latency_ms': {stage: percentiles(values) for (stage, values) in sorted(stages.items())}
+  }
+
+
+###################################################################
+#
+# main:
+#
+def main(argv):
+  parser = argparse.ArgumentParser(description="Benchmark the image pipeline locally.")
+  parser.add_argument("--rds-config", required=True,
+                      help="config.ini whose [rds] section names a scratch MySQL database")
+  parser.add_argument("--images", type=int, default=50)
+  parser.add_argument("--concurrency", type=int, default=4)
+  parser.add_argument("--sizes", default="640x480:5,1920x1080:3,4000x3000:1",
+                      help="WIDTHxHEIGHT:weight,... (default: %(default)s)")
+  parser.add_argument("--mode", choices=sorted(pipeline.PIPELINES), default="staged")
+  parser.add_argument("--trigger", choices=["direct", "notification"], default="direct",
+                      help="how uploads start the pipeline (default: %(default)s)")
+  parser.add_argument("--rekognition-ms", type=float, default=100.0,
+                      help="simulated Rekognition latency (default: %(default)s)")
+  parser.add_argument("--seed", type=int, default=310)
+  parser.add_argument("--reset", action="store_true",
+                      help="empty the database's tables first")
+  parser.add_argument("--out", help="also write the JSON report to this file")
+  args = parser.parse_args(argv)
+
+  rds_config = os.path.abspath(args.rds_config)
+  out = os.path.abspath(args.out) if args.out is not None else None
+
+  #
+  # the handlers read config.ini from the working directory:
+  #
+  workdir = tempfile.mkdtemp(prefix="finalproj-benchmark-")
+  configur = write_config(workdir, rds_config, args.mode)
+  os.chdir(workdir)
+
+  os.environ['AWS_DEFAULT_REGION'] = BENCHMARK_REGION
+  os.environ['AWS_SHARED_CREDENTIALS_FILE'] = 'config.ini'
+
+  mock = mock_aws()
+  mock.start()
+
+  try:
+    boto3.client('s3').create_bucket(Bucket=BENCHMARK_BUCKET,
+                                     CreateBucketConfiguration={'LocationConstraint': BENCHMARK_REGION})
+
+    #
+    # swap in the local stand-ins: the runtime takes the place
+    # of the lambda service, for the orchestrator's invokes and
+    # for S3 notifications:
+    #
+    runtime = localruntime.LocalLambdaRuntime(max_workers=max(args.concurrency, 1) * 4)
+
+    import finalproj_rekognition
+    import finalproj_fused
+    import finalproj_pipeline
+
+    finalproj_rekognition.rekognition = FakeRekognition(args.rekognition_ms)
+    finalproj_fused.rekognition = FakeRekognition(args.rekognition_ms)
+    finalproj_pipeline.lambda_client = runtime
+
+    if args.trigger == 'notification':
+      notifications = localruntime.S3Notifications(runtime, [{'bucket': BENCHMARK_BUCKET,
+                                                              'suffix': '.jpg',
+                                                              'function': 'finalproj_pipeline'}])
+      notifications.install()
+
+    #
+    # make sure we have a user to upload as:
+    #
+    if args.reset:
+      runtime.run('finalproj_reset', {})
+
+    dbConn = get_dbConn(configur)
+
+    sql = "INSERT IGNORE INTO users(username, pwdhash) VALUES(%s, %s);"
+    datatier.perform_action(dbConn, sql, [BENCHMARK_USER, 'benchmark'])
+
+    row = datatier.retrieve_one_row(dbConn, "SELECT userid FROM users WHERE username = %s;",
+                                    [BENCHMARK_USER])
+    userid = row[0]
+    dbConn.close()
+
+    #
+    # the images: one per size class, reused, so generating them
+    # isn't part of what we measure:
+    #
+    sizes = parse_sizes(args.sizes)
+    rng = random.Random(args.seed)
+
+    corpus = {size: make_jpeg(size[0], size[1], args.seed + i)
+              for (i, (size, weight)) in enumerate(sizes)}
+
+    workload = rng.choices([size for (size, weight) in sizes],
+                           weights=[weight for (size, weight) in sizes],
+                           k=args.images)
+
+    benchmark = Benchmark(configur, runtime, userid, args.trigger)
+
+    print("**Running", args.images, "images,", args.concurrency, "at a time**", file=sys.stderr)
+
+    #
+    # the handlers' logging goes to stderr, leaving stdout for
+    # the report:
+    #
+    with contextlib.redirect_stdout(sys.stderr):
+      start = time.time()
+      with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(lambda item: benchmark.run_one(item[0], corpus[item[1]]),
+                                    enumerate(workload)))
+      elapsed = time.time() - start
+
+      # let the compressed images' notifications drain:
+      runtime.shutdown()
+
+    if args.trigger == 'notification':
+      notifications.uninstall()
+
+  finally:
+    mock.stop()
+
+  report = summarize(args, results, elapsed)
+
+  print(json.dumps(report, indent=2))
+  if out is not None:
+    outfile = open(out, 'w')
+    json.dump(report, outfile, indent=2)
+    outfile.close()
+
+  return 0 if report['failed'] == 0 else 1
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
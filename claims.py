@@ -0,0 +1,193 @@
+#
+# claims.py
+#
+# Makes pipeline stages safe to run more than once. S3
+# notifications and asynchronous lambda invokes are delivered at
+# least once, so a stage may be invoked again for an image it has
+# already processed (or is processing right now). Before doing
+# any work, a stage claims (datafilekey, stage, etag) in the
+# stageclaims table:
+#
+#   claim = claims.claim_stage(dbConn, bucketkey, 'compress', etag, owner)
+#   if claim != claims.CLAIMED:
+#     return claims.skip_response('compress', claim)
+#   ... do the work ...
+#   claims.complete_stage(dbConn, bucketkey, 'compress', etag, owner)
+#
+# A duplicate delivery of finished work costs one primary-key
+# lookup. A claim whose owner died without completing or
+# releasing it is taken over once it is CLAIM_STALE_SECS old.
+#
+
+import json
+import uuid
+import datatier
+
+
+CLAIMED = 'claimed'      # ours, go ahead
+COMPLETED = 'completed'  # already done, skip
+BUSY = 'busy'            # another invocation is on it
+
+#
+# a lambda can run for at most 15 minutes, so a claim older than
+# that (plus a margin) belongs to an invocation that died:
+#
+CLAIM_STALE_SECS = 960
+
+
+###################################################################
+#
+# owner:
+#
+# Identifies the invocation making a claim: its request id, or a
+# fresh id if the context doesn't have one.
+#
+def owner(context):
+  request_id = getattr(context, 'aws_request_id', None)
+  return request_id if request_id else str(uuid.uuid4())
+
+
+###################################################################
+#
+# event_etag:
+#
+# The ETag of the object a stage was invoked for, if the event
+# carries one (S3 notifications do, and the orchestrator passes
+# it on); '' otherwise.
+#
+def event_etag(event):
+  if 'etag' in event:
+    return event['etag'] or ""
+
+  if 'Records' in event:
+    return event['Records'][0]['s3']['object'].get('eTag', "")
+
+  return ""
+
+
+###################################################################
+#
+# claim_stage:
+#
+# Claims a stage of an upload for this invocation. The claim is a
+# single INSERT ... ON DUPLICATE KEY UPDATE, which only takes over
+# an existing claim if it is still running and stale; reading the
+# row back tells us whose claim it is.
+#
+def claim_stage(dbConn, datafilekey, stage, etag, owner, stale_secs=CLAIM_STALE_SECS):
+  """
+  Claims a stage of an upload
+
+  Parameters
+  ----------
+  dbConn : the database connection,
+  datafilekey : bucket key of the uploaded image (string),
+  stage : name of the stage (string),
+  etag : ETag of the uploaded object, or '' (string),
+  owner : the claiming invocation (see owner()),
+  stale_secs : age after which a running claim can be taken over
+
+  Returns
+  -------
+  CLAIMED, COMPLETED or BUSY
+  """
+  etag = etag.strip('"')
+
+  sql = """
+    SELECT status, owner, claimed < NOW() - INTERVAL %s SECOND
+    FROM stageclaims
+    WHERE datafilekey = %s AND stage = %s AND etag = %s;
+  """
+
+  row = datatier.retrieve_one_row(dbConn, sql, [stale_secs, datafilekey, stage, etag])
+
+  # the common duplicate: done already, or obviously in progress:
+  if row != () and row[0] == 'completed':
+    return COMPLETED
+  if row != () and not row[2]:
+    return BUSY
+
+  #
+  # MySQL applies the assignments left to right, so "claimed" is
+  # only refreshed if "owner" was just taken over:
+  #
+  sql = """
+    INSERT INTO stageclaims(datafilekey, stage, etag, status, owner, claimed)
+                VALUES(%s, %s, %s, 'running', %s, NOW())
+    ON DUPLICATE KEY UPDATE
+      owner = IF(status = 'running' AND claimed < NOW() - INTERVAL %s SECOND, VALUES(owner), owner),
+      claimed = IF(owner = VALUES(owner), VALUES(claimed), claimed);
+  """
+
+  datatier.perform_action(dbConn, sql, [datafilekey, stage, etag, owner, stale_secs])
+
+  sql = """
+    SELECT status, owner
+    FROM stageclaims
+    WHERE datafilekey = %s AND stage = %s AND etag = %s;
+  """
+
+  row = datatier.retrieve_one_row(dbConn, sql, [datafilekey, stage, etag])
+
+  if row[0] == 'completed':
+    return COMPLETED
+  if row[1] == owner:
+    return CLAIMED
+  return BUSY
+
+
+###################################################################
+#
+# complete_stage:
+#
+# Marks our claim completed, so later deliveries skip the stage.
+#
+def complete_stage(dbConn, datafilekey, stage, etag, owner):
+  sql = """
+    UPDATE stageclaims SET status = 'completed'
+    WHERE datafilekey = %s AND stage = %s AND etag = %s AND owner = %s;
+  """
+
+  return datatier.perform_action(dbConn, sql, [datafilekey, stage, etag.strip('"'), owner])
+
+
+###################################################################
+#
+# release_stage:
+#
+# Gives up our claim after a failure, so a retry can claim the
+# stage straight away rather than waiting for it to go stale.
+#
+def release_stage(dbConn, datafilekey, stage, etag, owner):
+  sql = """
+    DELETE FROM stageclaims
+    WHERE datafilekey = %s AND stage = %s AND etag = %s AND owner = %s AND status = 'running';
+  """
+
+  return datatier.perform_action(dbConn, sql, [datafilekey, stage, etag.strip('"'), owner])
+
+
+###################################################################
+#
+# skip_response:
+#
+# What a stage returns when it doesn't get the claim. Completed
+# work counts as success; work in progress elsewhere is a 409,
+# which the orchestrator (pipeline.run_stage) doesn't count as a
+# failed attempt: it polls the stage until the other invocation
+# completes it or its claim goes stale, for as long as the
+# orchestrating lambda has time left.
+#
+def skip_response(stage, claim):
+  print("**Stage", stage, claim + ", skipping**")
+
+  if claim == COMPLETED:
+    return {
+      'statusCode': 200,
+      'body': json.dumps(stage + " already completed")
+    }
+
+  return {
+    'statusCode': 409,
+    'body': json.dumps(stage + " already in progress")
+  }
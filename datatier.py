@@ -9,6 +9,18 @@
 #
 
 import pymysql
+import timing
+
+
+###################################################################
+#
+# sql_verb:
+#
+# The kind of statement (SELECT, INSERT, ...), for timing records.
+#
+def sql_verb(sql):
+  words = sql.split(None, 1)
+  return words[0].upper() if len(words) > 0 else ""
 
 
 ###################################################################
@@ -36,11 +48,12 @@ def get_dbConn(endpoint, portnum, username, pwd, dbname):
   a connection object
   """
   try:
-    dbConn = pymysql.connect(host=endpoint,
-                             port=portnum,
-                             user=username,
-                             passwd=pwd,
-                             database=dbname)
+    with timing.timed('db.connect', host=endpoint):
+      dbConn = pymysql.connect(host=endpoint,
+                               port=portnum,
+                               user=username,
+                               passwd=pwd,
+                               database=dbname)
 
     return dbConn
 
@@ -50,6 +63,32 @@ def get_dbConn(endpoint, portnum, username, pwd, dbname):
     raise
 
 
+###################################################################
+#
+# LazyConnection:
+#
+# A connection that isn't opened until it's first used, for
+# handlers that may be able to answer from a cache (see
+# rowcache.py) without the database at all. Takes the same
+# parameters as get_dbConn, and can be used wherever a
+# connection can.
+#
+class LazyConnection:
+
+  def __init__(self, endpoint, portnum, username, pwd, dbname):
+    self.parameters = (endpoint, portnum, username, pwd, dbname)
+    self.dbConn = None
+
+  @property
+  def opened(self):
+    return self.dbConn is not None
+
+  def __getattr__(self, name):
+    if self.dbConn is None:
+      self.dbConn = get_dbConn(*self.parameters)
+    return getattr(self.dbConn, name)
+
+
 ##################################################################
 #
 # retrieve_one_row:
@@ -80,8 +119,9 @@ def retrieve_one_row(dbConn, sql, parameters=[]):
   dbCursor = dbConn.cursor()
 
   try:
-    dbCursor.execute(sql, parameters)
-    row = dbCursor.fetchone()
+    with timing.timed('db.query', verb=sql_verb(sql)):
+      dbCursor.execute(sql, parameters)
+      row = dbCursor.fetchone()
     if row is None:  # executed successfully, but no data was retrieved
       return ()
     else:
@@ -127,8 +167,9 @@ def retrieve_all_rows(dbConn, sql, parameters=[]):
   dbCursor = dbConn.cursor()
 
   try:
-    dbCursor.execute(sql, parameters)
-    rows = dbCursor.fetchall()
+    with timing.timed('db.query', verb=sql_verb(sql)):
+      dbCursor.execute(sql, parameters)
+      rows = dbCursor.fetchall()
     if rows is None:  # executed successfully, but no data was retrieved
       return []
     else:
@@ -177,8 +218,9 @@ def perform_action(dbConn, sql, parameters=[]):
   try:
     # try to execute, and if successful commit the changes
     # and return the # of rows modified by the query:
-    dbCursor.execute(sql, parameters)
-    dbConn.commit()
+    with timing.timed('db.query', verb=sql_verb(sql)):
+      dbCursor.execute(sql, parameters)
+      dbConn.commit()
     return dbCursor.rowcount
 
   except Exception as err:
@@ -190,3 +232,51 @@ def perform_action(dbConn, sql, parameters=[]):
 
   finally:
     dbCursor.close()
+
+
+###############################################################
+#
+# perform_insert:
+#
+# Like perform_action, for an INSERT into a table with an
+# AUTO_INCREMENT key: also returns the id generated for the
+# (first) row inserted, straight from the cursor, so there's no
+# need for a "SELECT LAST_INSERT_ID()" round trip.
+#
+def perform_insert(dbConn, sql, parameters=[]):
+  """
+  Executes an sql INSERT query against the database connection
+  and returns the number of rows inserted and the first id
+  generated
+
+  Parameters
+  __________
+  dbConn : the database connection, 
+  sql : the SQL INSERT query (can be parameterized with %s),
+  parameters: optional list of values if parameterized
+
+  Returns
+  _______
+  (number of rows inserted, AUTO_INCREMENT id of the first of
+  them); for a multi-row INSERT, this is the id of the first row
+  listed, as with LAST_INSERT_ID()
+  """
+
+  dbCursor = dbConn.cursor()
+
+  try:
+    with timing.timed('db.query', verb=sql_verb(sql)) as step:
+      dbCursor.execute(sql, parameters)
+      dbConn.commit()
+      step['rows'] = dbCursor.rowcount
+    return (dbCursor.rowcount, dbCursor.lastrowid)
+
+  except Exception as err:
+    # failed, rollback any possible changes and log error:
+    dbConn.rollback()
+    print("datatier.perform_insert() failed:")
+    print(str(err))
+    raise
+
+  finally:
+    dbCursor.close()
@@ -2,6 +2,12 @@ CREATE DATABASE IF NOT EXISTS finalproj;
 
 USE finalproj;
 
+DROP TABLE IF EXISTS resultcache;
+DROP TABLE IF EXISTS jobartifacts;
+DROP TABLE IF EXISTS stageclaims;
+DROP TABLE IF EXISTS image_locations;
+DROP TABLE IF EXISTS image_metadata;
+DROP TABLE IF EXISTS jobstages;
 DROP TABLE IF EXISTS jobs;
 DROP TABLE IF EXISTS users;
 
@@ -25,11 +31,97 @@ CREATE TABLE jobs
     datafilekey       varchar(256) not null,  -- filename in the bucket
     resultsfilekey    varchar(256) not null,  -- results filename in bucket
     PRIMARY KEY (jobid),
-    FOREIGN KEY (userid) REFERENCES users(userid)
+    FOREIGN KEY (userid) REFERENCES users(userid),
+    INDEX (datafilekey)  -- stages look up their job by bucket key
 );
 
 ALTER TABLE jobs AUTO_INCREMENT = 1001;  -- starting value
 
+CREATE TABLE jobstages
+(
+    jobid             int not null,
+    stage             varchar(64) not null,   -- upload, compress, rekognition, metadata
+    status            varchar(256) not null,  -- completed, error msg
+    started           datetime(3) not null,
+    finished          datetime(3) not null,
+    durationms        int not null,
+    PRIMARY KEY (jobid, stage),
+    FOREIGN KEY (jobid) REFERENCES jobs(jobid),
+    INDEX (stage, durationms)  -- per-stage latency percentiles
+);
+
+CREATE TABLE jobartifacts  -- manifest of the results each stage wrote to the bucket
+(
+    jobid             int not null,
+    artifact          varchar(64) not null,   -- compressed, labels, metadata
+    bucketkey         varchar(256) not null,  -- its filename in the bucket
+    size              int not null,           -- in bytes
+    contenttype       varchar(64) not null,
+    checksum          char(64) not null,      -- SHA-256, hex
+    etag              varchar(64) not null,   -- S3 ETag, with its quotes
+    created           datetime(3) not null,
+    PRIMARY KEY (jobid, artifact),
+    FOREIGN KEY (jobid) REFERENCES jobs(jobid)
+);
+
+CREATE TABLE image_metadata
+(
+    jobid             int not null,
+    width             int,
+    height            int,
+    make              varchar(64),   -- camera make and model (EXIF)
+    model             varchar(64),
+    taken             datetime,      -- EXIF DateTimeOriginal
+    orientation       int,           -- EXIF orientation, 1-8
+    PRIMARY KEY (jobid),
+    FOREIGN KEY (jobid) REFERENCES jobs(jobid),
+    INDEX (taken, width),
+    INDEX (width, height),
+    INDEX (make, model)
+);
+
+CREATE TABLE image_locations  -- only images with an EXIF GPS position
+(
+    jobid             int not null,
+    latitude          double not null,
+    longitude         double not null,
+    location          POINT not null SRID 4326,
+    PRIMARY KEY (jobid),
+    FOREIGN KEY (jobid) REFERENCES jobs(jobid),
+    SPATIAL INDEX (location)
+);
+
+CREATE TABLE stageclaims  -- which invocation owns (or finished) a stage of an upload
+(
+    datafilekey       varchar(256) not null,  -- filename in the bucket
+    stage             varchar(64) not null,   -- pipeline, compress, rekognition, ...
+    etag              varchar(64) not null,   -- version of the object, '' if unknown
+    status            varchar(16) not null,   -- running, completed
+    owner             varchar(64) not null,   -- request id of the claiming invocation
+    claimed           datetime not null,
+    PRIMARY KEY (datafilekey, stage, etag)
+);
+
+CREATE TABLE resultcache  -- computed results (histogram matches) cached in the bucket
+(
+    cachekey          varchar(256) not null,  -- its filename in the bucket
+    size              int not null,           -- in bytes
+    created           datetime(3) not null,
+    lastused          datetime(3) not null,
+    hits              int not null,
+    PRIMARY KEY (cachekey),
+    INDEX (lastused)  -- least recently used are evicted first
+);
+
+CREATE TABLE resets  -- one row: bumped by finalproj_reset, so cached rows (rowcache.py) expire
+(
+    id                int not null,           -- always 1
+    generation        int not null,
+    PRIMARY KEY (id)
+);
+
+INSERT INTO resets(id, generation) VALUES(1, 0);
+
 --
 -- Insert some users to start with:
 -- 
@@ -0,0 +1,125 @@
+#
+# Queue-fed batch mode: an alternative to one pipeline invocation
+# per upload. The bucket's notifications go to an SQS queue
+# instead of finalproj_pipeline, and this function is subscribed
+# to the queue with a batch size of N (and ReportBatchItemFailures
+# enabled). Each invocation processes every upload in its batch
+# on a pool of workers, so cold start, config loading and the
+# stage modules are paid for once per batch rather than once per
+# image.
+#
+# A message body is either an S3 notification (as S3 sends to
+# SQS), or {"bucket": ..., "bucketkey": ..., "etag": ...}.
+# Failed messages are reported back individually, so only they
+# return to the queue.
+#
+# Settings, in the [batch] section of config.ini:
+#
+#   workers = size of the pool (default: the lambda's vCPUs)
+#   mode = pipeline to run, as in [pipeline] (default: fused)
+#
+# Stages run in-process (pipeline.LocalInvoker). The default is
+# the fused stage, which fetches and decodes each image once
+# rather than once per stage.
+#
+
+import json
+import os
+import timing
+import pipeline
+import workerpool
+import finalproj_pipeline
+
+from configparser import ConfigParser
+from concurrent.futures import ThreadPoolExecutor
+
+# the stages are imported on the batch's worker threads, too late
+# to fork the image workers safely, so start them now:
+workerpool.start()
+
+
+###################################################################
+#
+# message_objects:
+#
+# The uploads (bucket, key, etag) a queued message is about.
+#
+def message_objects(message):
+  body = json.loads(message['body'])
+
+  # S3 sends a test message when the notification is set up:
+  if body.get('Event') == 's3:TestEvent':
+    return []
+
+  if 'Records' in body:
+    return pipeline.s3_objects(body)
+
+  return [(body['bucket'], body['bucketkey'], body.get('etag', ""))]
+
+
+###################################################################
+#
+# process_message:
+#
+# Runs the pipeline for each upload in one message; raises if
+# any of them failed, so the message is retried.
+#
+def process_message(configur, invoker, stages, message, context):
+  for (bucketname, bucketkey, etag) in message_objects(message):
+    response = finalproj_pipeline.process_upload(configur, invoker, stages,
+                                                 bucketname, bucketkey, etag, context)
+
+    # 409: another invocation is still on it, so try again later:
+    if response is not None and response['statusCode'] != 200:
+      raise Exception(bucketkey + ": " + response['body'])
+
+
+@timing.instrumented
+def lambda_handler(event, context):
+  print("**STARTING**")
+  print("**lambda: finalproj_batch**")
+
+  messages = event.get('Records', [])
+  failures = []
+
+  try:
+    # setup AWS based on config file:
+    config_file = 'config.ini'
+    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
+
+    configur = ConfigParser()
+    with timing.timed('config.load'):
+      configur.read(config_file)
+
+    mode = configur.get('batch', 'mode', fallback='fused')
+    stages = pipeline.PIPELINES[mode]
+    invoker = pipeline.LocalInvoker(stages)
+
+    workers = configur.getint('batch', 'workers', fallback=os.cpu_count() or 1)
+    workers = max(1, min(workers, len(messages)))
+
+    print("batch of", len(messages), "message(s), pipeline mode", mode + ",", workers, "worker(s)")
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+      futures = {}
+      for message in messages:
+        future = timing.submit(executor, process_message, configur, invoker, stages, message, context)
+        futures[future] = message['messageId']
+
+      for (future, message_id) in futures.items():
+        try:
+          future.result()
+        except Exception as err:
+          print("**ERROR processing message", message_id, "**")
+          print(str(err))
+          failures.append({'itemIdentifier': message_id})
+
+  except Exception as err:
+    # nothing was processed, so the whole batch is retried:
+    print("**ERROR**")
+    print(str(err))
+    failures = [{'itemIdentifier': message['messageId']} for message in messages]
+
+  print("**DONE,", len(messages) - len(failures), "succeeded,", len(failures), "failed**")
+
+  return {'batchItemFailures': failures}
@@ -1,62 +1,69 @@
 import json
 import boto3
-from boto3 import client as boto3_client
 import os
 import uuid
 import base64
 import pathlib
 import datatier
-import urllib.parse
+import claims
+import artifacts
+import timing
+import transfer
+import imaging
+import progress
+import workerpool
+import pipeline
 import string
+import time
 
 from configparser import ConfigParser
 
-import PIL
-from PIL import Image
+# start the image workers at cold start, before any threads:
+workerpool.start()
+
+###################################################################
+#
+# compress_one:
+#
+# Compresses one uploaded image, and uploads the result next to
+# it. Errors are handled here, so that one bad image doesn't
+# stop the rest of a batch.
+#
+def compress_one(configur, bucket, bucketkey, etag, context):
+  """
+  Compresses an uploaded image
+
+  Parameters
+  ----------
+  configur : the parsed config.ini,
+  bucket : the S3 bucket holding the image,
+  bucketkey : key of the image in the bucket (string),
+  etag : ETag of the object, or '' (string),
+  context : the lambda context
+
+  Returns
+  -------
+  HTTP-like response, or None if the key is a compressed image
+  """
+  started = time.time()
+  s3 = bucket.meta.client
+
+  bucketkey_results_file = ""
+  compressed_bytes = None
+  local_img = None
+  claim = None
+
+  # configure for RDS access
+  rds_endpoint = configur.get('rds', 'endpoint')
+  rds_portnum = int(configur.get('rds', 'port_number'))
+  rds_username = configur.get('rds', 'user_name')
+  rds_pwd = configur.get('rds', 'user_pwd')
+  rds_dbname = configur.get('rds', 'db_name')
 
-lambda_client = boto3_client('lambda')
-
-def lambda_handler(event, context):
   try:
-    print("**STARTING**")
-    print("**lambda: finalproject_compress**")
-    
-    # in case we get an exception, set this to a default
-    # filename so we can write an error message if need be:
-    local_results_file = "/tmp/compressed-image.jpg"
-    bucketkey_results_file = ""
-    
-    # setup AWS based on config file:
-    config_file = 'config.ini'
-    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
-    
-    configur = ConfigParser()
-    configur.read(config_file)
-    
-    # configure for S3 access:
-    s3_profile = 's3readwrite'
-    boto3.setup_default_session(profile_name=s3_profile)
-    
-    bucketname = configur.get('s3', 'bucket_name')
-    
-    s3 = boto3.resource('s3')
-    bucket = s3.Bucket(bucketname)
-    
-    # configure for RDS access
-    rds_endpoint = configur.get('rds', 'endpoint')
-    rds_portnum = int(configur.get('rds', 'port_number'))
-    rds_username = configur.get('rds', 'user_name')
-    rds_pwd = configur.get('rds', 'user_pwd')
-    rds_dbname = configur.get('rds', 'db_name')
-    
-    # this function is event-driven by a PDF being
-    # dropped into S3. The bucket key is sent to 
-    # us and obtain as follows:
-    bucketkey = urllib.parse.unquote_plus(event['Records'][0]['s3']['object']['key'], encoding='utf-8')
-    
     #prevent recursive calls
-    if (len(bucketkey) >= 15 and bucketkey[-15:]=="-compressed.jpg"):
-      return
+    if artifacts.is_artifact(bucketkey):
+      return None
     
     print("bucketkey:", bucketkey)
       
@@ -64,82 +71,57 @@ def lambda_handler(event, context):
     
     if extension != ".jpg" and  extension != ".jpeg": 
       raise Exception("expecting S3 document to have .jpg extension")
+
+    # S3 events and asynchronous invokes may be delivered more
+    # than once; only the first delivery does the work:
+    dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+
+    claimant = claims.owner(context)
+    claim = claims.claim_stage(dbConn, bucketkey, 'compress', etag, claimant)
+
+    if claim != claims.CLAIMED:
+      return claims.skip_response('compress', claim)
     
-    # bucketkey_results_file = bucketkey[0:-4] + ".jpg"
-    if extension == ".jpg":
-      bucketkey_results_file = bucketkey[0:-4] + "-compressed.jpg"
-    elif extension == ".jpeg":
-      bucketkey_results_file = bucketkey[0:-5] + "-compressed.jpeg"
+    bucketkey_results_file = artifacts.artifact_key(bucketkey, 'compressed')
     
     print("bucketkey results file:", bucketkey_results_file)
-    print("local results file:", local_results_file)
       
-    # download image from S3:
+    # download image from S3: into memory, unless it's too big,
+    # in which case to a file of our own:
     print("**DOWNLOADING '", bucketkey, "'**")
 
-    local_img = "/tmp/image.jpg"
-    
-    bucket.download_file(bucketkey, local_img)
+    local_img = transfer.temp_path("image.jpg")
+    image = transfer.get(s3, bucket.name, bucketkey, local_img)
 
-    # compress image
-    img = Image.open(local_img)
-    width, height = img.size
-    img = img.resize((width, height), Image.Resampling.LANCZOS)
-    
-    # save the results to local results file:
-    img.save(local_results_file)
+    # compress image, on one of the worker processes if the
+    # lambda has more than one vCPU; huge images are decoded
+    # to a scratch file rather than into memory:
+    if imaging.needs_scratch(image):
+      compressed_bytes = workerpool.run(imaging.compress_jpeg_scratch, image)
+    else:
+      if not isinstance(image, bytes):
+        infile = open(image, "rb")
+        image = infile.read()
+        infile.close()
 
+      compressed_bytes = workerpool.run(imaging.compress_jpeg, image)
 
-    # upload the results file to S3:
+    # upload the results to S3, and add them to the job's
+    # manifest:
     print("**UPLOADING to S3 file", bucketkey_results_file, "**")
 
-    bucket.upload_file(local_results_file,
-                       bucketkey_results_file,
-                       ExtraArgs={
-                         'ACL': 'public-read',
-                         'ContentType': 'text/plain'
-                       })
-    
-    #invoke image recognition lambda function
-    invoke_input = {'bucket': bucketname, 'bucketkey': bucketkey}
-    invoke_response = lambda_client.invoke(FunctionName="arn:aws:lambda:us-east-2:003735305151:function:finalproj_rekog",
-                                           InvocationType='Event',
-                                           Payload=json.dumps(invoke_input))
-                       
+    entry = artifacts.upload_artifact(s3, bucket.name, bucketkey, 'compressed', compressed_bytes)
+    artifacts.record_artifact(dbConn, bucketkey, entry)
     
+    # rekognition and metadata run alongside us, and the job
+    # is marked completed by the orchestrator once all stages
+    # are done (see pipeline.py).
     
-    # The last step is to update the database to change
-    # the status of this job, and store the results
-    # bucketkey:
+    # record that this stage is done, so clients can fetch
+    # the compressed image before the whole job completes:
+    progress.record_stage(dbConn, bucketkey, 'compress', 'completed', started)
+    claims.complete_stage(dbConn, bucketkey, 'compress', etag, claimant)
 
-    # TODO: open connection, and update job in database.
-    # Change the status to 'completed', and update the
-    # resultsfilekey.
-    #
-    # dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
-    # get the datafilekey?
-    # sql = '''
-    #       SELECT datafilekey
-    #       FROM jobs
-    #       WHERE condition;
-    #       '''
-    
-    
-    # sql = '''
-    #       UPDATE jobs
-    #       SET status = 'completed', resultsfilekey = %s
-    #       WHERE datafilekey = %s;
-    #       '''
-    # datatier.perform_action(dbConn, sql, [bucketkey_results_file, bucketkey])
-
-
-
-    # done!
-    # respond in an HTTP-like way, i.e. with a status
-    # code and body in JSON format:
-    #
-    print("**DONE, returning success**")
-    
     return {
       'statusCode': 200,
       'body': json.dumps("success")
@@ -150,7 +132,7 @@ def lambda_handler(event, context):
   # on an error, try to upload error message to S3:
   #
   except Exception as err:
-    print("**ERROR**")
+    print("**ERROR compressing", bucketkey, "**")
     print(str(err))
     
     # change
@@ -160,37 +142,85 @@ def lambda_handler(event, context):
     # outfile.write("\n")
     # outfile.close()
     
-    if bucketkey_results_file == "": 
+    if bucketkey_results_file == "" or compressed_bytes is None: 
       # we can't upload the error file:
       pass
     else:
       # upload the error file to S3
       print("**UPLOADING**")
-      bucket.upload_file(local_results_file,
-                         bucketkey_results_file,
-                         ExtraArgs={
-                           'ACL': 'public-read',
-                           'ContentType': 'text/plain'
-                         })
+      artifacts.upload_artifact(s3, bucket.name, bucketkey, 'compressed', compressed_bytes)
 
     #
-    # update jobs row in database:
-    #
-    #
-    # TODO: open connection, update job in database
-    # Change the status to 'error', and update the
-    # resultsfilekey.
+    # record the failed stage; the orchestrator marks the job
+    # as an error:
     #
-    # dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
-    # sql = '''
-    #       UPDATE jobs
-    #       SET status = 'error', resultsfilekey = %s
-    #       WHERE datafilekey = %s;
-    #       '''
-    # datatier.perform_action(dbConn, sql, [bucketkey_results_file, bucketkey])
+    dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+    progress.record_stage(dbConn, bucketkey, 'compress', str(err), started)
+    if claim == claims.CLAIMED:
+      claims.release_stage(dbConn, bucketkey, 'compress', etag, claimant)
+
+    return {
+      'statusCode': 400,
+      'body': json.dumps(str(err))
+    }
+
+  finally:
+    transfer.discard(local_img)
+
+
+@timing.instrumented
+def lambda_handler(event, context):
+  try:
+    print("**STARTING**")
+    print("**lambda: finalproject_compress**")
+    
+    # setup AWS based on config file:
+    config_file = 'config.ini'
+    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
     
+    configur = ConfigParser()
+    with timing.timed('config.load'):
+      configur.read(config_file)
+    
+    # configure for S3 access, once for every image in the event:
+    s3_profile = 's3readwrite'
+    with timing.timed('aws.session'):
+      session = boto3.session.Session(profile_name=s3_profile)
+    
+    bucketname = configur.get('s3', 'bucket_name')
+    
+    s3 = session.resource('s3')
+    bucket = s3.Bucket(bucketname)
+    
+    # this function is a stage of the pipeline, and is sent
+    # the bucket key by the orchestrator (finalproj_pipeline).
+    # It can also still be driven directly by an S3 event, in
+    # which case every record in the event is compressed:
+    if "bucketkey" in event:
+      objects = [(event["bucketkey"], claims.event_etag(event))]
+    else:
+      objects = [(bucketkey, etag) for (_, bucketkey, etag) in pipeline.s3_objects(event)]
 
+    responses = {}
+    for (bucketkey, etag) in objects:
+      response = compress_one(configur, bucket, bucketkey, etag, context)
+      if response is not None:
+        responses[bucketkey] = response
 
+    # done!
+    # respond in an HTTP-like way, i.e. with a status
+    # code and body in JSON format:
+    #
+    print("**DONE**")
+
+    if len(objects) == 1:
+      return responses.get(objects[0][0])
+
+    return pipeline.batch_response(responses)
+
+  except Exception as err:
+    print("**ERROR**")
+    print(str(err))
 
     # done, return:
     return {
@@ -2,10 +2,65 @@ import json
 import boto3
 import os
 import base64
+import hashlib
+import time
 import datatier
+import timing
+import transfer
+import artifacts
+import rowcache
+import httpcache
+import progress
 
 from configparser import ConfigParser
+from concurrent.futures import ThreadPoolExecutor
 
+
+#
+# long-poll bounds: API Gateway gives up on a request after 29
+# seconds, and we keep a margin of the lambda's own timeout to
+# build the response once the job is done:
+#
+MAX_WAIT_SECS = 25
+TIMEOUT_MARGIN_SECS = 3
+
+
+###################################################################
+#
+# wait_for_job:
+#
+# Polls the status of a pending job until it changes or wait_secs
+# have passed, whichever comes first. Polls start 10ms apart and
+# back off exponentially to 100ms, so a job that finishes is
+# noticed within ~100ms while a single primary-key lookup per
+# poll keeps the load on the database small. Returns the latest
+# status.
+#
+def wait_for_job(dbConn, jobid, status, wait_secs, context):
+  if context is not None:
+    remaining_secs = context.get_remaining_time_in_millis() / 1000 - TIMEOUT_MARGIN_SECS
+    wait_secs = min(wait_secs, remaining_secs)
+
+  deadline = time.time() + min(wait_secs, MAX_WAIT_SECS)
+  delay = 0.01
+
+  sql = "SELECT status FROM jobs WHERE jobid = %s;"
+
+  while status == "pending" and time.time() + delay < deadline:
+    time.sleep(delay)
+    delay = min(delay * 2, 0.1)
+
+    # end the current read so the next one sees the latest
+    # committed status, rather than the transaction's snapshot:
+    dbConn.commit()
+
+    row = datatier.retrieve_one_row(dbConn, sql, [jobid])
+    status = row[0]
+
+  return status
+
+
+@timing.instrumented
 def lambda_handler(event, context):
   try:
     print("**STARTING**")
@@ -16,16 +71,17 @@ def lambda_handler(event, context):
     os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
     
     configur = ConfigParser()
-    configur.read(config_file)
+    with timing.timed('config.load'):
+      configur.read(config_file)
     
     # configure for S3 access:
     s3_profile = 's3readonly'
-    boto3.setup_default_session(profile_name=s3_profile)
+    with timing.timed('aws.session'):
+      session = boto3.session.Session(profile_name=s3_profile)
     
     bucketname = configur.get('s3', 'bucket_name')
     
-    s3 = boto3.resource('s3')
-    bucket = s3.Bucket(bucketname)
+    s3 = session.client('s3')
     
     # configure for RDS access
     rds_endpoint = configur.get('rds', 'endpoint')
@@ -48,18 +104,26 @@ def lambda_handler(event, context):
         
     print("jobid:", jobid)
 
+    # optionally, how long (in seconds) to wait for a pending
+    # job to finish before responding:
+    wait_secs = 0
+    if "wait" in event:
+      wait_secs = float(event["wait"])
+    elif event.get("queryStringParameters") and "wait" in event["queryStringParameters"]:
+      wait_secs = float(event["queryStringParameters"]["wait"])
+
+    print("wait:", wait_secs)
+
     # does the jobid exist?  What's the status of the job if so?
-    # open connection to the database:
-    print("**Opening connection**")
-    dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+    # the connection to the database is only opened if needed,
+    # since a warm container usually has completed jobs cached:
+    dbConn = datatier.LazyConnection(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
 
 
     # first we need to make sure the userid is valid:
     print("**Checking if jobid is valid**")
     
-    sql = "SELECT * FROM jobs WHERE jobid = %s;"
-    
-    row = datatier.retrieve_one_row(dbConn, sql, [jobid])
+    row = rowcache.get_job(dbConn, jobid)
     
     if row == ():  # no such job
       print("**No such job, returning...**")
@@ -74,52 +138,71 @@ def lambda_handler(event, context):
     original_data_file = row[3]
     data_file_key = row[4]
     
+    if status == "pending" and wait_secs > 0:
+      print("**Job pending, waiting up to", wait_secs, "secs**")
+      with timing.timed('job.wait', jobid=jobid):
+        status = wait_for_job(dbConn, jobid, status, wait_secs, context)
+    
     print("status:", status)
     print("original data file:", original_data_file)
     print("data file key:", data_file_key)
+
+    # where each of the job's results is (so far), in one
+    # lookup:
+    manifest = rowcache.get_manifest(dbConn, jobid, status == "completed")
+    print("artifacts:", list(manifest.keys()))
+    print("rowcache:", rowcache.stats())
     
     # what's the status of the job?
     if status == "pending":
-      print("**Job status pending, returning...**")
       #
-      return {
-        'statusCode': 400,
-        'body': json.dumps("pending")
-      }
-      
-    if status == 'error':
-      # let's download the results if available, and return the
-      # error message in the results file:
-      if data_file_key == "":
-        print("**Job status unknown error, returning...**")
+      # the job isn't done, but some of its stages may be, in
+      # which case we return what's already available:
+      #
+      stages = progress.get_stages(dbConn, jobid)
+      print("stages:", stages)
+      #
+      output_json = {'status': 'pending', 'stages': stages, 'orig_name': original_data_file,
+                     'artifacts': manifest}
+      #
+      if 'compressed' in manifest:
+        print("**Job pending, downloading compressed image from S3**")
+        compressed_img_bytes = transfer.get_bytes(s3, bucketname, manifest['compressed']['key'])
         #
-        return {
-          'statusCode': 400,
-          'body': json.dumps("ERROR: unknown")
-        }
+        output_json['img_str'] = base64.b64encode(compressed_img_bytes).decode()
+        
+      if 'labels' in manifest:
+        print("**Job pending, downloading labels from S3**")
+        labels_bytes = transfer.get_bytes(s3, bucketname, manifest['labels']['key'])
+        #
+        output_json['labels_str'] = base64.b64encode(labels_bytes).decode()
+        
+      print("**Job status pending, returning partial results...**")
+      #
+      # (which will change, so mustn't be cached):
+      #
+      return httpcache.uncached_response(202, output_json)
       
-      local_filename = "/tmp/results.txt"
+    if status == 'error':
       #
-      # print("**Job status error, downloading error results from S3**")
-      print("**Job status error**")
+      # the failed stages recorded their error messages:
       #
-      # bucket.download_file(results_file_key, local_filename)
+      stages = progress.get_stages(dbConn, jobid)
       #
-      infile = open(local_filename, "r")
-      lines = infile.readlines()
-      infile.close()
+      errors = [stage + ": " + info['status'] for (stage, info) in stages.items()
+                if info['status'] != 'completed']
       #
-      if len(lines) == 0:
-        print("**Job status unknown error given empty results file, returning...**")
+      if len(errors) == 0:
+        print("**Job status unknown error, returning...**")
         #
         return {
           'statusCode': 400,
-          'body': json.dumps("ERROR: unknown, results file was empty")
+          'body': json.dumps("ERROR: unknown")
         }
         
-      msg = "ERROR: " + lines[0]
+      msg = "ERROR: " + "; ".join(errors)
       #
-      print("**Job status error, results msg:", msg)
+      print("**Job status error, stage errors:", msg)
       print("**Returning error msg")
       #
       return {
@@ -139,32 +222,44 @@ def lambda_handler(event, context):
         'body': json.dumps(msg)
       }
       
-    # if we get here, the job completed. So we should have results
-    # to download and return to the user:
-    local_compress_filename = "/tmp/compressed.jpg"
-    local_labels_filename = "/tmp/labels.txt"
-    local_metadata_filename = "/tmp/metadata.txt"
-    
+    # if we get here, the job completed, and its results will
+    # never change. Their checksums identify the response, so if
+    # the client already has it we're done without touching S3:
+    checksums = {artifact: entry['checksum'] for (artifact, entry) in manifest.items()}
+    etag = None
+
+    if len(checksums) == len(artifacts.ARTIFACTS):
+      etag = httpcache.strong_etag('download', jobid, original_data_file, checksums)
+      if httpcache.not_modified(event, etag):
+        print("**Client has the results, returning 304**")
+        return httpcache.not_modified_response(etag)
+
+    # otherwise we download them and return them to the user,
+    # straight into memory and all three at once:
     print("**Downloading results from S3**")
     # y_li/gourds-454e6c17-47d2-48ef-b271-405f5a5c3d8e.jpg
 
-    bucket.download_file(data_file_key[0:-4]+"-compressed.jpg", local_compress_filename)
-    bucket.download_file(data_file_key[0:-4]+"-labels.txt", local_labels_filename)
-    bucket.download_file(data_file_key[0:-4]+"-metadata.txt", local_metadata_filename)
-  
-    #
-    # open the files and read as raw bytes:
-    compressed_img_infile = open(local_compress_filename, "rb")
-    compressed_img_bytes = compressed_img_infile.read()
-    compressed_img_infile.close()
-    
-    labels_infile = open(local_labels_filename, "rb")
-    labels_bytes = labels_infile.read()
-    compressed_img_infile.close()
-    
-    metadata_infile = open(local_metadata_filename, "rb")
-    metadata_bytes = metadata_infile.read()
-    metadata_infile.close()
+    # (each from the first of its keys that exists: jobs completed
+    # before the metadata was JSON only have the legacy .txt):
+    keys = artifacts.artifact_keys(manifest, data_file_key)
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+      downloads = [timing.submit(executor, transfer.get_any, s3, bucketname, keys[artifact])
+                   for artifact in ['compressed', 'labels', 'metadata']]
+
+      (compressed_img_bytes, labels_bytes, metadata_bytes) = [download.result() for download in downloads]
+
+    # jobs from before there were manifests: identify the
+    # response by what we downloaded instead:
+    if etag is None:
+      checksums = {artifact: hashlib.sha256(body).hexdigest()
+                   for (artifact, body) in [('compressed', compressed_img_bytes),
+                                            ('labels', labels_bytes),
+                                            ('metadata', metadata_bytes)]}
+      etag = httpcache.strong_etag('download', jobid, original_data_file, checksums)
+      if httpcache.not_modified(event, etag):
+        print("**Client has the results, returning 304**")
+        return httpcache.not_modified_response(etag)
     
     #
     # now encode the data as base64. Note b64encode returns
@@ -182,11 +277,9 @@ def lambda_handler(event, context):
     # respond in an HTTP-like way, i.e. with a status
     # code and body in JSON format:
     #
-    output_json = {'orig_name': original_data_file, 'img_str':img_str, 'labels_str': labels_str, 'metadata_str': metadata_str}
-    return {
-      'statusCode': 200,
-      'body': json.dumps(output_json)
-    }
+    output_json = {'orig_name': original_data_file, 'img_str':img_str, 'labels_str': labels_str, 'metadata_str': metadata_str,
+                   'artifacts': manifest}
+    return httpcache.cached_response(200, output_json, etag)
     
   except Exception as err:
     print("**ERROR**")
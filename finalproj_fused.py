@@ -0,0 +1,184 @@
+#
+# Fused pipeline stage: fetches the uploaded image from S3 once,
+# into memory, and runs compression, label detection and metadata
+# extraction from that same buffer, writing all three results
+# concurrently. Produces the same outputs as the compress,
+# rekognition and metadata stages combined, with one S3 GET and
+# one pixel decode instead of three downloads.
+#
+
+import json
+import boto3
+import os
+import pathlib
+import time
+import datatier
+import claims
+import artifacts
+import timing
+import transfer
+import imaging
+import metastore
+import progress
+import workerpool
+
+from configparser import ConfigParser
+from concurrent.futures import ThreadPoolExecutor
+
+# Rekognition runs under the lambda's own role. finalproj_batch
+# runs this handler on several threads at once, and a boto3
+# Session (the module-level default one included) isn't safe to
+# share between threads, so each invocation makes its own, and
+# this client comes from a private one too; clients themselves
+# are thread-safe:
+rekognition = boto3.session.Session().client('rekognition')
+
+# start the image workers at cold start, before the Rekognition
+# call (or finalproj_batch) starts threads:
+workerpool.start()
+
+@timing.instrumented
+def lambda_handler(event, context):
+  try:
+    print("**STARTING**")
+    print("**lambda: finalproj_fused**")
+
+    started = time.time()
+    bucketkey = ""
+    claim = None
+
+    # setup AWS based on config file:
+    config_file = 'config.ini'
+    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
+
+    configur = ConfigParser()
+    with timing.timed('config.load'):
+      configur.read(config_file)
+
+    # configure for S3 access:
+    s3_profile = 's3readwrite'
+    with timing.timed('aws.session'):
+      session = boto3.session.Session(profile_name=s3_profile)
+
+    bucketname = configur.get('s3', 'bucket_name')
+
+    s3 = session.client('s3')
+
+    # configure for RDS access
+    rds_endpoint = configur.get('rds', 'endpoint')
+    rds_portnum = int(configur.get('rds', 'port_number'))
+    rds_username = configur.get('rds', 'user_name')
+    rds_pwd = configur.get('rds', 'user_pwd')
+    rds_dbname = configur.get('rds', 'db_name')
+
+    # this function is a stage of the pipeline, and is sent
+    # the bucket key by the orchestrator (finalproj_pipeline):
+    bucketkey = event["bucketkey"]
+
+    print("bucketkey:", bucketkey)
+
+    extension = pathlib.Path(bucketkey).suffix
+
+    if extension != ".jpg" and extension != ".jpeg":
+      raise Exception("expecting S3 document to have .jpg extension")
+
+    # S3 events and asynchronous invokes may be delivered more
+    # than once; only the first delivery does the work:
+    dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+
+    etag = claims.event_etag(event)
+    claimant = claims.owner(context)
+    claim = claims.claim_stage(dbConn, bucketkey, 'fused', etag, claimant)
+
+    if claim != claims.CLAIMED:
+      return claims.skip_response('fused', claim)
+
+    # download image from S3, once, into memory:
+    print("**DOWNLOADING '", bucketkey, "'**")
+
+    image_bytes = transfer.get_bytes(s3, bucketname, bucketkey)
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+      #
+      # label detection is a network call, so let it run
+      # while we work on the pixels:
+      #
+      print("**PROCESSING in memory**")
+
+      labels_future = timing.submit(executor, imaging.detect_labels, rekognition,
+                                    image_bytes, bucketname, bucketkey)
+
+      # metadata only parses the headers; compression is the
+      # one and only decode of the pixels, on a worker process
+      # (so a batch of images uses every vCPU):
+      jpg_metadata = imaging.extract_jpg_metadata(image_bytes)
+
+      # (huge images are decoded to a scratch file rather than
+      # into memory):
+      if imaging.needs_scratch(image_bytes):
+        compressed_bytes = workerpool.run(imaging.compress_jpeg_scratch, image_bytes)
+      else:
+        compressed_bytes = workerpool.run(imaging.compress_jpeg, image_bytes)
+
+      labels = labels_future.result()
+
+      print("Labels found:")
+      print(labels)
+      print("JPG Metadata:", jpg_metadata)
+
+      # upload all the results at once, under the same keys
+      # the individual stages use:
+      print("**UPLOADING results to S3**")
+
+      outputs = [
+        ('compressed', compressed_bytes),
+        ('labels', '\n'.join(labels)),
+        ('metadata', metastore.canonical_json(jpg_metadata))
+      ]
+
+      uploads = [timing.submit(executor, artifacts.upload_artifact, s3, bucketname, bucketkey, artifact, body)
+                 for (artifact, body) in outputs]
+
+      entries = [upload.result() for upload in uploads]
+
+    # add them to the job's manifest:
+    for entry in entries:
+      artifacts.record_artifact(dbConn, bucketkey, entry)
+
+    # index the searchable metadata, and since we stand in for
+    # all three stages, record each of them:
+
+    if jpg_metadata is not None:
+      metastore.index_metadata(dbConn, bucketkey, jpg_metadata)
+      metastore.index_location(dbConn, bucketkey, jpg_metadata)
+
+    for stage in ['compress', 'rekognition', 'metadata']:
+      progress.record_stage(dbConn, bucketkey, stage, 'completed', started)
+
+    claims.complete_stage(dbConn, bucketkey, 'fused', etag, claimant)
+
+    # done!
+    # respond in an HTTP-like way, i.e. with a status
+    # code and body in JSON format:
+    #
+    print("**DONE, returning success**")
+
+    return {
+      'statusCode': 200,
+      'body': json.dumps("success")
+    }
+
+  except Exception as err:
+    print("**ERROR**")
+    print(str(err))
+
+    if bucketkey != "":
+      dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+      progress.record_stage(dbConn, bucketkey, 'fused', str(err), started)
+      if claim == claims.CLAIMED:
+        claims.release_stage(dbConn, bucketkey, 'fused', etag, claimant)
+
+    return {
+      'statusCode': 400,
+      'body': json.dumps(str(err))
+    }
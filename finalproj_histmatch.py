@@ -4,10 +4,96 @@ import os
 import numpy as np
 import base64
 import datatier
+import timing
+import transfer
+import httpcache
+import resultcache
+import rowcache
+import imaging
+import pixels
+import workerpool
 import cv2
 from configparser import ConfigParser
+from concurrent.futures import ThreadPoolExecutor
 
+
+# start the image workers at cold start, before any threads:
+workerpool.start()
+
+#
+# part of the result's ETag: bump it whenever the matching (and
+# so the result for the same two images) changes:
+#
+HISTMATCH_VERSION = 1
+
+#
+# histograms are matched on thumbnails of this size:
+#
+THUMBNAIL_SIZE = 128
+
+#
+# results are cached in the bucket (see resultcache.py), up to
+# [histmatch] cache_budget_mb in config.ini:
+#
+CACHE_BUDGET_MB = 512
+
+
+###################################################################
+#
+# load_thumbnail:
+#
+# Decodes an image, and shrinks it to the size histograms are
+# matched at. Runs on a worker process, so it returns only the
+# small thumbnail.
+#
+def load_thumbnail(local_filename):
+  if imaging.needs_scratch(local_filename):
+    return load_thumbnail_scratch(local_filename)
+
+  return cv2.resize(cv2.imread(local_filename), (THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+
+
+###################################################################
+#
+# load_thumbnail_scratch:
+#
+# load_thumbnail for images too big to decode into memory: the
+# pixels are decoded into a scratch file (imaging.ScratchImage),
+# and shrunk from there, which only reads the rows the thumbnail
+# samples. Gives the same thumbnail as cv2.imread would.
+#
+def load_thumbnail_scratch(local_filename):
+  with imaging.ScratchImage(local_filename) as scratch:
+    (width, height) = scratch.image.size
+    image = np.frombuffer(scratch.buffer, np.uint8).reshape(height, width, scratch.bytes_per_pixel)
+    thumbnail = cv2.resize(image, (THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+
+    # the scratch file can't be unmapped while we look at it:
+    del image
+
+  if thumbnail.ndim == 2:
+    return cv2.cvtColor(thumbnail, cv2.COLOR_GRAY2BGR)
+  return cv2.cvtColor(thumbnail, cv2.COLOR_RGBA2BGR)
+
+
+###################################################################
+#
+# error_response:
+#
+# Builds a 400 response whose body identifies what went wrong
+# and with which job, so clients can branch on the error code
+# rather than parse the message.
+#
+def error_response(code, role, message):
+  return {
+    'statusCode': 400,
+    'body': json.dumps({'error': code, 'job': role, 'message': message})
+  }
+
+
+@timing.instrumented
 def lambda_handler(event, context):
+  local_filenames = []
   try:
     print("**STARTING**")
     print("**lambda: hist_match**")
@@ -17,15 +103,16 @@ def lambda_handler(event, context):
     config_file = 'config.ini'
     os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
     configur = ConfigParser()
-    configur.read(config_file)
+    with timing.timed('config.load'):
+      configur.read(config_file)
     #
     # configure for S3 access:
     #
-    s3_profile = 's3readonly'
-    boto3.setup_default_session(profile_name=s3_profile)
+    s3_profile = 's3readwrite'
+    with timing.timed('aws.session'):
+      session = boto3.session.Session(profile_name=s3_profile)
     bucketname = configur.get('s3', 'bucket_name')
-    s3 = boto3.resource('s3')
-    bucket = s3.Bucket(bucketname)
+    s3 = session.client('s3')
     #
     # configure for RDS access
     #
@@ -58,108 +145,110 @@ def lambda_handler(event, context):
     else:
         raise Exception("requires target parameter in event")
     #
-    # does the jobid exist?  What's the status of the job if so?
+    # do the jobids exist?  What's the status of the jobs if so?
     #
-    # open connection to the database:
+    # the connection to the database is only opened if needed:
+    # completed jobs are usually cached by a warm container:
     #
-    print("**Opening connection**")
-    dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+    dbConn = datatier.LazyConnection(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
     #
-    # first we need to make sure the userid is valid:
+    # look up source and target in (at most) one round trip, and
+    # validate both before we touch S3:
     #
-    print("**Checking if source is valid**")
-    sql = "select * from jobs where jobid = %s;"
-    row = datatier.retrieve_one_row(dbConn, sql, [source])
-    if row == ():  # no such job
-      print("**No such source, returning...**")
-      return {
-        'statusCode': 400,
-        'body': json.dumps("no such source image...")
-      }
-    status = row[2]
-    origin_source_name = row[3]
-    source_key = row[5]
+    print("**Checking if source and target are valid**")
+    jobs = rowcache.get_jobs(dbConn, [source, target])
+    print("rowcache:", rowcache.stats()['jobs'])
     #
-    # what's the status of the job?
-    #
-    if status == "pending":
-      print("**Source still pending, returning...**")
-      #
-      return {
-        'statusCode': 400,
-        'body': json.dumps("pending")
-      }
-    if status == 'error':
+    for role, jobid in [("source", source), ("target", target)]:
+      if str(jobid) not in jobs:  # no such job
+        print("**No such", role, "returning...**")
+        return error_response("no_such_job", role,
+                              "no such " + role + " image...")
+      status = jobs[str(jobid)][2]
+      data_file_key = jobs[str(jobid)][4]
       #
-      # let's download the results if available, and return the
-      # error message in the results file:
+      # what's the status of the job?
       #
-      if results_file_key == "":
-        print("**Source not upload sucessfully, returning...**")
-        #
-        return {
-          'statusCode': 400,
-          'body': json.dumps("ERROR: unknown")
-        }
-    print("**Checking if target is valid**")
-    sql = "select * from jobs where jobid = %s;"
-    row = datatier.retrieve_one_row(dbConn, sql, [target])
-    if row == ():  # no such job
-      print("**No such target, returning...**")
-      return {
-        'statusCode': 400,
-        'body': json.dumps("no such target image...")
-      }
-    status = row[2]
-    origin_target_name = row[3]
-    target_key = row[5]
-    #
-    # what's the status of the job?
-    #
-    if status == "pending":
-      print("**Target still pending, returning...**")
-      #
-      return {
-        'statusCode': 400,
-        'body': json.dumps("pending")
-      }
-    if status == 'error':
-      #
-      # let's download the results if available, and return the
-      # error message in the results file:
-      #
-      if results_file_key == "":
-        print("**Target not upload sucessfully, returning...**")
-        #
-        return {
-          'statusCode': 400,
-          'body': json.dumps("ERROR: unknown")
-        }
-    #
-    # if we get here, the job completed. So we should have results
-    # to download and return to the user:
-    #
-    local_source_filename = "/tmp/source.png"
-    local_target_filename = "/tmp/target.png"
-    local_result_filename = "/tmp/result.png"
+      if status == "pending":
+        print("**", role, "still pending, returning...**")
+        return error_response("pending", role, role + " job is still pending")
+      if status != "completed":
+        print("**", role, "status:", status, "returning...**")
+        return error_response("job_error", role,
+                              role + " job did not complete: " + status)
+      if data_file_key == "":
+        print("**", role, "not uploaded successfully, returning...**")
+        return error_response("job_error", role,
+                              role + " image was not uploaded")
+    #
+    origin_source_name = jobs[str(source)][3]
+    source_key = jobs[str(source)][4]
+    origin_target_name = jobs[str(target)][3]
+    target_key = jobs[str(target)][4]
+    #
+    # uploads are never overwritten (their keys are unique), so
+    # the result only depends on the two keys; if the client
+    # already has it, there's nothing to do:
+    #
+    etag = httpcache.strong_etag('histmatch', HISTMATCH_VERSION, source_key, target_key,
+                                 origin_source_name, origin_target_name)
+    if httpcache.not_modified(event, etag):
+      print("**Client has the result, returning 304**")
+      return httpcache.not_modified_response(etag)
+    #
+    # and if anyone has asked for this pair before, the result
+    # is in the cache:
+    #
+    cachekey = resultcache.cache_key('histmatch', HISTMATCH_VERSION, THUMBNAIL_SIZE,
+                                     source_key, target_key)
+    result_bytes = resultcache.lookup(s3, dbConn, bucketname, cachekey)
+    if result_bytes is not None:
+      print("**DONE, returning cached result**")
+      res_body = {'data': base64.b64encode(result_bytes).decode(),
+                  'source': origin_source_name, 'target': origin_target_name}
+      return httpcache.cached_response(200, res_body, etag)
+    #
+    # if we get here, both jobs completed. So we have images
+    # to download and match:
+    #
+    local_source_filename = transfer.temp_path("source.jpg")
+    local_target_filename = transfer.temp_path("target.jpg")
+    local_filenames = [local_source_filename, local_target_filename]
     print("**Downloading results from S3**")
-    bucket.download_file(source_key, local_source_filename)
-    bucket.download_file(target_key, local_target_filename)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+      downloads = [timing.submit(executor, transfer.download_file, s3, bucketname, key, local_filename)
+                   for (key, local_filename) in [(source_key, local_source_filename),
+                                                 (target_key, local_target_filename)]]
+      for download in downloads:
+        download.result()
     print("**Conducting image matching**")
-    source_im = cv2.resize(cv2.imread(local_source_filename), (128, 128))
-    target_im = cv2.resize(cv2.imread(local_target_filename), (128, 128))
-    H1,W1,C1 = source_im.shape
-    H2,W2,C2 =   target_im.shape
-    out = np.hstack([source_im, cv2.resize(target_im, (W1,H1))])
-    for i in range(C1):
-      source_hist, _ = np.histogram(source_im[:, :, i:i+1], 256, (0, 256))
-      source_hist = source_hist.cumsum() / (H1 * W1)
-      target_hist, _ = np.histogram(target_im[:, :, i:i+1], 256, (0, 256))
-      target_hist = target_hist.cumsum() / (H2 * W2)
-      mapping = np.interp(source_hist, target_hist, np.arange(256))
-      source_im[:, :, i:i+1] = mapping[source_im[:, :, i:i+1]]
-    out = np.hstack([out, source_im])
-    retval, buffer_img= cv2.imencode('.jpg', out)
+    #
+    # decoding the two images is most of the work, so decode
+    # them side by side on the worker processes (if the lambda
+    # has more than one vCPU):
+    #
+    with timing.timed('image.decode'):
+      (source_im, target_im) = workerpool.run_all(load_thumbnail,
+                                                  [(local_source_filename,),
+                                                   (local_target_filename,)])
+    with timing.timed('image.histmatch'):
+      H1,W1,C1 = source_im.shape
+      out = np.hstack([source_im, cv2.resize(target_im, (W1,H1))])
+      source_im = pixels.histogram_match(source_im, target_im)
+      out = np.hstack([out, source_im])
+    with timing.timed('image.encode'):
+      retval, buffer_img= cv2.imencode('.jpg', out)
+    #
+    # cache the result for next time, on a fresh connection
+    # since the matching may have taken a while; a failure here
+    # costs only the caching:
+    #
+    budget_mb = configur.getint('histmatch', 'cache_budget_mb', fallback=CACHE_BUDGET_MB)
+    try:
+      dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+      resultcache.store(s3, dbConn, bucketname, cachekey, buffer_img.tobytes(), budget_mb * 1024 * 1024)
+    except Exception as err:
+      print("**ERROR caching result:", str(err), "**")
     data = base64.b64encode(buffer_img)
     datastr = data.decode()
     print("**DONE, returning results**")
@@ -168,17 +257,14 @@ def lambda_handler(event, context):
     # code and body in JSON format:
     #
     res_body = {'data': datastr, 'source': origin_source_name, 'target': origin_target_name}
-    return {
-      'statusCode': 200,
-      # 'body': json.dumps(datastr),
-      'body': json.dumps(res_body),
-      # 'source' : json.dumps(str(origin_source_name)),
-      # 'target' : json.dumps(str(origin_target_name))
-    }
+    return httpcache.cached_response(200, res_body, etag)
   except Exception as err:
     print("**ERROR**")
     print(str(err))
     return {
       'statusCode': 400,
       'body': json.dumps(str(err))
-    }
\ No newline at end of file
+    }
+  finally:
+    for local_filename in local_filenames:
+      transfer.discard(local_filename)
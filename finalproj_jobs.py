@@ -2,9 +2,11 @@ import json
 import boto3
 import os
 import datatier
+import timing
 
 from configparser import ConfigParser
 
+@timing.instrumented
 def lambda_handler(event, context):
   try:
     print("**STARTING**")
@@ -17,7 +19,8 @@ def lambda_handler(event, context):
     os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
     
     configur = ConfigParser()
-    configur.read(config_file)
+    with timing.timed('config.load'):
+      configur.read(config_file)
     
     #
     # configure for S3 access:
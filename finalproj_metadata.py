@@ -8,13 +8,20 @@ import uuid
 import base64
 import pathlib
 import datatier
+import claims
+import artifacts
+import timing
+import transfer
+import imaging
+import jpegheader
+import metastore
+import progress
 import urllib.parse
 import string
+import time
 
 from configparser import ConfigParser
 from pypdf import PdfReader
-from PIL import Image
-from PIL.ExifTags import TAGS
 
 
 def extract_pdf_metadata(pdf_path):
@@ -38,67 +45,19 @@ def extract_pdf_metadata(pdf_path):
         print("**ERROR**")
         print(f"Error reading PDF metadata: {e}")
         return None
-        
-        
-def extract_jpg_metadata(jpg_path):
-    """
-    Extract metadata from a JPEG file.
-    
-    :param jpeg_path: Path to the JPEG file
-    :return: Dictionary containing metadata, or None if metadata is not available
-    """
-    try:
-        # Open the image file
-        
-        with Image.open(jpg_path) as img:
-            print(f"Image opened successfully: {img.format}, {img.size}")
-            # extract other basic metadata
-            info_dict = {
-                "Image Size": img.size,
-                "Image Height": img.height,
-                "Image Width": img.width,
-                "Image Format": img.format,
-                "Image Mode": img.mode,
-                "Image is Animated": getattr(img, "is_animated", False),
-                "Frames in Image": getattr(img, "n_frames", 1)
-            }
-            
-            for label,value in info_dict.items():
-              print(f"{label:25}: {value}")
-              # Get EXIF data
-              exif_data = img._getexif()
-              # print("exif_data",exif_data)
 
-            # Proceed only if EXIF data is found
-            if exif_data is not None:
-                # Decode EXIF data
-                exif = {
-                    TAGS.get(key): value
-                    for key, value in exif_data.items()
-                    if key in ExifTags.TAGS
-                }
-                # Combine basic metadata and EXIF data
-                info_dict.update(exif)
-            return info_dict
-            
-    except Exception as e:
-          print("**ERROR**")
-          print(f"Error type: {type(e).__name__}")
-          print(f"Error reading JPEG metadata: {e}")
-          return None
 
-        
+@timing.instrumented
 def lambda_handler(event, context):
   try:
     print("**STARTING**")
     print("**lambda: final_proj_metdata**")
     
-    #
-    # in case we get an exception, set this to a default
-    # filename so we can write an error message if need
-    # be:
-    local_results_file = "/tmp/results.txt"
+    started = time.time()
+    
     bucketkey_results_file = ""
+    bucketkey = ""
+    claim = None
     
     
     # setup AWS based on config file:
@@ -106,17 +65,18 @@ def lambda_handler(event, context):
     os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
     
     configur = ConfigParser()
-    configur.read(config_file)
+    with timing.timed('config.load'):
+      configur.read(config_file)
     
     
     # configure for S3 access:
     s3_profile = 's3readwrite'
-    boto3.setup_default_session(profile_name=s3_profile)
+    with timing.timed('aws.session'):
+      session = boto3.session.Session(profile_name=s3_profile)
     
     bucketname = configur.get('s3', 'bucket_name')
     
-    s3 = boto3.resource('s3')
-    bucket = s3.Bucket(bucketname)
+    s3 = session.resource('s3')
     # bucket = event[bucket]
     
     
@@ -127,10 +87,8 @@ def lambda_handler(event, context):
     rds_pwd = configur.get('rds', 'user_pwd')
     rds_dbname = configur.get('rds', 'db_name')
     
-    # this function is event-driven by a PDF being
-    # dropped into S3. The bucket key is sent to 
-    # us and obtain as follows:
-    # bucketkey = urllib.parse.unquote_plus(event['Records'][0]['s3']['object']['key'], encoding='utf-8')
+    # this function is a stage of the pipeline, and is sent
+    # the bucket key by the orchestrator (finalproj_pipeline):
     bucketkey = event["bucketkey"]
     
     print("bucketkey:", bucketkey)
@@ -140,82 +98,70 @@ def lambda_handler(event, context):
     
     if extension.lower() != ".jpeg" and extension.lower() != ".jpg" : 
       raise Exception("expecting S3 document to have .jpeg extension")
+
+    # S3 events and asynchronous invokes may be delivered more
+    # than once; only the first delivery does the work:
+    dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+
+    etag = claims.event_etag(event)
+    claimant = claims.owner(context)
+    claim = claims.claim_stage(dbConn, bucketkey, 'metadata', etag, claimant)
+
+    if claim != claims.CLAIMED:
+      return claims.skip_response('metadata', claim)
     
-    bucketkey_results_file = bucketkey[0:-4] + "-metadata.txt"
+    bucketkey_results_file = artifacts.artifact_key(bucketkey, 'metadata')
     
 
     
     print("bucketkey results file:", bucketkey_results_file)
-    print("local results file:", local_results_file)
       
     #
-    # download jpeg from S3:
+    # fetch just the headers of the jpeg from S3; there's no
+    # need to download (or decode) the pixels:
     #
-    print("**DOWNLOADING '", bucketkey, "'**")
+    print("**FETCHING HEADERS of '", bucketkey, "'**")
 
-    local_jpg = "/tmp/data.jpg"
-    
-    bucket.download_file(bucketkey, local_jpg)
+    header = jpegheader.fetch_jpeg_header(s3.meta.client, bucketname, bucketkey)
+
+    print("fetched", header['fetched'], "bytes")
 
     #
-    # open jpg file:
+    # extract the metadata:
     #
-    print("**PROCESSING local JPG**")
-    
-    # reader = PdfReader(local_pdf)
-    # number_of_pages = len(reader.pages)
-    
+    print("**PROCESSING JPG headers**")
 
-    # if os.path.exists(local_jpg):
-    #     print(f"File {local_jpg} exists.")
-    # else:
-    #     print(f"File {local_jpg} does not exist.")
-        
-    # size = os.path.getsize(local_jpg)
-    # print(f"File size: {size} bytes")
-    # with open(local_jpg, 'rb') as file:
-    #   content = file.read(10)
-    #   print(content)  # This will print the first 10 bytes of the file  
+    jpg_metadata = imaging.header_metadata(header)
 
-
-    # Usage example
-    jpg_metadata = extract_jpg_metadata("/tmp/data.jpg")
     if jpg_metadata:
       print("JPG Metadata:", jpg_metadata)
     else:
       print("No metadata found or error occurred.")
       
     
-    # write the results to local results file:
-    outfile = open(local_results_file, "w")
-    outfile.write("**METADATA**\n")
-    outfile.write(str(jpg_metadata))
-    outfile.close()
-    
-    
-    # upload the results file to S3:
+    # upload the results to S3, as JSON, and add them to the
+    # job's manifest:
     print("**UPLOADING to S3 file", bucketkey_results_file, "**")
 
-    bucket.upload_file(local_results_file,
-                       bucketkey_results_file,
-                       ExtraArgs={
-                         'ACL': 'public-read',
-                         'ContentType': 'text/plain'
-                       })
+    entry = artifacts.upload_artifact(s3.meta.client, bucketname, bucketkey, 'metadata',
+                                      metastore.canonical_json(jpg_metadata))
+    artifacts.record_artifact(dbConn, bucketkey, entry)
     
-    # 
-    # The last step is to update the database to change
-    # the status of this job, and store the results
-    # bucketkey:
-
     #
-    # TODO: open connection, and update job in database.
-    # Change the status to 'completed', and update the
-    # resultsfilekey.
+    # index the searchable fields:
     #
-    dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
-    sql = """UPDATE jobs SET status = 'completed', resultsfilekey = %s WHERE datafilekey = %s"""
-    datatier.perform_action(dbConn, sql, [bucketkey[0:-4] + "-compressed.jpg", bucketkey])
+    print("**INDEXING metadata**")
+
+    metastore.index_metadata(dbConn, bucketkey, jpg_metadata)
+    metastore.index_location(dbConn, bucketkey, jpg_metadata)
+
+    # 
+    # record that the metadata is available; the job itself is
+    # marked completed by the orchestrator once every stage is
+    # done (see pipeline.py).
+    #
+    progress.record_stage(dbConn, bucketkey, 'metadata', 'completed', started)
+    claims.complete_stage(dbConn, bucketkey, 'metadata', etag, claimant)
 
     #
     # done!
@@ -238,12 +184,6 @@ def lambda_handler(event, context):
     print("**ERROR**")
     print(str(err))
     
-    outfile = open(local_results_file, "w")
-
-    outfile.write(str(err))
-    outfile.write("\n")
-    outfile.close()
-    
     if bucketkey_results_file == "": 
       #
       # we can't upload the error file:
@@ -255,25 +195,19 @@ def lambda_handler(event, context):
       #
       print("**UPLOADING**")
       #
-      bucket.upload_file(local_results_file,
-                         bucketkey_results_file,
-                         ExtraArgs={
-                           'ACL': 'public-read',
-                           'ContentType': 'text/plain'
-                         })
+      transfer.put_bytes(s3.meta.client, bucketname, bucketkey_results_file,
+                         json.dumps({"error": str(err)}),
+                         content_type='application/json', acl='public-read')
 
     #
-    # update jobs row in database:
+    # record the failed stage; the orchestrator marks the job
+    # as an error when this stage reports failure.
     #
-    #
-    # TODO: open connection, update job in database
-    # Change the status to 'error', and update the
-    # resultsfilekey.
-    #
-    dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
-    sql = """UPDATE jobs SET status = 'error', resultsfilekey = %s WHERE datafilekey = %s"""
-    datatier.perform_action(dbConn, sql, [bucketkey[0:-4] + "-compressed.jpg", bucketkey])
-
+    if bucketkey != "":
+      dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+      progress.record_stage(dbConn, bucketkey, 'metadata', str(err), started)
+      if claim == claims.CLAIMED:
+        claims.release_stage(dbConn, bucketkey, 'metadata', etag, claimant)
 
     #
     # done, return:
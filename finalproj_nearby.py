@@ -0,0 +1,108 @@
+import json
+import boto3
+import os
+import datatier
+import timing
+import metastore
+
+from configparser import ConfigParser
+
+@timing.instrumented
+def lambda_handler(event, context):
+  try:
+    print("**STARTING**")
+    print("**lambda: finalproj_nearby**")
+    
+    #
+    # setup AWS based on config file:
+    #
+    config_file = 'config.ini'
+    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
+    
+    configur = ConfigParser()
+    with timing.timed('config.load'):
+      configur.read(config_file)
+    
+    #
+    # configure for S3 access:
+    #
+    #s3_profile = 's3readonly'
+    #boto3.setup_default_session(profile_name=s3_profile)
+    #
+    #bucketname = configur.get('s3', 'bucket_name')
+    #
+    #s3 = boto3.resource('s3')
+    #bucket = s3.Bucket(bucketname)
+    
+    #
+    # configure for RDS access
+    #
+    rds_endpoint = configur.get('rds', 'endpoint')
+    rds_portnum = int(configur.get('rds', 'port_number'))
+    rds_username = configur.get('rds', 'user_name')
+    rds_pwd = configur.get('rds', 'user_pwd')
+    rds_dbname = configur.get('rds', 'db_name')
+
+    #
+    # either a box (min_lat, min_lon, max_lat, max_lon), or a
+    # point and radius in metres (lat, lon, radius): could be
+    # parameters in the event, or query string parameters:
+    #
+    print("**Accessing event/queryStringParameters**")
+    
+    if event.get("queryStringParameters"):
+      params = event["queryStringParameters"]
+    else:
+      params = event
+    
+    box = ['min_lat', 'min_lon', 'max_lat', 'max_lon']
+    circle = ['lat', 'lon', 'radius']
+    
+    if all(name in params for name in box):
+      query = {name: float(params[name]) for name in box}
+    elif all(name in params for name in circle):
+      query = {name: float(params[name]) for name in circle}
+    else:
+      raise Exception("requires min_lat, min_lon, max_lat, max_lon or lat, lon, radius parameters")
+    
+    print("query:", query)
+
+    #
+    # open connection to the database:
+    #
+    print("**Opening connection**")
+    
+    dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+    
+    #
+    # now search the spatial index:
+    #
+    print("**Retrieving data**")
+    
+    if 'radius' in query:
+      results = metastore.search_radius(dbConn, query['lat'], query['lon'], query['radius'])
+    else:
+      results = metastore.search_bbox(dbConn, query['min_lat'], query['min_lon'],
+                                      query['max_lat'], query['max_lon'])
+    
+    print(len(results), "matching images")
+
+    #
+    # respond in an HTTP-like way, i.e. with a status
+    # code and body in JSON format:
+    #
+    print("**DONE, returning results**")
+    
+    return {
+      'statusCode': 200,
+      'body': json.dumps(results)
+    }
+    
+  except Exception as err:
+    print("**ERROR**")
+    print(str(err))
+    
+    return {
+      'statusCode': 400,
+      'body': json.dumps(str(err))
+    }
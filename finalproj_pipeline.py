@@ -0,0 +1,234 @@
+import json
+import boto3
+from boto3 import client as boto3_client
+import os
+import time
+import pathlib
+import datatier
+import claims
+import artifacts
+import timing
+import pipeline
+
+from configparser import ConfigParser
+
+lambda_client = boto3_client('lambda')
+
+#
+# time kept back from the lambda's own timeout, when waiting for a
+# stage another invocation is running, to update the job after:
+#
+TIMEOUT_MARGIN_SECS = 10
+
+
+###################################################################
+#
+# UploadsFailed:
+#
+# Raised by lambda_handler when an upload in the event wasn't
+# processed (it failed, or a stage is still busy elsewhere), so
+# that Lambda retries the event, and once out of retries sends it
+# to the function's dead-letter queue; the job stays pending until
+# then. Uploads that did complete are skipped by the retry, since
+# their claims are completed.
+#
+class UploadsFailed(Exception):
+  pass
+
+
+###################################################################
+#
+# deadline:
+#
+# When to stop waiting for busy stages (seconds since the epoch),
+# from the time the lambda has left; None without a context.
+#
+def deadline(context):
+  if context is None or not hasattr(context, 'get_remaining_time_in_millis'):
+    return None
+  return time.time() + context.get_remaining_time_in_millis() / 1000 - TIMEOUT_MARGIN_SECS
+
+
+###################################################################
+#
+# process_upload:
+#
+# Runs the pipeline for one uploaded image and updates its job.
+# Called by lambda_handler for each object in an S3 event, and by
+# finalproj_batch for each queued upload.
+#
+def process_upload(configur, invoker, stages, bucketname, bucketkey, etag, context):
+  """
+  Runs the pipeline for an uploaded image
+
+  Parameters
+  ----------
+  configur : the parsed config.ini,
+  invoker : runs the stages (see pipeline.py),
+  stages : the pipeline definition,
+  bucketname : bucket holding the image (string),
+  bucketkey : key of the image in the bucket (string),
+  etag : ETag of the object, or '' (string),
+  context : the lambda context
+
+  Returns
+  -------
+  HTTP-like response with each stage's status (or a skip response
+  if the upload was already processed), or None if the key is not
+  an original upload
+  """
+  rds_endpoint = configur.get('rds', 'endpoint')
+  rds_portnum = int(configur.get('rds', 'port_number'))
+  rds_username = configur.get('rds', 'user_name')
+  rds_pwd = configur.get('rds', 'user_pwd')
+  rds_dbname = configur.get('rds', 'db_name')
+
+  print("bucketkey:", bucketkey)
+
+  # the stages write their results back into the same bucket;
+  # only original uploads start the pipeline:
+  extension = pathlib.Path(bucketkey).suffix
+
+  if extension != ".jpg" and extension != ".jpeg":
+    print("**Not an image upload, ignoring**")
+    return None
+
+  if artifacts.is_artifact(bucketkey):
+    print("**Derived image, ignoring**")
+    return None
+
+  # S3 may deliver the same notification more than once; only
+  # the first delivery runs the pipeline:
+  dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+
+  claimant = claims.owner(context)
+  claim = claims.claim_stage(dbConn, bucketkey, 'pipeline', etag, claimant)
+
+  if claim != claims.CLAIMED:
+    return claims.skip_response('pipeline', claim)
+
+  try:
+    # fan out to the stages, and join on their completion:
+    print("**RUNNING PIPELINE**")
+
+    # the stages claim their work by the same ETag:
+    payload = {'bucket': bucketname, 'bucketkey': bucketkey, 'etag': etag}
+
+    results = pipeline.run_pipeline(invoker, payload, stages, deadline=deadline(context))
+
+    for name, result in results.items():
+      print(name, ":", result['status'], "after", result['attempts'], "attempt(s),",
+            round(result['duration'], 3), "secs")
+
+    # a stage still running elsewhere hasn't failed: leave the job
+    # pending, and have the caller retry the upload (lambda_handler
+    # raises, finalproj_batch fails the message):
+    if pipeline.pipeline_busy(results):
+      dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+      claims.release_stage(dbConn, bucketkey, 'pipeline', etag, claimant)
+      return claims.skip_response('pipeline', claims.BUSY)
+
+    # now that every stage is done, update the job (on a new
+    # connection, since the stages may have run for a while):
+    dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+
+    if pipeline.pipeline_succeeded(results):
+      sql = """UPDATE jobs SET status = 'completed', resultsfilekey = %s WHERE datafilekey = %s"""
+      datatier.perform_action(dbConn, sql, [artifacts.artifact_key(bucketkey, 'compressed'), bucketkey])
+    else:
+      sql = """UPDATE jobs SET status = 'error' WHERE datafilekey = %s"""
+      datatier.perform_action(dbConn, sql, [bucketkey])
+
+    claims.complete_stage(dbConn, bucketkey, 'pipeline', etag, claimant)
+
+  except Exception:
+    dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+    claims.release_stage(dbConn, bucketkey, 'pipeline', etag, claimant)
+    raise
+
+  summary = {name: result['status'] for name, result in results.items()}
+  return {
+    'statusCode': 200,
+    'body': json.dumps(summary)
+  }
+
+
+###################################################################
+#
+# pipeline_invoker:
+#
+# "invoker = local" in the [pipeline] section runs the stages in
+# this process, as the benchmark (benchmark.py) does; otherwise
+# they are invoked as lambda functions.
+#
+def pipeline_invoker(configur, stages, default='lambda'):
+  if configur.get('pipeline', 'invoker', fallback=default) == 'local':
+    return pipeline.LocalInvoker(stages)
+  return pipeline.LambdaInvoker(lambda_client, stages)
+
+
+@timing.instrumented
+def lambda_handler(event, context):
+  try:
+    print("**STARTING**")
+    print("**lambda: finalproj_pipeline**")
+
+    # setup AWS based on config file:
+    config_file = 'config.ini'
+    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
+
+    configur = ConfigParser()
+    with timing.timed('config.load'):
+      configur.read(config_file)
+
+    mode = configur.get('pipeline', 'mode', fallback='staged')
+    stages = pipeline.PIPELINES[mode]
+
+    print("pipeline mode:", mode)
+
+    invoker = pipeline_invoker(configur, stages)
+
+    # this function is event-driven by images being dropped
+    # into S3; one event may carry several of them, and a
+    # failure on one doesn't stop the others:
+    objects = pipeline.s3_objects(event)
+
+    responses = {}
+    failed = []
+    for (bucketname, bucketkey, etag) in objects:
+      try:
+        response = process_upload(configur, invoker, stages, bucketname, bucketkey, etag, context)
+      except Exception as err:
+        print("**ERROR processing", bucketkey, "**")
+        print(str(err))
+        response = {'statusCode': 400, 'body': json.dumps(str(err))}
+
+      if response is not None:
+        responses[bucketkey] = response
+        if response['statusCode'] != 200:
+          failed.append(bucketkey + ": " + response['body'])
+
+    print("**DONE**")
+
+    # S3 invokes us asynchronously, and counts any response as
+    # success; only an exception gets the event retried:
+    if len(failed) > 0:
+      raise UploadsFailed("; ".join(failed))
+
+    # a single upload gets its own response, as before:
+    if len(objects) == 1:
+      return responses.get(objects[0][1])
+
+    return pipeline.batch_response(responses)
+
+  except UploadsFailed:
+    raise
+
+  except Exception as err:
+    print("**ERROR**")
+    print(str(err))
+
+    return {
+      'statusCode': 400,
+      'body': json.dumps(str(err))
+    }
@@ -1,21 +1,79 @@
 import boto3
-from boto3 import client as boto3_client
 import logging
 from botocore.exceptions import ClientError
 import json
 import os
+import time
+import datatier
+import claims
+import artifacts
+import timing
+import transfer
+import imaging
+import progress
+
+from configparser import ConfigParser
 
 # Instantiate logger
 logger = logging.getLogger(__name__)
 
 # Connect to the Rekognition client and S3 client
-rekognition = boto3.client('rekognition')
-s3 = boto3.client('s3')
+# from a private session, since the default one isn't thread-safe
+# and finalproj_batch may import stages from several threads:
+session = boto3.session.Session()
+rekognition = session.client('rekognition')
+s3 = session.client('s3')
+
+
+def connect():
+    """
+    Opens a connection to the database named in config.ini.
+
+    :return: The database connection
+    """
+    configur = ConfigParser()
+    with timing.timed('config.load'):
+        configur.read('config.ini')
+
+    rds_endpoint = configur.get('rds', 'endpoint')
+    rds_portnum = int(configur.get('rds', 'port_number'))
+    rds_username = configur.get('rds', 'user_name')
+    rds_pwd = configur.get('rds', 'user_pwd')
+    rds_dbname = configur.get('rds', 'db_name')
+
+    return datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+
+
+def record_progress(dbConn, s3_object_key, status, started):
+    """
+    Records the outcome of this stage in the jobstages table.
 
+    :param dbConn: The database connection
+    :param s3_object_key: Bucket key of the job's uploaded image
+    :param status: 'completed', or an error message
+    :param started: When the stage started (seconds since the epoch)
+    """
+    progress.record_stage(dbConn, s3_object_key, 'rekognition', status, started)
 
-lambda_client = boto3_client('lambda')
 
+def record_failure(s3_object_key, status, started, claim, etag, claimant):
+    """
+    Records a failure of this stage, and gives up its claim so a
+    retry can run straight away.
+    """
+    dbConn = connect()
+    record_progress(dbConn, s3_object_key, status, started)
+    if claim == claims.CLAIMED:
+        claims.release_stage(dbConn, s3_object_key, 'rekognition', etag, claimant)
+
+
+@timing.instrumented
 def lambda_handler(event, context):
+    started = time.time()
+    s3_object_key = ""
+    claim = None
+    etag = ""
+    claimant = ""
     try:
         print("hello1")
         # Extract S3 bucket and object key from the event
@@ -23,32 +81,35 @@ def lambda_handler(event, context):
         # s3_object_key = event['Records'][0]['s3']['object']['key']
         s3_bucket = event["bucket"]
         s3_object_key = event["bucketkey"]
-        
-        # Extract the image name without the file extension
-        # image_name = os.path.splitext(os.path.basename(s3_object_key))[0]
-        image_name = s3_object_key[0:]
 
+        # The event may be delivered more than once; only the
+        # first delivery runs label detection:
+        dbConn = connect()
+        etag = claims.event_etag(event)
+        claimant = claims.owner(context)
+        claim = claims.claim_stage(dbConn, s3_object_key, 'rekognition', etag, claimant)
+
+        if claim != claims.CLAIMED:
+            return claims.skip_response('rekognition', claim)
+        
         # Retrieve the image content from S3
-        response = s3.get_object(Bucket=s3_bucket, Key=s3_object_key)
-        image = response['Body'].read()
+        image = transfer.get_bytes(s3, s3_bucket, s3_object_key)
 
         # Analyze the image using Amazon Rekognition
-        response = rekognition.detect_labels(Image={'Bytes': image})
-        labels = [label['Name'] for label in response['Labels']]
+        labels = imaging.detect_labels(rekognition, image, s3_bucket, s3_object_key)
         print("Labels found:")
         print(labels)
 
-        # Create a .txt file with labels
+        # Create a .txt file with labels, and add it to the job's
+        # manifest
         labels_txt = '\n'.join(labels)
-        labels_filename = f"{image_name[0:-4]}-labels.txt"
-        s3.put_object(Body=labels_txt, Bucket=s3_bucket, Key=labels_filename)
-        
-        
-        #invoke metadata lambda function
-        invoke_input = {'bucket': s3_bucket, 'bucketkey': s3_object_key}
-        invoke_response = lambda_client.invoke(FunctionName="arn:aws:lambda:us-east-2:003735305151:function:finalproj_metadata",
-                                           InvocationType='Event',
-                                           Payload=json.dumps(invoke_input))
+        entry = artifacts.upload_artifact(s3, s3_bucket, s3_object_key, 'labels', labels_txt)
+        labels_filename = entry['key']
+        artifacts.record_artifact(dbConn, s3_object_key, entry)
+
+        # Record that the labels are available
+        record_progress(dbConn, s3_object_key, 'completed', started)
+        claims.complete_stage(dbConn, s3_object_key, 'rekognition', etag, claimant)
 
         # Construct a response with the filename
         lambda_response = {
@@ -67,6 +128,8 @@ def lambda_handler(event, context):
         }
         logger.error("Error function %s: %s",
                      context.invoked_function_arn, error_message)
+        if s3_object_key != "":
+            record_failure(s3_object_key, error_message, started, claim, etag, claimant)
 
     except Exception as e:
         lambda_response = {
@@ -78,5 +141,7 @@ def lambda_handler(event, context):
         }
         logger.error("Error function %s: %s",
                      context.invoked_function_arn, str(e))
+        if s3_object_key != "":
+            record_failure(s3_object_key, str(e), started, claim, etag, claimant)
 
     return lambda_response
\ No newline at end of file
@@ -2,9 +2,12 @@ import json
 import boto3
 import os
 import datatier
+import rowcache
+import timing
 
 from configparser import ConfigParser
 
+@timing.instrumented
 def lambda_handler(event, context):
   try:
     print("**STARTING**")
@@ -17,7 +20,8 @@ def lambda_handler(event, context):
     os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
     
     configur = ConfigParser()
-    configur.read(config_file)
+    with timing.timed('config.load'):
+      configur.read(config_file)
     
     #
     # configure for S3 access:
@@ -55,6 +59,26 @@ def lambda_handler(event, context):
     
     datatier.perform_action(dbConn, sql)
     
+    sql = "TRUNCATE TABLE jobartifacts";
+    
+    datatier.perform_action(dbConn, sql)
+    
+    sql = "TRUNCATE TABLE stageclaims";
+    
+    datatier.perform_action(dbConn, sql)
+    
+    sql = "TRUNCATE TABLE image_locations";
+    
+    datatier.perform_action(dbConn, sql)
+    
+    sql = "TRUNCATE TABLE image_metadata";
+    
+    datatier.perform_action(dbConn, sql)
+    
+    sql = "TRUNCATE TABLE jobstages";
+    
+    datatier.perform_action(dbConn, sql)
+    
     sql = "TRUNCATE TABLE jobs";
     
     datatier.perform_action(dbConn, sql)
@@ -69,6 +93,12 @@ def lambda_handler(event, context):
     
     datatier.perform_action(dbConn, sql)
     
+    #
+    # job ids start over, so other containers' cached rows are no
+    # longer theirs: start a new reset generation (see rowcache.py):
+    #
+    rowcache.next_generation(dbConn)
+    
     sql = "ALTER TABLE users AUTO_INCREMENT = 80001;"
     
     datatier.perform_action(dbConn, sql)
@@ -0,0 +1,102 @@
+import json
+import boto3
+import os
+import datatier
+import timing
+import metastore
+
+from configparser import ConfigParser
+
+@timing.instrumented
+def lambda_handler(event, context):
+  try:
+    print("**STARTING**")
+    print("**lambda: finalproj_search**")
+    
+    #
+    # setup AWS based on config file:
+    #
+    config_file = 'config.ini'
+    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
+    
+    configur = ConfigParser()
+    with timing.timed('config.load'):
+      configur.read(config_file)
+    
+    #
+    # configure for S3 access:
+    #
+    #s3_profile = 's3readonly'
+    #boto3.setup_default_session(profile_name=s3_profile)
+    #
+    #bucketname = configur.get('s3', 'bucket_name')
+    #
+    #s3 = boto3.resource('s3')
+    #bucket = s3.Bucket(bucketname)
+    
+    #
+    # configure for RDS access
+    #
+    rds_endpoint = configur.get('rds', 'endpoint')
+    rds_portnum = int(configur.get('rds', 'port_number'))
+    rds_username = configur.get('rds', 'user_name')
+    rds_pwd = configur.get('rds', 'user_pwd')
+    rds_dbname = configur.get('rds', 'db_name')
+
+    #
+    # search filters: could be parameters in the event, or
+    # query string parameters in the URL:
+    #
+    print("**Accessing event/queryStringParameters**")
+    
+    if event.get("queryStringParameters"):
+      params = event["queryStringParameters"]
+    else:
+      params = event
+    
+    filters = {}
+    for name in metastore.SEARCH_FILTERS:
+      if name in params:
+        filters[name] = params[name]
+    
+    for name in ['min_width', 'max_width', 'min_height', 'max_height', 'orientation']:
+      if name in filters:
+        filters[name] = int(filters[name])
+    
+    print("filters:", filters)
+
+    #
+    # open connection to the database:
+    #
+    print("**Opening connection**")
+    
+    dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+    
+    #
+    # now search the indexed metadata:
+    #
+    print("**Retrieving data**")
+    
+    results = metastore.search_metadata(dbConn, filters)
+    
+    print(len(results), "matching images")
+
+    #
+    # respond in an HTTP-like way, i.e. with a status
+    # code and body in JSON format:
+    #
+    print("**DONE, returning results**")
+    
+    return {
+      'statusCode': 200,
+      'body': json.dumps(results)
+    }
+    
+  except Exception as err:
+    print("**ERROR**")
+    print(str(err))
+    
+    return {
+      'statusCode': 400,
+      'body': json.dumps(str(err))
+    }
@@ -1,13 +1,16 @@
 import json
 import boto3
 import os
-import uuid
 import base64
-import pathlib
 import datatier
+import rowcache
+import timing
+import transfer
+import uploads
 
 from configparser import ConfigParser
 
+@timing.instrumented
 def lambda_handler(event, context):
   try:
     print("**STARTING**")
@@ -18,16 +21,17 @@ def lambda_handler(event, context):
     os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
     
     configur = ConfigParser()
-    configur.read(config_file)
+    with timing.timed('config.load'):
+      configur.read(config_file)
     
     # configure for S3 access:
     s3_profile = 's3readwrite'
-    boto3.setup_default_session(profile_name=s3_profile)
+    with timing.timed('aws.session'):
+      session = boto3.session.Session(profile_name=s3_profile)
     
     bucketname = configur.get('s3', 'bucket_name')
     
-    s3 = boto3.resource('s3')
-    bucket = s3.Bucket(bucketname)
+    s3 = session.resource('s3')
     
     # configure for RDS access
     rds_endpoint = configur.get('rds', 'endpoint')
@@ -85,9 +89,7 @@ def lambda_handler(event, context):
     # first we need to make sure the userid is valid:
     print("**Checking if userid is valid**")
     
-    sql = "SELECT * FROM users WHERE userid = %s;"
-    
-    row = datatier.retrieve_one_row(dbConn, sql, [userid])
+    row = rowcache.get_user(dbConn, userid)
     
     if row == ():  # no such user
       print("**No such user, returning...**")
@@ -106,60 +108,28 @@ def lambda_handler(event, context):
     base64_bytes = datastr.encode()        # string -> base64 bytes
     bytes = base64.b64decode(base64_bytes) # base64 bytes -> raw bytes
     
-    #
-    # write raw bytes to local filesystem for upload:
-    #
-    print("**Writing local data file**")
-    
-    local_filename = "/tmp/image.jpg"
-    
-    outfile = open(local_filename, "wb")
-    outfile.write(bytes)
-    outfile.close()
-    
     # generate unique filename in preparation for the S3 upload:
-    print("**Uploading local file to S3**")
+    print("**Generating S3 bucketkey**")
     
-    basename = pathlib.Path(filename).stem
-    extension = pathlib.Path(filename).suffix
-    
-    if extension != ".jpg" : 
-      raise Exception("expecting filename to have .jpg extension")
-    
-    bucketkey =  username + "/" + basename + "-" + str(uuid.uuid4()) + ".jpg"
+    bucketkey = uploads.make_bucketkey(username, filename)
     
     print("S3 bucketkey:", bucketkey)
     
     # add a jobs record to the database BEFORE we upload, just in case
     # the compute function is triggered faster than we can update the
-    # database:
+    # database; the INSERT tells us the jobid mysql generated:
     print("**Adding jobs row to database**")
     
-    sql = """
-      INSERT INTO jobs(userid, status, originaldatafile, datafilekey, resultsfilekey)
-                  VALUES(%s, 'pending', %s, %s, '');
-    """
-    
-    datatier.perform_action(dbConn, sql, [userid, filename, bucketkey])
-    
-    # grab the jobid that was auto-generated by mysql:
-    sql = "SELECT LAST_INSERT_ID();"
-    
-    row = datatier.retrieve_one_row(dbConn, sql)
-    
-    jobid = row[0]
+    jobid = uploads.create_jobs(dbConn, userid, [(filename, bucketkey)])[0]
     
     print("jobid:", jobid)
     
     # finally, upload to S3:
     print("**Uploading data file to S3**")
 
-    bucket.upload_file(local_filename, 
-                       bucketkey, 
-                       ExtraArgs={
-                         'ACL': 'public-read',
-                         'ContentType': 'application/jpg'
-                       })
+    # straight from memory, there's no need for a local file:
+    transfer.put_bytes(s3.meta.client, bucketname, bucketkey, bytes,
+                       content_type='application/jpg', acl='public-read')
 
     # respond in an HTTP-like way, i.e. with a status
     # code and body in JSON format:
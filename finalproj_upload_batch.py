@@ -0,0 +1,252 @@
+#
+# Batch uploads: many files in one request, rather than one
+# finalproj_upload call each (POST /upload_batch/{userid}). The
+# body lists the files:
+#
+#   {"files": [{"filename": "cat.jpg", "data": "<base64>"},
+#              {"filename": "big.jpg"}, ...]}
+#
+# A file with data is uploaded by us, as finalproj_upload would;
+# a file without is for the client to PUT to S3 itself, at the
+# presigned URL we return for it (with the headers it must send),
+# which gets around API Gateway's limit on the size of a request.
+# Every file gets a pending job, all added by one INSERT before
+# anything is uploaded; the response lists them in order:
+#
+#   [{"filename": "cat.jpg", "jobid": "1001"},
+#    {"filename": "big.jpg", "jobid": "1002", "url": ..., "headers": {...}}, ...]
+#
+# Should an upload fail, its job is marked as an error and its
+# entry has an "error"; the status code is then 400.
+#
+
+import json
+import boto3
+import os
+import base64
+import time
+import datatier
+import progress
+import rowcache
+import timing
+import transfer
+import uploads
+
+from concurrent.futures import ThreadPoolExecutor
+from configparser import ConfigParser
+
+
+#
+# most files per request, and how many of them we upload at once:
+#
+MAX_BATCH_FILES = uploads.MAX_JOBS_PER_INSERT
+UPLOAD_CONCURRENCY = 8
+
+#
+# how long a presigned URL stays valid:
+#
+PRESIGN_EXPIRES_SECS = 900
+
+#
+# every upload is stored with these, and a presigned PUT must
+# send them to match its signature:
+#
+CONTENT_TYPE = 'application/jpg'
+ACL = 'public-read'
+
+
+###################################################################
+#
+# read_files:
+#
+# The files listed in the request body, checked before anything
+# is written: [(filename, data or None), ...].
+#
+def read_files(body):
+  if "files" not in body:
+    raise Exception("event has a body but no files")
+
+  files = body["files"]
+
+  if not isinstance(files, list) or len(files) == 0:
+    raise Exception("expecting files to be a non-empty list")
+  if len(files) > MAX_BATCH_FILES:
+    raise Exception("at most " + str(MAX_BATCH_FILES) + " files per batch")
+
+  result = []
+  for file in files:
+    if not isinstance(file, dict) or "filename" not in file:
+      raise Exception("each file needs a filename")
+
+    data = None
+    if file.get("data") is not None:
+      data = base64.b64decode(file["data"].encode())
+
+    result.append((file["filename"], data))
+
+  return result
+
+
+###################################################################
+#
+# presign:
+#
+# A presigned PUT for bucketkey, and the headers the client must
+# send with it.
+#
+def presign(s3, bucketname, bucketkey):
+  url = s3.generate_presigned_url('put_object',
+                                  Params={'Bucket': bucketname,
+                                          'Key': bucketkey,
+                                          'ContentType': CONTENT_TYPE,
+                                          'ACL': ACL},
+                                  ExpiresIn=PRESIGN_EXPIRES_SECS)
+
+  return (url, {'Content-Type': CONTENT_TYPE, 'x-amz-acl': ACL})
+
+
+@timing.instrumented
+def lambda_handler(event, context):
+  try:
+    print("**STARTING**")
+    print("**lambda: finalproj_upload_batch**")
+
+    # setup AWS based on config file:
+    config_file = 'config.ini'
+    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
+
+    configur = ConfigParser()
+    with timing.timed('config.load'):
+      configur.read(config_file)
+
+    # configure for S3 access:
+    s3_profile = 's3readwrite'
+    with timing.timed('aws.session'):
+      session = boto3.session.Session(profile_name=s3_profile)
+
+    bucketname = configur.get('s3', 'bucket_name')
+
+    s3 = session.client('s3')
+
+    # configure for RDS access
+    rds_endpoint = configur.get('rds', 'endpoint')
+    rds_portnum = int(configur.get('rds', 'port_number'))
+    rds_username = configur.get('rds', 'user_name')
+    rds_pwd = configur.get('rds', 'user_pwd')
+    rds_dbname = configur.get('rds', 'db_name')
+
+    # userid from event: could be a parameter
+    # or could be part of URL path ("pathParameters"):
+    print("**Accessing event/pathParameters**")
+
+    if "userid" in event:
+      userid = event["userid"]
+    elif "pathParameters" in event:
+      if "userid" in event["pathParameters"]:
+        userid = event["pathParameters"]["userid"]
+      else:
+        raise Exception("requires userid parameter in pathParameters")
+    else:
+        raise Exception("requires userid parameter in event")
+
+    print("userid:", userid)
+
+    print("**Accessing request body**")
+
+    if "body" not in event:
+      raise Exception("event has no body")
+
+    files = read_files(json.loads(event["body"]))
+
+    print("files:", len(files))
+
+    # open connection to the database:
+    print("**Opening connection**")
+
+    dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+
+    # first we need to make sure the userid is valid:
+    print("**Checking if userid is valid**")
+
+    row = rowcache.get_user(dbConn, userid)
+
+    if row == ():  # no such user
+      print("**No such user, returning...**")
+      return {
+        'statusCode': 400,
+        'body': json.dumps("no such user...")
+      }
+
+    username = row[1]
+
+    # a unique bucketkey for each file (this also checks they
+    # are all .jpg):
+    print("**Generating S3 bucketkeys**")
+
+    bucketkeys = [uploads.make_bucketkey(username, filename) for (filename, data) in files]
+
+    # add all the jobs rows BEFORE we upload, just in case the
+    # compute function is triggered faster than we can update the
+    # database; one INSERT for all of them:
+    print("**Adding jobs rows to database**")
+
+    jobids = uploads.create_jobs(dbConn, userid,
+                                 [(filename, bucketkey) for ((filename, data), bucketkey)
+                                  in zip(files, bucketkeys)])
+
+    print("jobids:", jobids[0], "-", jobids[-1])
+
+    results = [{'filename': filename, 'jobid': str(jobid)}
+               for ((filename, data), jobid) in zip(files, jobids)]
+
+    # upload the files we were sent, and presign the others:
+    print("**Uploading data files to S3**")
+
+    started = time.time()
+
+    def upload(i):
+      transfer.put_bytes(s3, bucketname, bucketkeys[i], files[i][1],
+                         content_type=CONTENT_TYPE, acl=ACL)
+
+    inline = [i for i in range(len(files)) if files[i][1] is not None]
+
+    with ThreadPoolExecutor(max_workers=UPLOAD_CONCURRENCY) as executor:
+      futures = {i: timing.submit(executor, upload, i) for i in inline}
+
+      for i in range(len(files)):
+        if i in futures:
+          try:
+            futures[i].result()
+          except Exception as err:
+            print("**Upload of", bucketkeys[i], "failed:", str(err), "**")
+            results[i]['error'] = str(err)
+        else:
+          (results[i]['url'], results[i]['headers']) = presign(s3, bucketname, bucketkeys[i])
+
+    failed = [i for i in range(len(files)) if 'error' in results[i]]
+
+    # a failed upload is a job error, with the reason recorded as
+    # its upload stage, as the pipeline stages record theirs:
+    if len(failed) > 0:
+      sql = "UPDATE jobs SET status = 'error' WHERE jobid IN (" \
+            + ", ".join(["%s"] * len(failed)) + ");"
+      datatier.perform_action(dbConn, sql, [jobids[i] for i in failed])
+
+      for i in failed:
+        progress.record_stage(dbConn, bucketkeys[i], 'upload', results[i]['error'], started)
+
+    print("**DONE, returning jobids**")
+
+    return {
+      'statusCode': 200 if len(failed) == 0 else 400,
+      'body': json.dumps(results)
+    }
+
+  except Exception as err:
+    print("**ERROR**")
+    print(str(err))
+
+    return {
+      'statusCode': 400,
+      'body': json.dumps(str(err))
+    }
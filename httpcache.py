@@ -0,0 +1,106 @@
+#
+# httpcache.py
+#
+# HTTP caching for the handlers whose responses never change once
+# a job is done (finalproj_download, finalproj_histmatch). Such a
+# response carries a strong ETag, computed from what the response
+# is made of; a request that sends the same ETag back in
+# If-None-Match gets an empty 304 instead of the (large, base64)
+# body:
+#
+#   etag = httpcache.strong_etag('download', jobid, checksums)
+#   if httpcache.not_modified(event, etag):
+#     return httpcache.not_modified_response(etag)
+#   ...
+#   return httpcache.cached_response(200, body, etag)
+#
+# Ideally the check comes before any S3 reads, so a revalidation
+# costs one database lookup.
+#
+
+import json
+import hashlib
+
+
+#
+# a completed result never changes, but its URL isn't immutable:
+# job ids start over after finalproj_reset, so /download/1001 may
+# later be another upload's. Caches may keep the response, but
+# must revalidate it (a cheap 304) every time, and only the
+# client's own cache may keep it. Anything else (pending jobs)
+# mustn't be cached at all:
+#
+REVALIDATE = "private, no-cache"
+NO_STORE = "no-store"
+
+
+###################################################################
+#
+# strong_etag:
+#
+# A quoted ETag from the parts a response is built from; parts
+# are anything JSON can serialize.
+#
+def strong_etag(*parts):
+  digest = hashlib.sha256(json.dumps(parts, sort_keys=True).encode())
+  return '"' + digest.hexdigest()[0:32] + '"'
+
+
+###################################################################
+#
+# request_header:
+#
+# A header of the request, from an API Gateway proxy event
+# (header names may arrive in any case), or None.
+#
+def request_header(event, name):
+  headers = event.get("headers") or {}
+  for (key, value) in headers.items():
+    if key.lower() == name.lower():
+      return value
+  return None
+
+
+###################################################################
+#
+# not_modified:
+#
+# Whether the client already has the response with this ETag,
+# according to the request's If-None-Match.
+#
+def not_modified(event, etag):
+  value = request_header(event, "If-None-Match")
+  if value is None:
+    return False
+
+  etags = [tag.strip() for tag in value.split(",")]
+  # a weak comparison, as RFC 9110 asks for If-None-Match:
+  return "*" in etags or etag in etags or ("W/" + etag) in etags
+
+
+###################################################################
+#
+# responses:
+#
+def not_modified_response(etag, cache_control=REVALIDATE):
+  return {
+    'statusCode': 304,
+    'headers': {'ETag': etag, 'Cache-Control': cache_control},
+    'body': ""
+  }
+
+
+def cached_response(status_code, body, etag, cache_control=REVALIDATE):
+  return {
+    'statusCode': status_code,
+    'headers': {'ETag': etag, 'Cache-Control': cache_control},
+    'body': json.dumps(body)
+  }
+
+
+def uncached_response(status_code, body):
+  return {
+    'statusCode': status_code,
+    'headers': {'Cache-Control': NO_STORE},
+    'body': json.dumps(body)
+  }
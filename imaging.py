@@ -0,0 +1,435 @@
+#
+# imaging.py
+#
+# Image-processing steps shared by the pipeline stages
+# (finalproj_compress, finalproj_rekognition, finalproj_metadata)
+# and the fused single-pass stage (finalproj_fused).
+#
+
+import io
+import os
+import mmap
+import uuid
+import jpegheader
+import timing
+
+from PIL import Image
+from PIL.ExifTags import TAGS, GPSTAGS
+
+
+#
+# Rekognition accepts at most 5MB of inline image bytes; larger
+# images must be passed by S3 reference:
+#
+REKOGNITION_MAX_BYTES = 5 * 1024 * 1024
+
+#
+# PIL image mode for each JPEG component count, and the EXIF tag
+# pointing to the Exif sub-IFD:
+#
+JPEG_MODES = {1: "L", 3: "RGB", 4: "CMYK"}
+
+EXIF_IFD = 0x8769
+GPS_IFD = 0x8825
+
+#
+# images of at least this many pixels are decoded into a scratch
+# file in /tmp rather than into memory (see ScratchImage), so a
+# huge panorama doesn't run the lambda out of memory:
+#
+SCRATCH_MIN_PIXELS = 32 * 1024 * 1024
+SCRATCH_DIR = "/tmp"
+
+#
+# the image mode we decode each JPEG mode into, and its bytes
+# per pixel; PIL keeps RGB as 4 bytes per pixel anyway, and can
+# only wrap a buffer without copying in RGBX:
+#
+SCRATCH_MODES = {"RGB": ("RGBX", 4), "L": ("L", 1)}
+
+
+###################################################################
+#
+# compress_image:
+#
+# Given an opened PIL image, resamples it and re-encodes it as
+# a JPEG, returning the encoded bytes.
+#
+def compress_image(img):
+  """
+  Compresses an image and returns the JPEG-encoded result
+
+  Parameters
+  ----------
+  img : an opened PIL image
+
+  Returns
+  -------
+  the compressed image as bytes
+  """
+  # PIL opens images lazily; decode explicitly so it's timed
+  # on its own:
+  with timing.timed('image.decode'):
+    img.load()
+
+  width, height = img.size
+  with timing.timed('image.resize', width=width, height=height):
+    img = img.resize((width, height), Image.Resampling.LANCZOS)
+
+  buffer = io.BytesIO()
+  with timing.timed('image.encode'):
+    img.save(buffer, format="JPEG")
+
+  return buffer.getvalue()
+
+
+###################################################################
+#
+# compress_jpeg:
+#
+# compress_image for an encoded image. Takes and returns bytes,
+# which are cheap to pass to and from a worker process (see
+# workerpool.py), so the pixels only ever exist in the worker.
+#
+def compress_jpeg(image_bytes):
+  return compress_image(Image.open(io.BytesIO(image_bytes)))
+
+
+###################################################################
+#
+# ScratchImage:
+#
+class ScratchImage:
+  """
+  A JPEG decoded into a memory-mapped scratch file, rather than
+  into memory. The decoder streams scanlines into the file, so
+  the pixels are file-backed pages the kernel can write out
+  under memory pressure, and peak (anonymous) memory stays the
+  same whatever the size of the image.
+
+  Parameters
+  ----------
+  jpg : path to the JPEG file, or its contents as bytes
+
+  Attributes
+  ----------
+  image : PIL image backed by the scratch file (read-only, mode
+          RGBX or L),
+  buffer : the mapped pixels, rows of width * bytes_per_pixel
+  """
+
+  def __init__(self, jpg):
+    self.fp = io.BytesIO(jpg) if isinstance(jpg, bytes) else open(jpg, "rb")
+    self.path = None
+    self.buffer = None
+    self.image = None
+
+    try:
+      source = Image.open(self.fp)
+      if source.format != "JPEG" or source.mode not in SCRATCH_MODES or len(source.tile) != 1:
+        raise Exception("can only decode baseline RGB or greyscale JPEGs to scratch")
+
+      (self.mode, self.bytes_per_pixel) = SCRATCH_MODES[source.mode]
+      (width, height) = source.size
+
+      self.path = os.path.join(SCRATCH_DIR, "scratch-" + str(uuid.uuid4()) + ".pixels")
+      outfile = open(self.path, "w+b")
+      outfile.truncate(width * height * self.bytes_per_pixel)
+      self.buffer = mmap.mmap(outfile.fileno(), 0)
+      outfile.close()
+
+      self.image = Image.frombuffer(self.mode, source.size, self.buffer, "raw", self.mode, 0, 1)
+
+      with timing.timed('image.decode', width=width, height=height, scratch=True):
+        self.decode(source)
+
+    except Exception:
+      self.close()
+      raise
+
+  #
+  # decode: what ImageFile.load does, but into our image rather
+  # than one PIL allocates:
+  #
+  def decode(self, source):
+    (codec, extents, offset, args) = source.tile[0]
+
+    decoder = Image._getdecoder(self.mode, codec, args, source.decoderconfig)
+    decoder.setimage(self.image.im, extents)
+
+    self.fp.seek(offset)
+    data = b""
+
+    try:
+      while True:
+        chunk = self.fp.read(jpegheader.HEADER_FETCH_BYTES)
+        if chunk == b"":
+          raise Exception("image file is truncated")
+
+        (consumed, error) = decoder.decode(data + chunk)
+        if consumed < 0:
+          break
+        data = (data + chunk)[consumed:]
+    finally:
+      # the decoder holds on to the mapping too, and a traceback
+      # would keep it alive:
+      decoder.cleanup()
+      del decoder
+
+    if error < 0:
+      raise Exception("JPEG decoder error " + str(error))
+
+  def close(self):
+    # the image holds on to the mapping, so drop it first:
+    self.image = None
+
+    if self.buffer is not None:
+      self.buffer.close()
+      self.buffer = None
+    if self.path is not None:
+      os.remove(self.path)
+      self.path = None
+    self.fp.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+
+###################################################################
+#
+# needs_scratch:
+#
+# Whether an image is big enough to decode to scratch, judging
+# by its header. Only baseline JPEGs can be streamed: a
+# progressive decoder keeps every coefficient in memory anyway.
+#
+def needs_scratch(jpg):
+  if isinstance(jpg, bytes):
+    prefix = jpg[0:jpegheader.HEADER_FETCH_BYTES]
+  else:
+    infile = open(jpg, "rb")
+    prefix = infile.read(jpegheader.HEADER_FETCH_BYTES)
+    infile.close()
+
+  try:
+    header = jpegheader.parse_jpeg_header(prefix)
+  except jpegheader.NotAJpeg:
+    return False
+
+  if 'width' not in header or header.get('progressive', False):
+    return False
+  if header.get('components') not in [1, 3]:
+    return False
+
+  return header['width'] * header['height'] >= SCRATCH_MIN_PIXELS
+
+
+###################################################################
+#
+# compress_jpeg_scratch:
+#
+# compress_jpeg for images too big to decode into memory: the
+# pixels go to a scratch file (see ScratchImage), and are encoded
+# from there. The output is byte for byte the same. (The
+# resample in compress_image is to the same size, which PIL
+# implements as a copy, so there is nothing to do for it here.)
+#
+def compress_jpeg_scratch(jpg):
+  """
+  Compresses a large JPEG via a scratch file
+
+  Parameters
+  ----------
+  jpg : path to the JPEG file, or its contents as bytes
+
+  Returns
+  -------
+  the compressed image as bytes
+  """
+  with ScratchImage(jpg) as scratch:
+    buffer = io.BytesIO()
+    with timing.timed('image.encode', scratch=True):
+      scratch.image.save(buffer, format="JPEG")
+
+  return buffer.getvalue()
+
+
+###################################################################
+#
+# detect_labels:
+#
+# Runs Rekognition label detection on an image and returns the
+# list of label names. The image bytes are sent inline when
+# small enough, otherwise Rekognition reads the object from S3.
+#
+def detect_labels(rekognition, image_bytes, bucketname, bucketkey):
+  """
+  Detects the labels in an image using Amazon Rekognition
+
+  Parameters
+  ----------
+  rekognition : boto3 rekognition client,
+  image_bytes : the image contents (bytes),
+  bucketname : bucket holding the image (string),
+  bucketkey : key of the image in the bucket (string)
+
+  Returns
+  -------
+  list of label names
+  """
+  if len(image_bytes) <= REKOGNITION_MAX_BYTES:
+    image = {'Bytes': image_bytes}
+  else:
+    image = {'S3Object': {'Bucket': bucketname, 'Name': bucketkey}}
+
+  with timing.timed('rekognition.detect_labels', inline='Bytes' in image):
+    response = rekognition.detect_labels(Image=image)
+
+  return [label['Name'] for label in response['Labels']]
+
+
+###################################################################
+#
+# gps_coordinates:
+#
+# Converts the GPS tags of an image (degrees, minutes, seconds
+# plus N/S and E/W references) to signed decimal degrees.
+#
+def gps_coordinates(gps):
+  """
+  Converts decoded EXIF GPS tags to decimal degrees
+
+  Parameters
+  ----------
+  gps : dictionary of GPS tag name -> value
+
+  Returns
+  -------
+  (latitude, longitude) as floats, or None if the image has no
+  usable position
+  """
+  try:
+    (d, m, sec) = gps["GPSLatitude"]
+    latitude = float(d) + float(m) / 60 + float(sec) / 3600
+    (d, m, sec) = gps["GPSLongitude"]
+    longitude = float(d) + float(m) / 60 + float(sec) / 3600
+  except (KeyError, TypeError, ValueError, ZeroDivisionError):
+    return None
+
+  if gps.get("GPSLatitudeRef", "N").strip("\x00 ").upper() == "S":
+    latitude = -latitude
+  if gps.get("GPSLongitudeRef", "E").strip("\x00 ").upper() == "W":
+    longitude = -longitude
+
+  # rationals with a zero denominator come out as NaN:
+  if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+    return None
+
+  return (latitude, longitude)
+
+
+###################################################################
+#
+# header_metadata:
+#
+# Builds the metadata dictionary for an image from its parsed
+# JPEG header (see jpegheader.py); no pixels are decoded.
+#
+@timing.timed_function('image.metadata')
+def header_metadata(header):
+  """
+  Builds an image's metadata from its parsed JPEG header
+
+  Parameters
+  ----------
+  header : the parsed header, as returned by
+           jpegheader.parse_jpeg_header
+
+  Returns
+  -------
+  dictionary containing the metadata
+  """
+  width = header.get('width')
+  height = header.get('height')
+
+  info_dict = {
+    "Image Size": (width, height),
+    "Image Height": height,
+    "Image Width": width,
+    "Image Format": "JPEG",
+    "Image Mode": JPEG_MODES.get(header.get('components'), "unknown"),
+    "Image is Animated": False,
+    "Frames in Image": 1,
+    "Progressive": header.get('progressive', False)
+  }
+
+  for label, value in info_dict.items():
+    print(f"{label:25}: {value}")
+
+  if 'icc' in header:
+    info_dict["ICC Profile Size"] = len(header['icc'])
+
+  if 'xmp' in header:
+    info_dict["XMP"] = header['xmp']
+
+  # decode EXIF data, if any: the tags of the main image,
+  # plus those of the Exif sub-IFD (DateTimeOriginal, etc.).
+  # Malformed EXIF shouldn't cost us the rest of the metadata:
+  if 'exif' in header:
+    try:
+      exif_data = Image.Exif()
+      exif_data.load(header['exif'])
+
+      exif = {TAGS.get(key, key): value for key, value in exif_data.items()}
+      exif.update({TAGS.get(key, key): value
+                   for key, value in exif_data.get_ifd(EXIF_IFD).items()})
+
+      # the GPS sub-IFD replaces the pointer to it:
+      gps = {GPSTAGS.get(key, key): value
+             for key, value in exif_data.get_ifd(GPS_IFD).items()}
+
+      if len(gps) > 0:
+        exif["GPSInfo"] = gps
+
+        coordinates = gps_coordinates(gps)
+        if coordinates is not None:
+          (exif["Latitude"], exif["Longitude"]) = coordinates
+
+      info_dict.update(exif)
+
+    except Exception as e:
+      print("**ERROR**")
+      print(f"Error decoding EXIF data: {e}")
+
+  return info_dict
+
+
+###################################################################
+#
+# extract_jpg_metadata:
+#
+def extract_jpg_metadata(jpg):
+  """
+  Extract metadata from a JPEG file, from its headers alone.
+
+  :param jpg: Path to the JPEG file, or its contents as bytes
+  :return: Dictionary containing metadata, or None if metadata is not available
+  """
+  try:
+    if isinstance(jpg, bytes):
+      data = jpg
+    else:
+      infile = open(jpg, "rb")
+      data = infile.read()
+      infile.close()
+
+    return header_metadata(jpegheader.parse_jpeg_header(data))
+
+  except Exception as e:
+    print("**ERROR**")
+    print(f"Error type: {type(e).__name__}")
+    print(f"Error reading JPEG metadata: {e}")
+    return None
@@ -0,0 +1,188 @@
+#
+# jpegheader.py
+#
+# Reads the header of a JPEG file -- dimensions, EXIF, ICC profile
+# and XMP -- by walking its markers, without decoding any pixels.
+# Everything we need lives in the segments before the first SOS
+# (start of scan) marker, which for almost every photo is within
+# the first few tens of KB, so from S3 we fetch just that prefix
+# with a ranged GET rather than downloading the whole image.
+#
+
+import struct
+import timing
+
+
+#
+# how much of the object to fetch at a time; the first fetch
+# covers the headers of nearly all images:
+#
+HEADER_FETCH_BYTES = 128 * 1024
+
+#
+# SOFn markers carry the frame dimensions (C4 is DHT, C8 is
+# reserved, CC is DAC):
+#
+SOF_MARKERS = [0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7,
+               0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF]
+
+SOI = 0xD8
+EOI = 0xD9
+SOS = 0xDA
+APP1 = 0xE1
+APP2 = 0xE2
+
+EXIF_ID = b"Exif\x00\x00"
+XMP_ID = b"http://ns.adobe.com/xap/1.0/\x00"
+ICC_ID = b"ICC_PROFILE\x00"
+
+
+###################################################################
+#
+# NotAJpeg:
+#
+class NotAJpeg(Exception):
+  pass
+
+
+###################################################################
+#
+# parse_jpeg_header:
+#
+# Walks the markers at the start of a JPEG up to the first SOS.
+# The data may be a prefix of the file; if a segment runs past
+# the end of the data, the result says how many bytes are needed
+# to carry on.
+#
+def parse_jpeg_header(data):
+  """
+  Parses the header segments of a (possibly truncated) JPEG
+
+  Parameters
+  ----------
+  data : the file contents, or a prefix of them (bytes)
+
+  Returns
+  -------
+  dictionary with 'complete' (True once the first SOS or EOI was
+  reached), 'needed' (bytes needed to continue if not complete),
+  and whatever was found of 'width', 'height', 'components',
+  'progressive', 'exif' (raw TIFF bytes), 'icc' (bytes) and
+  'xmp' (string)
+  """
+  if len(data) < 2 or data[0] != 0xFF or data[1] != SOI:
+    raise NotAJpeg("missing SOI marker, not a JPEG file")
+
+  header = {'complete': False, 'needed': 0}
+  icc_chunks = {}
+  pos = 2
+
+  while True:
+    #
+    # find the next marker, skipping any fill bytes:
+    #
+    while pos < len(data) and data[pos] != 0xFF:
+      pos += 1
+    while pos < len(data) and data[pos] == 0xFF:
+      pos += 1
+
+    if pos >= len(data):
+      header['needed'] = pos + HEADER_FETCH_BYTES
+      break
+
+    marker = data[pos]
+    pos += 1
+
+    if marker == SOS or marker == EOI:
+      header['complete'] = True
+      break
+
+    # standalone markers (TEM, RSTn) have no length:
+    if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+      continue
+
+    if pos + 2 > len(data):
+      header['needed'] = pos + 2 + HEADER_FETCH_BYTES
+      break
+
+    (length,) = struct.unpack(">H", data[pos:pos + 2])
+    end = pos + length
+
+    if end > len(data):
+      header['needed'] = end + HEADER_FETCH_BYTES
+      break
+
+    segment = data[pos + 2:end]
+    pos = end
+
+    if marker in SOF_MARKERS and len(segment) >= 6:
+      (precision, height, width, components) = struct.unpack(">BHHB", segment[0:6])
+      header['width'] = width
+      header['height'] = height
+      header['components'] = components
+      header['progressive'] = marker in [0xC2, 0xC6, 0xCA, 0xCE]
+
+    elif marker == APP1 and segment.startswith(EXIF_ID) and 'exif' not in header:
+      header['exif'] = segment[len(EXIF_ID):]
+
+    elif marker == APP1 and segment.startswith(XMP_ID):
+      header['xmp'] = segment[len(XMP_ID):].decode("utf-8", errors="replace")
+
+    elif marker == APP2 and segment.startswith(ICC_ID) and len(segment) > len(ICC_ID) + 2:
+      # the profile may be split over several chunks, numbered
+      # from 1:
+      seqno = segment[len(ICC_ID)]
+      icc_chunks[seqno] = segment[len(ICC_ID) + 2:]
+
+  if len(icc_chunks) > 0:
+    header['icc'] = b"".join(icc_chunks[seqno] for seqno in sorted(icc_chunks))
+
+  return header
+
+
+###################################################################
+#
+# fetch_jpeg_header:
+#
+# Reads the header of a JPEG stored in S3 using ranged GETs. The
+# first GET fetches HEADER_FETCH_BYTES; further GETs are made only
+# if the header segments extend beyond what we have.
+#
+def fetch_jpeg_header(s3, bucketname, bucketkey):
+  """
+  Fetches and parses the header of a JPEG in S3
+
+  Parameters
+  ----------
+  s3 : boto3 S3 client,
+  bucketname : bucket holding the image (string),
+  bucketkey : key of the image in the bucket (string)
+
+  Returns
+  -------
+  the parsed header (see parse_jpeg_header), with 'fetched' set
+  to the number of bytes transferred
+  """
+  data = b""
+  wanted = HEADER_FETCH_BYTES
+
+  while True:
+    rangestr = "bytes=" + str(len(data)) + "-" + str(wanted - 1)
+    with timing.timed('s3.get_range', key=bucketkey, range=rangestr):
+      response = s3.get_object(Bucket=bucketname, Key=bucketkey, Range=rangestr)
+      chunk = response['Body'].read()
+    data += chunk
+
+    # ContentRange is "bytes first-last/total":
+    total = int(response['ContentRange'].split("/")[1])
+
+    header = parse_jpeg_header(data)
+
+    # done, or nothing more to fetch:
+    if header['complete'] or len(data) >= total or len(chunk) == 0:
+      break
+
+    wanted = max(header['needed'], wanted + HEADER_FETCH_BYTES)
+
+  header['fetched'] = len(data)
+  return header
@@ -0,0 +1,302 @@
+#
+# localruntime.py
+#
+# A local, in-process stand-in for the Lambda service, so the
+# whole pipeline can run (and be profiled) on one machine:
+#
+#   runtime = LocalLambdaRuntime(max_workers=32)
+#   notifications = S3Notifications(runtime, [{'suffix': '.jpg',
+#                                              'function': 'finalproj_pipeline'}])
+#   notifications.install()
+#
+# LocalLambdaRuntime has the same invoke() as a boto3 lambda
+# client, so it can be passed wherever one is expected (e.g. to
+# pipeline.LambdaInvoker). RequestResponse invocations run the
+# handler in the calling thread; Event invocations are queued to
+# a thread pool and retried on failure, as Lambda does.
+#
+# S3Notifications emulates S3 event notifications: once
+# installed, every object written through boto3 (put_object,
+# upload_file, copy) invokes the matching function with an
+# ObjectCreated event, like the bucket's notification
+# configuration does in AWS. Combine with moto's mock_aws for a
+# fake S3 (see benchmark.py).
+#
+
+import io
+import json
+import time
+import threading
+import importlib
+import traceback
+import urllib.parse
+
+import botocore.handlers
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pipeline
+
+
+#
+# function name -> module holding its lambda_handler; the stages
+# of the pipelines are added from pipeline.py:
+#
+FUNCTIONS = {
+  'finalproj_upload': 'finalproj_upload',
+  'finalproj_upload_batch': 'finalproj_upload_batch',
+  'finalproj_pipeline': 'finalproj_pipeline',
+  'finalproj_batch': 'finalproj_batch',
+  'finalproj_download': 'finalproj_download',
+  'finalproj_histmatch': 'finalproj_histmatch',
+  'finalproj_jobs': 'finalproj_jobs',
+  'finalproj_users': 'finalproj_users',
+  'finalproj_reset': 'finalproj_reset',
+  'finalproj_stats': 'finalproj_stats',
+  'finalproj_search': 'finalproj_search',
+  'finalproj_nearby': 'finalproj_nearby'
+}
+
+for stages in pipeline.PIPELINES.values():
+  for stage in stages.values():
+    FUNCTIONS[stage['function']] = stage['module']
+
+#
+# Lambda retries a failed asynchronous (Event) invocation twice:
+#
+EVENT_RETRIES = 2
+EVENT_RETRY_DELAY_SECS = 1.0
+
+#
+# the S3 operations that create an object, and so send an
+# ObjectCreated notification:
+#
+OBJECT_CREATED_OPERATIONS = {
+  'PutObject': 'ObjectCreated:Put',
+  'CompleteMultipartUpload': 'ObjectCreated:CompleteMultipartUpload',
+  'CopyObject': 'ObjectCreated:Copy'
+}
+
+
+###################################################################
+#
+# function_name:
+#
+# Accepts a function name or ARN ("arn:aws:lambda:region:account:
+# function:name[:qualifier]") and returns the function name.
+#
+def function_name(name):
+  if name.startswith("arn:"):
+    return name.split(":")[6]
+  return name
+
+
+###################################################################
+#
+# LocalLambdaRuntime:
+#
+class LocalLambdaRuntime:
+  """
+  Runs lambda handlers in this process, with the invoke() API of
+  a boto3 lambda client.
+
+  Parameters
+  ----------
+  functions : function name -> module (defaults to FUNCTIONS),
+  max_workers : size of the pool running Event invocations,
+  serialized : names of functions whose invocations must not
+    overlap (e.g. because they write fixed /tmp filenames)
+  """
+
+  def __init__(self, functions=None, max_workers=16, serialized=[]):
+    self.functions = dict(FUNCTIONS if functions is None else functions)
+    self.executor = ThreadPoolExecutor(max_workers=max_workers)
+    self.serialized = set(serialized)
+    self.serial_lock = threading.Lock()
+
+    #
+    # outstanding Event invocations, so wait() can join on them
+    # (including those queued by other invocations):
+    #
+    self.pending = 0
+    self.idle = threading.Condition()
+
+    self.stats_lock = threading.Lock()
+    self.stats = {}
+
+  def handler(self, name):
+    name = function_name(name)
+    if name not in self.functions:
+      raise Exception("no such function '" + name + "'")
+    return importlib.import_module(self.functions[name]).lambda_handler
+
+  def record(self, name, duration, failed):
+    with self.stats_lock:
+      stats = self.stats.setdefault(name, {'invocations': 0, 'errors': 0, 'secs': 0.0})
+      stats['invocations'] += 1
+      stats['errors'] += 1 if failed else 0
+      stats['secs'] += duration
+
+  def run(self, name, event):
+    """
+    Runs a function's handler on an event, and returns its
+    response; exceptions propagate, as unhandled errors.
+    """
+    name = function_name(name)
+    handler = self.handler(name)
+    context = pipeline.LocalContext(name)
+
+    start = time.time()
+    failed = True
+    try:
+      if name in self.serialized:
+        with self.serial_lock:
+          response = handler(event, context)
+      else:
+        response = handler(event, context)
+      failed = False
+      return response
+    finally:
+      self.record(name, time.time() - start, failed)
+
+  def invoke(self, FunctionName, InvocationType='RequestResponse', Payload=b'{}', **kwargs):
+    """
+    Invokes a function, as lambda_client.invoke does.
+
+    Returns
+    -------
+    {'StatusCode', 'Payload'} where Payload is a stream of the
+    JSON response (empty for Event invocations); an unhandled
+    error adds 'FunctionError' and the payload describes it
+    """
+    event = json.loads(Payload)
+
+    if InvocationType == 'Event':
+      self.submit(FunctionName, event)
+      return {'StatusCode': 202, 'Payload': io.BytesIO(b'')}
+
+    if InvocationType == 'DryRun':
+      self.handler(FunctionName)
+      return {'StatusCode': 204, 'Payload': io.BytesIO(b'')}
+
+    try:
+      response = self.run(FunctionName, event)
+      return {'StatusCode': 200, 'Payload': io.BytesIO(json.dumps(response).encode())}
+    except Exception as err:
+      error = {'errorMessage': str(err), 'errorType': type(err).__name__,
+               'stackTrace': traceback.format_tb(err.__traceback__)}
+      return {'StatusCode': 200, 'FunctionError': 'Unhandled',
+              'Payload': io.BytesIO(json.dumps(error).encode())}
+
+  def submit(self, name, event):
+    """
+    Queues an Event (asynchronous) invocation.
+    """
+    with self.idle:
+      self.pending += 1
+    self.executor.submit(self.run_event, name, event)
+
+  def run_event(self, name, event):
+    try:
+      for attempt in range(EVENT_RETRIES + 1):
+        try:
+          self.run(name, event)
+          return
+        except Exception as err:
+          print("**local invoke of", name, "attempt", attempt + 1, "failed:", str(err))
+          if attempt < EVENT_RETRIES:
+            time.sleep(EVENT_RETRY_DELAY_SECS * (2 ** attempt))
+    finally:
+      with self.idle:
+        self.pending -= 1
+        self.idle.notify_all()
+
+  def wait(self, timeout=None):
+    """
+    Waits until every Event invocation, including any queued
+    while waiting, has finished. Returns False on timeout.
+    """
+    with self.idle:
+      return self.idle.wait_for(lambda: self.pending == 0, timeout)
+
+  def shutdown(self):
+    self.wait()
+    self.executor.shutdown()
+
+
+###################################################################
+#
+# s3_event:
+#
+# The event S3 sends a lambda function when an object is created.
+#
+def s3_event(event_name, bucketname, bucketkey, size=0, etag=""):
+  return {
+    'Records': [{
+      'eventVersion': '2.1',
+      'eventSource': 'aws:s3',
+      'eventTime': time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime()),
+      'eventName': event_name,
+      's3': {
+        'bucket': {'name': bucketname, 'arn': 'arn:aws:s3:::' + bucketname},
+        'object': {'key': urllib.parse.quote_plus(bucketkey), 'size': size, 'eTag': etag}
+      }
+    }]
+  }
+
+
+###################################################################
+#
+# S3Notifications:
+#
+class S3Notifications:
+  """
+  Emulates S3 event notifications for objects written through
+  boto3: each rule {'bucket', 'prefix', 'suffix', 'function'}
+  (all but 'function' optional) sends ObjectCreated events for
+  matching keys to the function, as an Event invocation.
+
+  install() hooks into botocore's built-in handlers, so it
+  applies to every boto3 session created afterwards (the
+  handlers create theirs per invocation).
+  """
+
+  def __init__(self, runtime, rules):
+    self.runtime = runtime
+    self.rules = rules
+    self.hooks = []
+
+    for operation in OBJECT_CREATED_OPERATIONS:
+      self.hooks.append(('before-parameter-build.s3.' + operation, self.remember_object))
+      self.hooks.append(('after-call.s3.' + operation, self.notify))
+
+  def install(self):
+    botocore.handlers.BUILTIN_HANDLERS.extend(self.hooks)
+
+  def uninstall(self):
+    for hook in self.hooks:
+      botocore.handlers.BUILTIN_HANDLERS.remove(hook)
+
+  def matches(self, rule, bucketname, bucketkey):
+    return rule.get('bucket', bucketname) == bucketname \
+       and bucketkey.startswith(rule.get('prefix', "")) \
+       and bucketkey.endswith(rule.get('suffix', ""))
+
+  #
+  # the bucket and key are in the request parameters, which
+  # after-call doesn't see, so stash them in the call's context:
+  #
+  def remember_object(self, params, context, **kwargs):
+    context['local_s3_object'] = (params.get('Bucket'), params.get('Key'))
+
+  def notify(self, http_response, parsed, model, context, **kwargs):
+    if http_response.status_code != 200 or 'local_s3_object' not in context:
+      return
+
+    (bucketname, bucketkey) = context['local_s3_object']
+    event_name = OBJECT_CREATED_OPERATIONS[model.name]
+    etag = parsed.get('ETag', parsed.get('CopyObjectResult', {}).get('ETag', "")).strip('"')
+
+    for rule in self.rules:
+      if self.matches(rule, bucketname, bucketkey):
+        self.runtime.submit(rule['function'], s3_event(event_name, bucketname, bucketkey, etag=etag))
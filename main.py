@@ -4,6 +4,15 @@
 # The overall purpose of the app is to compress a JPG image
 # and provide information on the contents of that image and metadata
 #
+# The web service is wrapped by the Client class, which can be
+# imported and used as a library. Run with no arguments for the
+# interactive menu, or with a command for scripting:
+#
+#   python main.py users
+#   python main.py --json download 1001
+#   python main.py --repeat 100 --concurrency 10 jobs
+#   python main.py -h
+#
 # Authors:
 #   John Li, Alex Militchinski, Rui Wei, Yi Li
 #   Northwestern University
@@ -11,7 +20,7 @@
 #
 
 import requests
-import jsons
+import urllib3
 
 import uuid
 import pathlib
@@ -19,11 +28,75 @@ import logging
 import sys
 import os
 import base64
+import json
+import glob
+import time
+import random
+import hashlib
+import argparse
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from configparser import ConfigParser
 
-import matplotlib.pyplot as plt
-import matplotlib.image as img
 
-from configparser import ConfigParser
+#
+# how long the server should wait for a pending job to
+# finish before responding to a download:
+#
+DOWNLOAD_WAIT_SECS = 25
+
+#
+# bulk transfers: how many requests to have in flight by
+# default, how often to retry a transient failure, and which
+# HTTP status codes count as transient:
+#
+BULK_CONCURRENCY = 8
+BULK_RETRIES = 4
+TRANSIENT_STATUS_CODES = [429, 500, 502, 503, 504]
+
+#
+# a request that isn't idempotent (an upload creates a job each
+# time it runs) is only retried if the service can't have run
+# it: a 429 (throttled before the lambda started), or a failure
+# to connect. A 5xx from the gateway may come while the lambda
+# is still running, so it is returned as an error instead:
+#
+IDEMPOTENT_METHODS = ["GET", "HEAD"]
+UNSENT_STATUS_CODES = [429]
+
+#
+# a download that times out at the gateway (504) has already
+# waited out its long poll; sending it again would just wait
+# again, so it isn't retried:
+#
+LONG_POLL_RETRY_STATUSES = [429, 500, 502, 503]
+
+#
+# most files one /upload_batch request may carry, and most bytes
+# of base64 data: a lambda's request payload is limited to 6MB
+# (and API Gateway's to 10MB), less the JSON around the data:
+#
+MAX_BATCH_FILES = 100
+MAX_BATCH_BYTES = 5 * 1024 * 1024
+
+#
+# bulk downloads read responses in chunks of this size:
+#
+STREAM_CHUNK_SIZE = 64 * 1024
+
+DEFAULT_CONFIG_FILE = 'finalproj-client-config.ini'
+
+#
+# where responses with an ETag (completed downloads, histogram
+# matches) are kept, so asking again costs an empty 304:
+#
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "finalproj")
+
+#
+# the cache is pruned to this size, least recently used first,
+# when a client starts:
+#
+DEFAULT_CACHE_MAX_BYTES = 512 * 1024 * 1024
 
 
 ############################################################
@@ -49,473 +122,1382 @@ class Job:
     self.resultsfilekey = row[5]
 
 
+class ApiError(Exception):
+  """
+  Raised by Client when the web service responds with an
+  unexpected status code.
+  """
+
+  def __init__(self, url, status_code, body):
+    super().__init__(str(status_code) + ": " + str(body))
+    self.url = url
+    self.status_code = status_code
+    self.body = body
+
+
 ############################################################
 #
-# prompt
+# new_session
 #
-def prompt():
+def new_session(concurrency):
   """
-  Prompts the user and returns the command number
+  Returns a requests session whose connection pool can keep
+  one kept-alive connection per concurrent request.
 
   Parameters
   ----------
-  None
+  concurrency: number of requests that will be in flight
 
   Returns
   -------
-  Command number entered by user (0, 1, 2, ...)
+  a requests.Session
   """
-  print()
-  print(">> Enter a command:")
-  print("   0 => end")
-  print("   1 => users")
-  print("   2 => jobs")
-  print("   3 => upload")
-  print("   4 => download")
-  print("   5 => histogram match")
-  print("   6 => reset")
-
-  cmd = input()
-
-  if cmd == "":
-    cmd = -1
-  elif not cmd.isnumeric():
-    cmd = -1
-  else:
-    cmd = int(cmd)
-
-  return cmd
+  session = requests.Session()
+  adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                          pool_maxsize=concurrency)
+  session.mount("https://", adapter)
+  session.mount("http://", adapter)
+  return session
 
 
 ############################################################
 #
-# users
+# request_with_retries
 #
-def users(baseurl):
+def request_with_retries(session, method, url, retries=BULK_RETRIES,
+                         idempotent=None, retry_statuses=None, **kwargs):
   """
-  Prints out all the users in the database
+  Sends a request, retrying connection failures and transient
+  (429 / 5xx) responses with exponential backoff and jitter.
+  A request that isn't idempotent is only retried when it can't
+  have reached the service (see UNSENT_STATUS_CODES).
 
   Parameters
   ----------
-  baseurl: baseurl for web service
+  session: requests session to send with,
+  method: "GET", "POST", ...,
+  url: url to send to,
+  retries: how many times to retry,
+  idempotent: whether the request may safely run twice
+              (default: only for IDEMPOTENT_METHODS),
+  retry_statuses: status codes to retry (default:
+                  TRANSIENT_STATUS_CODES if idempotent,
+                  otherwise UNSENT_STATUS_CODES),
+  kwargs: passed on to session.request
 
   Returns
   -------
-  nothing
-  """
-  '''
-  Basic User Flow:
-  
-  User uploads an image
-    This triggers compression, recognition, and metadata
-      compression - compresses the image and uploads it onto s3 bucket (original_name-compressed.jpg)
-      metadata - creates text file and uploads to s3 (original_name.txt)
-      recognition - creates text file and uploads to s3 (original_name-labels.txt)
-    This also adds a new job in the jobs table
-  User downloads image thru jobid
-    => compressed image is sent to client thru json
-    => labels are sent thru json
-    => meta data is sent thru json
-  Client will download the image
-  Console will also output the image's labels and metadata
-
-  '''
+  the final response (which may still be an error)
+  """
+  if idempotent is None:
+    idempotent = method.upper() in IDEMPOTENT_METHODS
+  if retry_statuses is None:
+    retry_statuses = TRANSIENT_STATUS_CODES if idempotent else UNSENT_STATUS_CODES
 
-  try:
-    #
-    # call the web service:
-    #
-    api = '/users'
-    url = baseurl + api
+  attempt = 0
+  while True:
+    try:
+      res = session.request(method, url, **kwargs)
+      if res.status_code not in retry_statuses or attempt >= retries:
+        return res
+    except (requests.ConnectionError, requests.Timeout) as e:
+      if attempt >= retries or not (idempotent or unsent(e)):
+        raise
 
-    res = requests.get(url)
+    time.sleep((0.5 * 2 ** attempt) * (0.5 + random.random()))
+    attempt += 1
 
-    #
-    # let's look at what we got back:
-    #
-    if res.status_code != 200:
-      # failed:
-      print("Failed with status code:", res.status_code)
-      print("url: " + url)
-      if res.status_code == 400:
-        # we'll have an error message
-        body = res.json()
-        print("Error message:", body)
-      #
-      return
 
-    #
-    # deserialize and extract users:
-    #
-    body = res.json()
+############################################################
+#
+# unsent
+#
+def unsent(e):
+  """
+  Whether a requests exception means the request never
+  reached the server: the connection couldn't be made.
+  """
+  if isinstance(e, requests.exceptions.ConnectTimeout):
+    return True
+  reason = getattr(e.args[0], "reason", None) if len(e.args) > 0 else None
+  return isinstance(reason, urllib3.exceptions.NewConnectionError)
 
-    #
-    # let's map each row into a User object:
-    #
-    users = []
-    for row in body:
-      user = User(row)
-      users.append(user)
-    #
-    # Now we can think OOP:
-    #
-    if len(users) == 0:
-      print("no users...")
-      return
-
-    for user in users:
-      print(user.userid)
-      print(" ", user.username)
-      print(" ", user.pwdhash)
-    #
-    return
 
-  except Exception as e:
-    logging.error("users() failed:")
-    logging.error("url: " + url)
-    logging.error(e)
-    return
+############################################################
+#
+# percentile
+#
+def percentile(values, p):
+  """
+  Returns the p-th percentile (nearest rank) of a list of
+  numbers, or 0 for an empty list.
+  """
+  if len(values) == 0:
+    return 0
+  values = sorted(values)
+  rank = max(1, -(-p * len(values) // 100))
+  return values[rank - 1]
 
 
 ############################################################
 #
-# jobs
+# stream_b64_field
 #
-def jobs(baseurl):
+def stream_b64_field(chunks, field, outfile):
   """
-  Prints out all the jobs in the database
+  Reads a JSON object from a stream of byte chunks, base64
+  decoding the string value of the given field straight into
+  outfile as it arrives, so the (large) value is never held in
+  memory whole. The rest of the object is small, and is parsed
+  normally with the field's value replaced by "".
 
   Parameters
   ----------
-  baseurl: baseurl for web service
+  chunks: iterable of bytes making up the JSON text,
+  field: name of the base64 string field (string),
+  outfile: binary file to write the decoded value to
 
   Returns
   -------
-  nothing
+  (the rest of the object as a dictionary, True if the field
+  was found), with outfile containing the decoded value
   """
+  marker = b'"' + field.encode() + b'"'
+  state = "search"
+  buf = b""
+  rest = b""
+  found = False
+
+  for chunk in chunks:
+    buf += chunk
+
+    if state == "search":
+      i = buf.find(marker)
+      if i < 0:
+        # keep enough of the tail to match a marker split
+        # across chunks:
+        keep = len(marker) + 16
+        rest += buf[:-keep]
+        buf = buf[-keep:]
+        continue
+      #
+      # skip over the colon to the opening quote:
+      #
+      j = i + len(marker)
+      while j < len(buf) and buf[j:j + 1] in b' \t\r\n:':
+        j += 1
+      if j >= len(buf):
+        continue
+      rest += buf[:i] + marker + b':""'
+      buf = buf[j + 1:]
+      state = "value"
+      found = True
+
+    if state == "value":
+      q = buf.find(b'"')
+      data = buf if q < 0 else buf[:q]
+      #
+      # decode whole 4-character groups, carry the remainder:
+      #
+      n = len(data) if q >= 0 else len(data) - len(data) % 4
+      outfile.write(base64.b64decode(data[:n]))
+      if q < 0:
+        buf = data[n:]
+        continue
+      buf = buf[q + 1:]
+      state = "tail"
 
-  try:
-    #
-    # call the web service:
-    #
-    api = '/jobs'
-    url = baseurl + api
+    if state == "tail":
+      rest += buf
+      buf = b""
 
-    res = requests.get(url)
+  rest += buf
+  return (json.loads(rest), found)
 
-    #
-    # let's look at what we got back:
-    #
-    if res.status_code != 200:
-      # failed:
-      print("Failed with status code:", res.status_code)
-      print("url: " + url)
-      if res.status_code == 400:
-        # we'll have an error message
-        body = res.json()
-        print("Error message:", body)
-      #
-      return
 
-    #
-    # deserialize and extract jobs:
-    #
-    body = res.json()
-    #
-    # let's map each row into an Job object:
-    #
-    jobs = []
-    for row in body:
-      job = Job(row)
-      jobs.append(job)
-    #
-    # Now we can think OOP:
-    #
-    if len(jobs) == 0:
-      print("no jobs...")
-      return
-
-    for job in jobs:
-      print(job.jobid)
-      print(" ", job.userid)
-      print(" ", job.status)
-      print(" ", job.originaldatafile)
-      print(" ", job.datafilekey)
-      print(" ", job.resultsfilekey)
-    #
-    return
+############################################################
+#
+# file_sha256
+#
+def file_sha256(filename):
+  """
+  Returns the SHA-256 hex digest of a file's contents.
+  """
+  digest = hashlib.sha256()
+  infile = open(filename, "rb")
+  for chunk in iter(lambda: infile.read(STREAM_CHUNK_SIZE), b""):
+    digest.update(chunk)
+  infile.close()
+  return digest.hexdigest()
 
-  except Exception as e:
-    logging.error("jobs() failed:")
-    logging.error("url: " + url)
-    logging.error(e)
-    return
+
+############################################################
+#
+# parse_jobids
+#
+def parse_jobids(s):
+  """
+  Returns the list of job ids described by s, which is either
+  a range ("1001-1050"), a comma-separated list, or the name
+  of an upload manifest written by bulk upload.
+  """
+  if pathlib.Path(s).is_file():
+    infile = open(s, "r")
+    manifest = json.load(infile)
+    infile.close()
+    return [str(u["jobid"]) for u in manifest["uploads"] if u["jobid"] is not None]
+
+  if "-" in s:
+    (first, last) = s.split("-")
+    return [str(jobid) for jobid in range(int(first), int(last) + 1)]
+
+  return [jobid.strip() for jobid in s.split(",") if jobid.strip() != ""]
+
+
+############################################################
+#
+# find_jpgs
+#
+def find_jpgs(pattern):
+  """
+  Returns the JPG filenames in a directory, or matching a glob
+  pattern, in sorted order.
+  """
+  if pathlib.Path(pattern).is_dir():
+    return sorted(glob.glob(os.path.join(pattern, "*.jpg")))
+  return sorted(glob.glob(pattern))
 
 
 ############################################################
 #
-# upload
+# batches
 #
-def upload(baseurl):
+def batches(items, size, max_bytes=None, nbytes=None):
   """
-  Prompts the user for a local filename and user id, 
-  and uploads that asset (PDF) to S3 for processing. 
+  Yields the items in lists of (at most) size. With max_bytes,
+  a list is also closed before its items' nbytes(item) would
+  add up to more than max_bytes; an item bigger than that on
+  its own gets a list to itself.
+  """
+  batch = []
+  total = 0
+  for item in items:
+    weight = nbytes(item) if max_bytes is not None else 0
+    if len(batch) > 0 and max_bytes is not None and total + weight > max_bytes:
+      yield batch
+      batch = []
+      total = 0
+    batch.append(item)
+    total += weight
+    if len(batch) == size:
+      yield batch
+      batch = []
+      total = 0
+  if len(batch) > 0:
+    yield batch
+
+
+############################################################
+#
+# encoded_size
+#
+def encoded_size(local_filename):
+  """
+  Returns how many bytes a file takes in an upload request:
+  its base64 encoding (0 if it can't be read; the upload will
+  report why).
+  """
+  try:
+    return 4 * -(-os.path.getsize(local_filename) // 3)
+  except OSError:
+    return 0
+
+
+############################################################
+#
+# read_baseurl
+#
+def read_baseurl(config_file):
+  """
+  Reads the base URL of the web service from a client config
+  file, and checks that it looks reasonable.
 
   Parameters
   ----------
-  baseurl: baseurl for web service
+  config_file: name of the config file
 
   Returns
   -------
-  nothing
+  the base URL, without a trailing /
   """
+  if not pathlib.Path(config_file).is_file():
+    raise Exception("config file '" + config_file + "' does not exist")
 
-  print("Enter JPG filename>")
-  local_filename = input()
+  configur = ConfigParser()
+  configur.read(config_file)
+  baseurl = configur.get('client', 'webservice')
 
-  if not pathlib.Path(local_filename).is_file():
-    print("JPG file '", local_filename, "' does not exist...")
-    return
+  if len(baseurl) < 16:
+    raise Exception("baseurl '" + baseurl + "' is not nearly long enough...")
 
-  print("Enter user id>")
-  userid = input()
+  if baseurl == "https://YOUR_GATEWAY_API.amazonaws.com":
+    raise Exception("update config.ini file with your gateway endpoint")
 
-  try:
-    #
-    # build the data packet:
-    #
+  #
+  # make sure baseurl does not end with /, if so remove:
+  #
+  if baseurl.endswith("/"):
+    baseurl = baseurl[:-1]
+
+  return baseurl
+
+
+############################################################
+#
+# ResponseCache
+#
+class ResponseCache:
+  """
+  Local cache of web service responses that carry an ETag.
+  It is content-addressed: each body is stored once, under a
+  hash of its ETag (which the server derives from the
+  contents), and an index maps each URL to the ETag it last
+  had. Files are written whole and renamed into place, so
+  concurrent requests (or clients) can share the cache. A body
+  is deleted when its URL gets a new ETag, and the cache is
+  pruned to max_bytes (least recently used bodies first) when
+  it is opened.
+  """
+
+  def __init__(self, dirname, max_bytes=DEFAULT_CACHE_MAX_BYTES):
+    self.dirname = dirname
+    self.max_bytes = max_bytes
+    os.makedirs(os.path.join(dirname, "bodies"), exist_ok=True)
+    os.makedirs(os.path.join(dirname, "urls"), exist_ok=True)
+    self.prune()
+
+  def path(self, kind, key):
+    return os.path.join(self.dirname, kind, hashlib.sha256(key.encode()).hexdigest())
+
+  def read(self, filename):
+    try:
+      infile = open(filename, "r")
+    except FileNotFoundError:
+      return None
+    text = infile.read()
+    infile.close()
+    return text
+
+  def write(self, filename, text):
+    tmp_filename = filename + "." + uuid.uuid4().hex + ".part"
+    outfile = open(tmp_filename, "w")
+    outfile.write(text)
+    outfile.close()
+    os.replace(tmp_filename, filename)
+
+  def lookup(self, url):
+    """
+    Returns (etag, body text) of the cached response for url,
+    or None.
+    """
+    etag = self.read(self.path("urls", url))
+    if etag is None:
+      return None
+    body = self.read(self.path("bodies", etag))
+    if body is None:
+      return None
+    self.touch(self.path("bodies", etag))
+    return (etag, body)
+
+  def store(self, url, etag, body):
+    previous = self.read(self.path("urls", url))
+    if not pathlib.Path(self.path("bodies", etag)).is_file():
+      self.write(self.path("bodies", etag), body)
+    self.write(self.path("urls", url), etag)
+
+    # the body the URL had before is superseded (should another
+    # URL share it, that URL just misses next time):
+    if previous is not None and previous != etag:
+      self.remove(self.path("bodies", previous))
+
+  def touch(self, filename):
+    try:
+      os.utime(filename)
+    except FileNotFoundError:
+      pass
+
+  def remove(self, filename):
+    try:
+      os.remove(filename)
+    except FileNotFoundError:
+      pass
+
+  def prune(self):
+    """
+    Deletes the least recently used bodies until the cache is
+    within max_bytes, and any URL whose body is gone. Returns
+    the number of bodies deleted.
+    """
+    bodies = []
+    for entry in os.scandir(os.path.join(self.dirname, "bodies")):
+      if entry.is_file():
+        stat = entry.stat()
+        bodies.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for (mtime, size, path) in bodies)
+    if total <= self.max_bytes:
+      return 0
+
+    bodies.sort()
+    deleted = 0
+    for (mtime, size, path) in bodies:
+      if total <= self.max_bytes:
+        break
+      self.remove(path)
+      total -= size
+      deleted += 1
+
+    for entry in os.scandir(os.path.join(self.dirname, "urls")):
+      etag = self.read(entry.path)
+      if etag is not None and not pathlib.Path(self.path("bodies", etag)).is_file():
+        self.remove(entry.path)
+
+    return deleted
+
+
+############################################################
+#
+# Client
+#
+class Client:
+  """
+  Client for the web service. Requests go through one
+  persistent requests.Session, whose connection pool keeps
+  up to "concurrency" connections alive, so repeated calls
+  (from one thread or several) reuse TCP/TLS connections.
+  Methods return results rather than printing them, and
+  raise ApiError when the service responds with an error.
+  With a ResponseCache, downloads and histogram matches the
+  client has fetched before are revalidated rather than sent
+  again.
+  """
+
+  def __init__(self, baseurl, concurrency=BULK_CONCURRENCY, cache=None):
+    if baseurl.endswith("/"):
+      baseurl = baseurl[:-1]
+    self.baseurl = baseurl
+    self.concurrency = concurrency
+    self.cache = cache
+    self.session = new_session(concurrency)
+
+  def request(self, method, api, ok=[200], idempotent=None, retry_statuses=None, **kwargs):
+    """
+    Sends a request to api, retried as request_with_retries
+    decides (by default, only GETs are retried on 5xx), and
+    returns the response; raises ApiError if its status code
+    isn't in ok.
+    """
+    url = self.baseurl + api
+    res = request_with_retries(self.session, method, url, idempotent=idempotent,
+                               retry_statuses=retry_statuses, **kwargs)
+    if res.status_code not in ok:
+      try:
+        body = res.json()
+      except ValueError:
+        body = res.text
+      raise ApiError(url, res.status_code, body)
+    return res
+
+  def cached_get(self, api, ok=[200], **kwargs):
+    """
+    GETs api, sending the ETag of the cached response (if
+    any) in If-None-Match, and answering from the cache when
+    the server says 304. Responses with an ETag that may be
+    cached are stored. Returns (status code, body).
+    """
+    url = self.baseurl + api
+    cached = self.cache.lookup(url) if self.cache is not None else None
+
+    if cached is None:
+      res = self.request("GET", api, ok=ok, **kwargs)
+    else:
+      res = self.request("GET", api, ok=ok + [304],
+                         headers={"If-None-Match": cached[0]}, **kwargs)
+      if res.status_code == 304:
+        return (200, json.loads(cached[1]))
+
+    etag = res.headers.get("ETag")
+    if self.cache is not None and etag is not None \
+       and "no-store" not in res.headers.get("Cache-Control", ""):
+      self.cache.store(url, etag, res.text)
+
+    return (res.status_code, res.json())
+
+  def users(self):
+    """
+    Returns all the users, as a list of User objects.
+    """
+    return [User(row) for row in self.request("GET", "/users").json()]
+
+  def jobs(self):
+    """
+    Returns all the jobs, as a list of Job objects.
+    """
+    return [Job(row) for row in self.request("GET", "/jobs").json()]
+
+  def upload(self, local_filename, userid):
+    """
+    Uploads a JPG for processing, and returns its job id.
+    """
     infile = open(local_filename, "rb")
     bytes = infile.read()
     infile.close()
 
     #
-    # now encode the pdf as base64. Note b64encode returns
+    # now encode the jpg as base64. Note b64encode returns
     # a bytes object, not a string. So then we have to convert
     # (decode) the bytes -> string, and then we can serialize
     # the string as JSON for upload to server:
     #
-    data = base64.b64encode(bytes)
-    datastr = data.decode()
-
-    data = {"filename": local_filename, "data": datastr}
-
-    #
-    # call the web service:
-    #
-    api = '/upload'
-    url = baseurl + api + "/" + userid
-
-    res = requests.post(url, json=data)
+    datastr = base64.b64encode(bytes).decode()
+    data = {"filename": pathlib.Path(local_filename).name, "data": datastr}
+
+    return self.request("POST", "/upload/" + str(userid), json=data).json()
+
+  def upload_batch(self, local_filenames, userid, presigned=False):
+    """
+    Uploads several JPGs with one request, and returns an entry
+    for each, in order: its filename and job id, and an "error"
+    if it failed. With presigned, the request carries only the
+    filenames, and each file is then PUT straight to S3 at the
+    URL the server returns for it.
+    """
+    files = []
+    for local_filename in local_filenames:
+      file = {"filename": pathlib.Path(local_filename).name}
+      if not presigned:
+        infile = open(local_filename, "rb")
+        file["data"] = base64.b64encode(infile.read()).decode()
+        infile.close()
+      files.append(file)
+
+    # each try creates jobs, so a 5xx isn't retried; a 400 with
+    # a list of entries means only some uploads failed:
+    res = self.request("POST", "/upload_batch/" + str(userid), ok=[200, 400],
+                       idempotent=False, json={"files": files})
+    entries = res.json()
+    if not isinstance(entries, list):
+      raise ApiError(self.baseurl + "/upload_batch/" + str(userid), res.status_code, entries)
+
+    if presigned:
+      for (local_filename, entry) in zip(local_filenames, entries):
+        if "url" not in entry:
+          continue
+
+        infile = open(local_filename, "rb")
+        bytes = infile.read()
+        infile.close()
+
+        # a PUT to the same key can safely be sent again:
+        put = request_with_retries(self.session, "PUT", entry["url"], idempotent=True,
+                                   data=bytes, headers=entry["headers"])
+        if put.status_code != 200:
+          entry["error"] = "S3 PUT failed with status " + str(put.status_code)
+
+    return entries
+
+  def download(self, jobid, wait=DOWNLOAD_WAIT_SECS):
+    """
+    Downloads the results of a job, asking the server to wait
+    up to "wait" seconds for a pending job to finish. Returns
+    (status code, body): 200 with all the results, or 202 if
+    the job is still pending, with whatever results are ready.
+    """
+    return self.cached_get("/download/" + str(jobid), ok=[200, 202],
+                           retry_statuses=LONG_POLL_RETRY_STATUSES,
+                           params={"wait": wait})
+
+  def hist_match(self, source, target):
+    """
+    Histogram-matches the source job's image to the target's,
+    and returns the body: {'data', 'source', 'target'}.
+    """
+    return self.cached_get("/hist_match/" + str(source) + "/" + str(target))[1]
+
+  def reset(self):
+    """
+    Resets the database back to initial state.
+    """
+    return self.request("DELETE", "/reset").json()
+
+  def stats(self):
+    """
+    Returns the latency percentiles of each pipeline stage.
+    """
+    return self.request("GET", "/stats").json()
+
+  def search(self, **filters):
+    """
+    Returns the images whose metadata matches all the filters
+    (taken_after, taken_before, min_width, make, ...).
+    """
+    return self.request("GET", "/search", params=filters).json()
+
+  def nearby(self, lat, lon, radius):
+    """
+    Returns the images taken within radius metres of a point.
+    """
+    return self.request("GET", "/nearby",
+                        params={"lat": lat, "lon": lon, "radius": radius}).json()
+
+  def upload_one(self, local_filename, userid):
+    """
+    Uploads one JPG for bulk_upload, returning a manifest entry
+    rather than raising: the file, its jobid (None on failure),
+    the error message (if any), the latency and the size.
+    """
+    start = time.time()
+    result = {"file": local_filename, "jobid": None, "error": None,
+              "latency": 0.0, "bytes": 0}
+
+    try:
+      result["bytes"] = os.path.getsize(local_filename)
+      result["jobid"] = self.upload(local_filename, userid)
+    except Exception as e:
+      result["error"] = str(e)
+
+    result["latency"] = time.time() - start
+    return result
+
+  def upload_batch_one(self, local_filenames, userid, presigned):
+    """
+    Uploads one batch of JPGs for bulk_upload, returning a
+    manifest entry for each (see upload_one) rather than
+    raising; the latency is that of the whole batch.
+    """
+    start = time.time()
+    results = [{"file": local_filename, "jobid": None, "error": None,
+                "latency": 0.0, "bytes": 0} for local_filename in local_filenames]
+
+    try:
+      for result in results:
+        result["bytes"] = os.path.getsize(result["file"])
+      entries = self.upload_batch(local_filenames, userid, presigned)
+      for (result, entry) in zip(results, entries):
+        result["jobid"] = entry["jobid"]
+        result["error"] = entry.get("error")
+    except Exception as e:
+      for result in results:
+        result["error"] = str(e)
+
+    for result in results:
+      result["latency"] = time.time() - start
+    return results
+
+  def bulk_upload(self, filenames, userid, callback=None, batch_size=1, presigned=False):
+    """
+    Uploads many JPGs concurrently. Only "concurrency" files
+    (or batches) are read (and held in memory) at a time, the
+    next starting as each one finishes. With a batch_size over
+    1, or presigned, files go batch_size at a time through
+    upload_batch, so each batch of jobs costs the server one
+    request and one INSERT; unless presigned, a batch is also
+    closed at MAX_BATCH_BYTES of file data. callback, if given,
+    is called with each manifest entry as it completes.
+
+    Returns
+    -------
+    list of manifest entries (see upload_one)
+    """
+    if batch_size > 1 or presigned:
+      units = batches(filenames, min(batch_size, MAX_BATCH_FILES),
+                      None if presigned else MAX_BATCH_BYTES, encoded_size)
+      upload = lambda batch: self.upload_batch_one(batch, userid, presigned)
+    else:
+      units = iter(filenames)
+      upload = lambda local_filename: [self.upload_one(local_filename, userid)]
+
+    results = []
+    pending = set()
+
+    with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+      while True:
+        while len(pending) < self.concurrency:
+          unit = next(units, None)
+          if unit is None:
+            break
+          pending.add(executor.submit(upload, unit))
+
+        if len(pending) == 0:
+          break
+
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+        for future in done:
+          for result in future.result():
+            results.append(result)
+            if callback is not None:
+              callback(result)
+
+    return results
+
+  def download_one(self, jobid, outdir, known=None, wait=DOWNLOAD_WAIT_SECS):
+    """
+    Downloads the results of one job into outdir, for
+    bulk_download. The compressed image is decoded to disk as
+    it streams in. If known (a previous manifest entry for
+    this job) names a file that is still there with the same
+    checksum, nothing is downloaded. The server waits up to
+    "wait" seconds for a pending job; if it is still pending
+    after that, the job is reported as pending.
+
+    Returns
+    -------
+    manifest entry for the job: the file, its checksum, whether
+    it was skipped or is still pending, the error (if any),
+    latency and size
+    """
+    start = time.time()
+    result = {"jobid": jobid, "file": None, "sha256": None, "skipped": False,
+              "pending": False, "error": None, "latency": 0.0, "bytes": 0}
+
+    try:
+      if known is not None and known.get("file") is not None \
+         and pathlib.Path(known["file"]).is_file() \
+         and file_sha256(known["file"]) == known["sha256"]:
+        result.update({"file": known["file"], "sha256": known["sha256"], "skipped": True})
+        return result
+
+      res = self.request("GET", "/download/" + jobid, ok=[200, 202],
+                         retry_statuses=LONG_POLL_RETRY_STATUSES,
+                         params={"wait": wait}, stream=True)
+
+      if res.status_code == 202:
+        res.close()
+        result["pending"] = True
+        return result
+
+      img_filename = os.path.join(outdir, jobid + "-compressed.jpg")
+      tmp_filename = img_filename + ".part"
+
+      outfile = open(tmp_filename, "wb")
+      (body, found) = stream_b64_field(res.iter_content(STREAM_CHUNK_SIZE), "img_str", outfile)
+      outfile.close()
+
+      if not found:
+        os.remove(tmp_filename)
+        result["error"] = "response has no image"
+        return result
+
+      os.replace(tmp_filename, img_filename)
+
+      for (field, suffix) in [("labels_str", "-labels.txt"), ("metadata_str", "-metadata.json")]:
+        if field in body:
+          data = base64.b64decode(body[field])
+          # older jobs' metadata isn't JSON:
+          if field == "metadata_str" and parse_metadata(data) is None:
+            suffix = "-metadata.txt"
+          outfile = open(os.path.join(outdir, jobid + suffix), "wb")
+          outfile.write(data)
+          outfile.close()
+
+      result["file"] = img_filename
+      result["sha256"] = file_sha256(img_filename)
+      result["bytes"] = os.path.getsize(img_filename)
+
+    except Exception as e:
+      result["error"] = str(e)
+
+    finally:
+      result["latency"] = time.time() - start
+
+    return result
+
+  def bulk_download(self, jobids, outdir, callback=None):
+    """
+    Downloads the results of many jobs concurrently into
+    outdir, skipping results already downloaded (according to
+    outdir/download-manifest.json and their checksums), and
+    updates the manifest. callback, if given, is called with
+    each manifest entry as it completes.
+
+    Returns
+    -------
+    list of manifest entries (see download_one)
+    """
+    os.makedirs(outdir, exist_ok=True)
+
+    manifest_filename = os.path.join(outdir, "download-manifest.json")
+    manifest = {}
+    if pathlib.Path(manifest_filename).is_file():
+      infile = open(manifest_filename, "r")
+      manifest = json.load(infile)
+      infile.close()
+
+    results = []
+
+    with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+      futures = [executor.submit(self.download_one, jobid, outdir, manifest.get(jobid))
+                 for jobid in jobids]
+
+      for future in futures:
+        result = future.result()
+        results.append(result)
+        if result["error"] is None and not result["skipped"] and not result["pending"]:
+          manifest[result["jobid"]] = {"file": result["file"], "sha256": result["sha256"]}
+        if callback is not None:
+          callback(result)
+
+    outfile = open(manifest_filename, "w")
+    json.dump(manifest, outfile, indent=2)
+    outfile.close()
 
-    #
-    # let's look at what we got back:
-    #
-    if res.status_code != 200:
-      # failed:
-      print("Failed with status code:", res.status_code)
-      print("url: " + url)
-      if res.status_code == 400:
-        # we'll have an error message
-        body = res.json()
-        print("Error message:", body)
-      #
-      return
+    return results
 
-    #
-    # success, extract jobid:
-    #
-    body = res.json()
 
-    jobid = body
-
-    print("JPG uploaded, job id =", jobid)
-    return
+############################################################
+#
+# parse_metadata
+#
+def parse_metadata(data):
+  """
+  Parses the metadata of a download, which is JSON, except for
+  jobs completed before it was (their metadata is text).
 
-  except Exception as e:
-    logging.error("upload() failed:")
-    logging.error("url: " + url)
-    logging.error(e)
-    return
+  Returns
+  -------
+  the parsed metadata, or None if it isn't JSON
+  """
+  try:
+    return json.loads(data.decode())
+  except ValueError:
+    return None
 
 
 ############################################################
 #
-# download
+# save_download
 #
-def download(baseurl):
+def save_download(status_code, body, outdir="."):
   """
-  Prompts the user for the job id, and downloads
-  that asset (PDF).
+  Saves the compressed image from a download response, and
+  decodes its labels and metadata.
 
   Parameters
   ----------
-  baseurl: baseurl for web service
+  status_code: 200 (completed) or 202 (pending),
+  body: the response body,
+  outdir: directory to save the image in
 
   Returns
   -------
-  nothing
+  dictionary with the job status, the image filename (None if
+  not available yet), labels, metadata and stages (if pending)
+  """
+  result = {"status": "completed" if status_code == 200 else "pending",
+            "image": None, "labels": None, "metadata": None,
+            "stages": body.get("stages")}
+
+  if "img_str" in body:
+    result["image"] = os.path.join(outdir, body["orig_name"][0:-4] + "-compressed.jpg")
+    outfile = open(result["image"], "wb")
+    outfile.write(base64.b64decode(body["img_str"]))
+    outfile.close()
+
+  if "labels_str" in body:
+    result["labels"] = base64.b64decode(body["labels_str"]).decode().splitlines()
+
+  if "metadata_str" in body:
+    data = base64.b64decode(body["metadata_str"])
+    metadata = parse_metadata(data)
+    result["metadata"] = metadata if metadata is not None else data.decode()
+
+  return result
+
+
+############################################################
+#
+# save_hist_match
+#
+def save_hist_match(body, outdir="."):
+  """
+  Saves the image from a histogram-match response, and
+  returns its filename.
   """
+  source = body["source"]
+  target = body["target"]
 
-  print("Enter job id>")
-  jobid = input()
+  #
+  # write the binary data to a file (as a
+  # binary file, not a text file):
+  #
+  filename = os.path.join(outdir, f"{source[0:-4]}-{target[0:-4]}.png")
+  outfile = open(filename, "wb")
+  outfile.write(base64.b64decode(body["data"]))
+  outfile.close()
 
-  try:
-    #
-    # call the web service:
-    #
-    api = '/download'
-    url = baseurl + api + '/' + jobid
+  return filename
 
-    res = requests.get(url)
 
-    #
-    # let's look at what we got back:
-    #
-    if res.status_code != 200:
-      # failed:
-      print("Failed with status code:", res.status_code)
-      print("url: " + url)
-      if res.status_code == 400:
-        # we'll have an error message
-        body = res.json()
-        print("Error message:", body)
-      #
-      return
+############################################################
+#
+# printing results
+#
+def print_api_error(e):
+  print("Failed with status code:", e.status_code)
+  print("url: " + e.url)
+  if e.status_code == 400:
+    # we'll have an error message
+    print("Error message:", e.body)
 
-    #
-    # deserialize and extract results:
-    #
-    body = res.json()
 
-    img_str = body["img_str"]
-    labels_str = body["labels_str"]
-    metadata_str = body["metadata_str"]
+def print_users(users):
+  if len(users) == 0:
+    print("no users...")
+    return
 
-    outfile = open(body["orig_name"][0:-4]+"-compressed.jpg", "wb")
-    decoded_data = base64.b64decode(img_str)
-    outfile.write(decoded_data)
-    outfile.close()
+  for user in users:
+    print(user.userid)
+    print(" ", user.username)
+    print(" ", user.pwdhash)
+
+
+def print_jobs(jobs):
+  if len(jobs) == 0:
+    print("no jobs...")
+    return
 
-    labels_base64_bytes = labels_str.encode()
-    labels_bytes = base64.b64decode(labels_base64_bytes)
-    labels_results = labels_bytes.decode()
+  for job in jobs:
+    print(job.jobid)
+    print(" ", job.userid)
+    print(" ", job.status)
+    print(" ", job.originaldatafile)
+    print(" ", job.datafilekey)
+    print(" ", job.resultsfilekey)
+
+
+def print_download(result):
+  if result["status"] == "pending":
+    print("Job still pending, stages done so far:")
+    for stage, info in result["stages"].items():
+      print(" ", stage, ":", info["status"], "(" + str(info["durationms"]) + " ms)")
+
+  if result["image"] is not None:
+    print("compressed image saved to", result["image"])
+
+  if result["labels"] is not None:
     print("\n**DETECTED IMAGE LABELS")
-    print(labels_results)
+    print("\n".join(result["labels"]))
     print()
 
-    metadata_base64_bytes = metadata_str.encode()
-    metadata_bytes = base64.b64decode(metadata_base64_bytes)
-    metadata_results = metadata_bytes.decode()
-    print(metadata_results)
+  if result["metadata"] is not None:
+    print("**IMAGE METADATA")
+    if isinstance(result["metadata"], str):
+      print(result["metadata"])
+    else:
+      print(json.dumps(result["metadata"], indent=2))
+
 
+def print_stats(stats):
+  if len(stats) == 0:
+    print("no completed stages...")
     return
 
-  except Exception as e:
-    logging.error("download() failed:")
-    logging.error("url: " + url)
-    logging.error(e)
+  for stage, values in stats.items():
+    print(stage)
+    for name, value in values.items():
+      print(" ", name, ":", value)
+
+
+def print_search(images):
+  if len(images) == 0:
+    print("no matching images...")
+    return
+
+  for image in images:
+    print(image["jobid"])
+    print(" ", str(image["width"]) + "x" + str(image["height"]))
+    print(" ", image["make"], image["model"])
+    print(" ", image["taken"])
+
+
+def print_nearby(images):
+  if len(images) == 0:
+    print("no images nearby...")
     return
 
+  for image in images:
+    print(image["jobid"])
+    print(" ", image["latitude"], image["longitude"])
+    print(" ", round(image["distance"]), "metres away")
+
+
+def print_upload_result(result):
+  if result["error"] is None:
+    print(result["file"], "=> job", result["jobid"],
+          "(" + str(round(result["latency"] * 1000)) + " ms)")
+  else:
+    print(result["file"], "FAILED:", result["error"])
+
+
+def print_download_result(result):
+  if result["error"] is not None:
+    print("job", result["jobid"], "FAILED:", result["error"])
+  elif result["skipped"]:
+    print("job", result["jobid"], "already downloaded, skipped")
+  elif result["pending"]:
+    print("job", result["jobid"], "still pending")
+  else:
+    print("job", result["jobid"], "=>", result["file"],
+          "(" + str(round(result["latency"] * 1000)) + " ms)")
+
+
+def upload_summary(results, elapsed):
+  succeeded = [r for r in results if r["error"] is None]
+  total_mb = sum(r["bytes"] for r in succeeded) / (1024 * 1024)
+  latencies = [r["latency"] * 1000 for r in succeeded]
+
+  return {
+    "files": len(results),
+    "uploaded": len(succeeded),
+    "secs": elapsed,
+    "files_per_sec": len(succeeded) / elapsed if elapsed > 0 else 0,
+    "mb_per_sec": total_mb / elapsed if elapsed > 0 else 0,
+    "p50_ms": percentile(latencies, 50),
+    "p95_ms": percentile(latencies, 95),
+    "p99_ms": percentile(latencies, 99)
+  }
+
+
+def print_upload_summary(summary):
+  print()
+  print(summary["uploaded"], "of", summary["files"], "files uploaded in",
+        round(summary["secs"], 2), "secs")
+  print(" ", round(summary["files_per_sec"], 2), "files/sec,",
+        round(summary["mb_per_sec"], 2), "MB/sec")
+  print("  latency p50:", round(summary["p50_ms"]), "ms, p95:",
+        round(summary["p95_ms"]), "ms, p99:", round(summary["p99_ms"]), "ms")
+
+
+def download_summary(results, elapsed):
+  downloaded = [r for r in results if r["error"] is None and not r["skipped"] and not r["pending"]]
+  skipped = [r for r in results if r["skipped"]]
+  pending = [r for r in results if r["pending"]]
+  total_mb = sum(r["bytes"] for r in downloaded) / (1024 * 1024)
+
+  return {
+    "jobs": len(results),
+    "downloaded": len(downloaded),
+    "skipped": len(skipped),
+    "pending": len(pending),
+    "failed": len(results) - len(downloaded) - len(skipped) - len(pending),
+    "secs": elapsed,
+    "mb_per_sec": total_mb / elapsed if elapsed > 0 else 0
+  }
+
+
+def print_download_summary(summary):
+  print()
+  print(summary["downloaded"], "downloaded,", summary["skipped"], "skipped,",
+        summary["pending"], "pending,", summary["failed"], "failed in", round(summary["secs"], 2), "secs")
+  print(" ", round(summary["mb_per_sec"], 2), "MB/sec")
+
 
 ############################################################
 #
-# reset
+# prompt
 #
-def reset(baseurl):
+def prompt():
   """
-  Resets the database back to initial state.
+  Prompts the user and returns the command number
 
   Parameters
   ----------
-  baseurl: baseurl for web service
+  None
 
   Returns
   -------
-  nothing
+  Command number entered by user (0, 1, 2, ...)
   """
+  print()
+  print(">> Enter a command:")
+  print("   0 => end")
+  print("   1 => users")
+  print("   2 => jobs")
+  print("   3 => upload")
+  print("   4 => download")
+  print("   5 => histogram match")
+  print("   6 => reset")
+  print("   7 => stage latency stats")
+  print("   8 => search metadata")
+  print("   9 => photos near a location")
+  print("  10 => bulk upload")
+  print("  11 => bulk download")
 
+  cmd = input()
+
+  if cmd == "":
+    cmd = -1
+  elif not cmd.isnumeric():
+    cmd = -1
+  else:
+    cmd = int(cmd)
+
+  return cmd
+
+
+############################################################
+#
+# interactive commands: each prompts for what it needs, calls
+# the web service through the client, and prints the results.
+#
+'''
+Basic User Flow:
+
+User uploads an image
+  This triggers compression, recognition, and metadata
+    compression - compresses the image and uploads it onto s3 bucket (original_name-compressed.jpg)
+    metadata - creates json file and uploads to s3 (original_name-metadata.json)
+    recognition - creates text file and uploads to s3 (original_name-labels.txt)
+  This also adds a new job in the jobs table
+User downloads image thru jobid
+  => compressed image is sent to client thru json
+  => labels are sent thru json
+  => meta data is sent thru json
+Client will download the image
+Console will also output the image's labels and metadata
+'''
+
+def interactive(name, func, *args):
+  """
+  Runs func(*args) for an interactive command, printing any
+  error rather than raising it.
+  """
   try:
-    #
-    # call the web service:
-    #
-    api = '/reset'
-    url = baseurl + api
+    return func(*args)
+  except ApiError as e:
+    print_api_error(e)
+  except Exception as e:
+    logging.error(name + "() failed:")
+    logging.error(e)
+  return None
 
-    res = requests.delete(url)
 
-    #
-    # let's look at what we got back:
-    #
-    if res.status_code != 200:
-      # failed:
-      print("Failed with status code:", res.status_code)
-      print("url: " + url)
-      if res.status_code == 400:
-        # we'll have an error message
-        body = res.json()
-        print("Error message:", body)
-      #
-      return
+def users(client):
+  """
+  Prints out all the users in the database
+  """
+  users = interactive("users", client.users)
+  if users is not None:
+    print_users(users)
 
-    #
-    # deserialize and print message
-    #
-    body = res.json()
 
-    msg = body
+def jobs(client):
+  """
+  Prints out all the jobs in the database
+  """
+  jobs = interactive("jobs", client.jobs)
+  if jobs is not None:
+    print_jobs(jobs)
 
-    print(msg)
-    return
 
-  except Exception as e:
-    logging.error("reset() failed:")
-    logging.error("url: " + url)
-    logging.error(e)
+def upload(client):
+  """
+  Prompts the user for a local filename and user id,
+  and uploads that image to S3 for processing.
+  """
+  print("Enter JPG filename>")
+  local_filename = input()
+
+  if not pathlib.Path(local_filename).is_file():
+    print("JPG file '", local_filename, "' does not exist...")
     return
 
+  print("Enter user id>")
+  userid = input()
 
-def hist_match(baseurl):
-  try:
+  jobid = interactive("upload", client.upload, local_filename, userid)
+  if jobid is not None:
+    print("JPG uploaded, job id =", jobid)
 
-    print("Enter source job id>")
-    key1 = input()
-    print("Enter target job id>")
-    key2 = input()
-    
-    api = '/hist_match'
-    url = baseurl + api + "/" + key1 + "/" + key2
-    res = requests.get(url)
-    body = res.json()
-    if res.status_code != 200:
-      print(f"error code: {res.status_code}")
-      print(f"error message: {body['message']}")
-      return
-
-    bytes = base64.b64decode(body["data"])
-    source = body["source"]
-    target = body["target"]
 
-    #
-    # write the binary data to a file (as a
-    # binary file, not a text file):
-    #
-    outfile = open(f"./{source[0:-4]}-{target[0:-4]}.png", "wb")
-    outfile.write(bytes)
-    outfile.close()
+def download(client):
+  """
+  Prompts the user for the job id, and downloads the results
+  of that job (or whatever is ready, if it's still pending).
+  """
+  print("Enter job id>")
+  jobid = input()
+
+  #
+  # the server holds the request until the job is done (or
+  # its wait limit is reached), rather than us polling:
+  #
+  response = interactive("download", client.download, jobid)
+  if response is not None:
+    (status_code, body) = response
+    print_download(save_download(status_code, body))
 
-    print(f"Process finish, download to ./{source}-{target}.png")
 
+def hist_match(client):
+  """
+  Prompts the user for a source and target job id, and saves
+  the histogram-matched result.
+  """
+  print("Enter source job id>")
+  key1 = input()
+  print("Enter target job id>")
+  key2 = input()
+
+  try:
+    body = client.hist_match(key1, key2)
+  except ApiError as e:
+    print(f"error code: {e.status_code}")
+    print(f"error message: {e.body['message'] if isinstance(e.body, dict) else e.body}")
+    return
   except Exception as e:
     logging.error("hist_match() failed:")
-    logging.error("url: " + url)
     logging.error(e)
     return
 
+  filename = save_hist_match(body)
+  print(f"Process finish, download to {filename}")
+
+
+def reset(client):
+  """
+  Resets the database back to initial state.
+  """
+  msg = interactive("reset", client.reset)
+  if msg is not None:
+    print(msg)
+
+
+def stats(client):
+  """
+  Prints out the latency percentiles of each pipeline stage.
+  """
+  stats = interactive("stats", client.stats)
+  if stats is not None:
+    print_stats(stats)
+
+
+def search(client):
+  """
+  Prompts the user for metadata filters, and prints out the
+  images whose metadata matches all of them.
+  """
+  filters = {}
+  for (name, text) in [("taken_after", "Taken after (YYYY-MM-DD, or ENTER to skip)>"),
+                       ("taken_before", "Taken before (YYYY-MM-DD, or ENTER to skip)>"),
+                       ("min_width", "Minimum width in pixels (or ENTER to skip)>"),
+                       ("make", "Camera make (or ENTER to skip)>")]:
+    print(text)
+    value = input()
+    if value != "":
+      filters[name] = value
+
+  images = interactive("search", client.search, **filters)
+  if images is not None:
+    print_search(images)
+
+
+def nearby(client):
+  """
+  Prompts the user for a location and radius, and prints out
+  the images taken within that radius, nearest first.
+  """
+  print("Enter latitude>")
+  lat = input()
+  print("Enter longitude>")
+  lon = input()
+  print("Enter radius in metres>")
+  radius = input()
+
+  images = interactive("nearby", client.nearby, lat, lon, radius)
+  if images is not None:
+    print_nearby(images)
+
+
+def read_concurrency():
+  print("Number of concurrent transfers (ENTER for " + str(BULK_CONCURRENCY) + ")>")
+  s = input()
+  return int(s) if s.isnumeric() and int(s) > 0 else BULK_CONCURRENCY
+
+
+def bulk_upload(client):
+  """
+  Prompts for a directory (or glob pattern) of JPGs and a user
+  id, uploads all of those files concurrently, and writes a
+  manifest of the job ids.
+  """
+  print("Enter directory or glob pattern of JPGs>")
+  pattern = input()
+
+  filenames = find_jpgs(pattern)
+  if len(filenames) == 0:
+    print("no JPG files match '", pattern, "'...")
+    return
+
+  print("Enter user id>")
+  userid = input()
+
+  bulk_client = Client(client.baseurl, read_concurrency(), client.cache)
+
+  print("Manifest filename (ENTER for upload-manifest.json)>")
+  manifest_filename = input()
+  if manifest_filename == "":
+    manifest_filename = "upload-manifest.json"
+
+  start = time.time()
+  results = interactive("bulk_upload", bulk_client.bulk_upload,
+                        filenames, userid, print_upload_result)
+  if results is None:
+    return
+
+  outfile = open(manifest_filename, "w")
+  json.dump({"userid": userid, "uploads": results}, outfile, indent=2)
+  outfile.close()
+
+  print_upload_summary(upload_summary(results, time.time() - start))
+  print("  manifest written to", manifest_filename)
+
+
+def bulk_download(client):
+  """
+  Prompts for a range or manifest of job ids, and downloads
+  the results of all of those jobs concurrently, skipping
+  results already downloaded.
+  """
+  print("Enter job id range (e.g. 1001-1050), list, or upload manifest>")
+  jobids = parse_jobids(input())
+
+  if len(jobids) == 0:
+    print("no job ids...")
+    return
+
+  print("Enter output directory (ENTER for current directory)>")
+  outdir = input()
+  if outdir == "":
+    outdir = "."
+
+  bulk_client = Client(client.baseurl, read_concurrency(), client.cache)
+
+  start = time.time()
+  results = interactive("bulk_download", bulk_client.bulk_download,
+                        jobids, outdir, print_download_result)
+  if results is not None:
+    print_download_summary(download_summary(results, time.time() - start))
+
 
 ############################################################
-# main
 #
-try:
+# menu
+#
+def menu():
+  """
+  Runs the interactive, menu-driven client.
+  """
   print('** Final Project Application **')
   print()
 
@@ -525,46 +1507,37 @@ try:
   #
   # what config file should we use for this session?
   #
-  config_file = 'finalproj-client-config.ini'
+  config_file = DEFAULT_CONFIG_FILE
 
   print("Config file to use for this session?")
   print("Press ENTER to use default, or")
   print("enter config file name>")
   s = input()
 
-  if s == "":  # use default
-    pass  # already set
-  else:
+  if s != "":
     config_file = s
 
-  #
-  # does config file exist?
-  #
-  if not pathlib.Path(config_file).is_file():
-    print("**ERROR: config file '", config_file, "' does not exist, exiting")
-    sys.exit(0)
-
-  #
-  # setup base URL to web service:
-  #
-  configur = ConfigParser()
-  configur.read(config_file)
-  baseurl = configur.get('client', 'webservice')
-
-  #
-  # make sure baseurl does not end with /, if so remove:
-  #
-  if len(baseurl) < 16:
-    print("**ERROR: baseurl '", baseurl, "' is not nearly long enough...")
-    sys.exit(0)
-
-  if baseurl == "https://YOUR_GATEWAY_API.amazonaws.com":
-    print("**ERROR: update config.ini file with your gateway endpoint")
-    sys.exit(0)
-
-  lastchar = baseurl[len(baseurl) - 1]
-  if lastchar == "/":
-    baseurl = baseurl[:-1]
+  try:
+    baseurl = read_baseurl(config_file)
+  except Exception as e:
+    print("**ERROR:", str(e) + ", exiting")
+    return 0
+
+  client = Client(baseurl, cache=ResponseCache(DEFAULT_CACHE_DIR))
+
+  commands = {
+    1: users,
+    2: jobs,
+    3: upload,
+    4: download,
+    5: hist_match,
+    6: reset,
+    7: stats,
+    8: search,
+    9: nearby,
+    10: bulk_upload,
+    11: bulk_download
+  }
 
   #
   # main processing loop:
@@ -572,22 +1545,10 @@ try:
   cmd = prompt()
 
   while cmd != 0:
-    #
-    if cmd == 1:
-      users(baseurl)
-    elif cmd == 2:
-      jobs(baseurl)
-    elif cmd == 3:
-      upload(baseurl)
-    elif cmd == 4:
-      download(baseurl)
-    elif cmd == 5:
-      hist_match(baseurl)
-    elif cmd == 6:
-      reset(baseurl)
+    if cmd in commands:
+      commands[cmd](client)
     else:
       print("** Unknown command, try again...")
-    #
     cmd = prompt()
 
   #
@@ -595,9 +1556,281 @@ try:
   #
   print()
   print('** done **')
-  sys.exit(0)
+  return 0
+
+
+############################################################
+#
+# command-line interface: each command runs against the
+# client and returns a JSON-serializable result, printed as
+# JSON with --json or as text otherwise.
+#
+def cmd_users(client, args):
+  return [vars(user) for user in client.users()]
+
+
+def cmd_jobs(client, args):
+  return [vars(job) for job in client.jobs()]
+
+
+def cmd_upload(client, args):
+  return {"file": args.filename, "jobid": client.upload(args.filename, args.userid)}
+
+
+def cmd_download(client, args):
+  (status_code, body) = client.download(args.jobid, args.wait)
+  return save_download(status_code, body, args.outdir)
+
+
+def cmd_hist_match(client, args):
+  return {"file": save_hist_match(client.hist_match(args.source, args.target), args.outdir)}
+
+
+def cmd_reset(client, args):
+  return client.reset()
+
+
+def cmd_stats(client, args):
+  return client.stats()
+
+
+def cmd_search(client, args):
+  filters = {}
+  for name in ["taken_after", "taken_before", "min_width", "max_width",
+               "min_height", "max_height", "make", "model"]:
+    if getattr(args, name) is not None:
+      filters[name] = getattr(args, name)
+  return client.search(**filters)
+
+
+def cmd_nearby(client, args):
+  return client.nearby(args.lat, args.lon, args.radius)
+
+
+def cmd_bulk_upload(client, args):
+  filenames = find_jpgs(args.pattern)
+  callback = None if args.json else print_upload_result
+
+  start = time.time()
+  results = client.bulk_upload(filenames, args.userid, callback,
+                               args.batch_size, args.presigned)
+  elapsed = time.time() - start
+
+  outfile = open(args.manifest, "w")
+  json.dump({"userid": args.userid, "uploads": results}, outfile, indent=2)
+  outfile.close()
+
+  return {"summary": upload_summary(results, elapsed), "manifest": args.manifest}
+
+
+def cmd_bulk_download(client, args):
+  callback = None if args.json else print_download_result
+
+  start = time.time()
+  results = client.bulk_download(parse_jobids(args.jobids), args.outdir, callback)
+
+  return {"summary": download_summary(results, time.time() - start)}
+
+
+#
+# how to print each command's result as text:
+#
+TEXT_PRINTERS = {
+  "users": lambda result: print_users([User(list(u.values())) for u in result]),
+  "jobs": lambda result: print_jobs([Job(list(j.values())) for j in result]),
+  "upload": lambda result: print("JPG uploaded, job id =", result["jobid"]),
+  "download": print_download,
+  "hist-match": lambda result: print("Process finish, download to", result["file"]),
+  "reset": print,
+  "stats": print_stats,
+  "search": print_search,
+  "nearby": print_nearby,
+  "bulk-upload": lambda result: (print_upload_summary(result["summary"]),
+                                 print("  manifest written to", result["manifest"])),
+  "bulk-download": lambda result: print_download_summary(result["summary"])
+}
+
+
+############################################################
+#
+# build_parser
+#
+def build_parser():
+  parser = argparse.ArgumentParser(
+    description="Client for the final project image-processing web service. "
+                "With no command, runs the interactive menu.")
+
+  parser.add_argument("--config", default=DEFAULT_CONFIG_FILE,
+                      help="client config file (default: %(default)s)")
+  parser.add_argument("--json", action="store_true",
+                      help="print results as JSON")
+  parser.add_argument("--repeat", type=int, default=1,
+                      help="run the command this many times, and report latencies")
+  parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR,
+                      help="where to cache completed results (default: %(default)s)")
+  parser.add_argument("--no-cache", action="store_true",
+                      help="don't cache results, or use cached ones")
+  parser.add_argument("--concurrency", type=int, default=1,
+                      help="with --repeat, how many runs to have in flight; for "
+                           "bulk commands, how many transfers (default: 1, or "
+                           + str(BULK_CONCURRENCY) + " for bulk commands)")
+
+  commands = parser.add_subparsers(dest="command", metavar="command")
+
+  commands.add_parser("users", help="list users").set_defaults(func=cmd_users)
+  commands.add_parser("jobs", help="list jobs").set_defaults(func=cmd_jobs)
+
+  p = commands.add_parser("upload", help="upload a JPG for processing")
+  p.add_argument("filename")
+  p.add_argument("userid")
+  p.set_defaults(func=cmd_upload)
+
+  p = commands.add_parser("download", help="download the results of a job")
+  p.add_argument("jobid")
+  p.add_argument("--wait", type=float, default=DOWNLOAD_WAIT_SECS,
+                 help="secs the server may wait for a pending job (default: %(default)s)")
+  p.add_argument("--outdir", default=".")
+  p.set_defaults(func=cmd_download)
+
+  p = commands.add_parser("hist-match", help="histogram-match one job's image to another's")
+  p.add_argument("source")
+  p.add_argument("target")
+  p.add_argument("--outdir", default=".")
+  p.set_defaults(func=cmd_hist_match)
+
+  commands.add_parser("reset", help="reset the database").set_defaults(func=cmd_reset)
+  commands.add_parser("stats", help="per-stage latency percentiles").set_defaults(func=cmd_stats)
+
+  p = commands.add_parser("search", help="search image metadata")
+  p.add_argument("--taken-after", dest="taken_after")
+  p.add_argument("--taken-before", dest="taken_before")
+  p.add_argument("--min-width", dest="min_width", type=int)
+  p.add_argument("--max-width", dest="max_width", type=int)
+  p.add_argument("--min-height", dest="min_height", type=int)
+  p.add_argument("--max-height", dest="max_height", type=int)
+  p.add_argument("--make")
+  p.add_argument("--model")
+  p.set_defaults(func=cmd_search)
+
+  p = commands.add_parser("nearby", help="images taken near a location")
+  p.add_argument("lat", type=float)
+  p.add_argument("lon", type=float)
+  p.add_argument("radius", type=float, help="metres")
+  p.set_defaults(func=cmd_nearby)
+
+  p = commands.add_parser("bulk-upload", help="upload a directory or glob of JPGs")
+  p.add_argument("pattern")
+  p.add_argument("userid")
+  p.add_argument("--manifest", default="upload-manifest.json")
+  p.add_argument("--batch-size", dest="batch_size", type=int, default=1,
+                 help="files per request, up to " + str(MAX_BATCH_FILES) + " (default: %(default)s)")
+  p.add_argument("--presigned", action="store_true",
+                 help="PUT the files straight to S3 at presigned URLs")
+  p.set_defaults(func=cmd_bulk_upload)
+
+  p = commands.add_parser("bulk-download", help="download the results of many jobs")
+  p.add_argument("jobids", help="range (1001-1050), list, or upload manifest")
+  p.add_argument("--outdir", default=".")
+  p.set_defaults(func=cmd_bulk_download)
+
+  return parser
+
+
+############################################################
+#
+# run_repeated
+#
+def run_repeated(client, args):
+  """
+  Runs a command args.repeat times, args.concurrency at a time,
+  and returns a latency summary; a quick load test.
+  """
+  def timed_run(i):
+    start = time.time()
+    try:
+      args.func(client, args)
+      return (time.time() - start, None)
+    except Exception as e:
+      return (time.time() - start, str(e))
+
+  start = time.time()
+  with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+    runs = list(executor.map(timed_run, range(args.repeat)))
+  elapsed = time.time() - start
+
+  latencies = [latency * 1000 for (latency, error) in runs if error is None]
+  errors = [error for (latency, error) in runs if error is not None]
+
+  return {
+    "command": args.command,
+    "runs": len(runs),
+    "errors": len(errors),
+    "first_error": errors[0] if len(errors) > 0 else None,
+    "concurrency": args.concurrency,
+    "secs": elapsed,
+    "runs_per_sec": len(runs) / elapsed if elapsed > 0 else 0,
+    "p50_ms": percentile(latencies, 50),
+    "p95_ms": percentile(latencies, 95),
+    "p99_ms": percentile(latencies, 99),
+    "max_ms": max(latencies) if len(latencies) > 0 else 0
+  }
+
+
+############################################################
+#
+# main
+#
+def main(argv):
+  """
+  Runs the command-line interface (or the interactive menu if
+  no command is given), and returns the exit status.
+  """
+  parser = build_parser()
+  args = parser.parse_args(argv)
+
+  if args.command is None:
+    return menu()
+
+  try:
+    baseurl = read_baseurl(args.config)
+
+    concurrency = args.concurrency
+    if args.command in ["bulk-upload", "bulk-download"] and args.concurrency == 1:
+      concurrency = BULK_CONCURRENCY
+
+    cache = None if args.no_cache else ResponseCache(args.cache_dir)
+
+    client = Client(baseurl, max(concurrency, 1), cache)
+
+    if args.repeat > 1:
+      summary = run_repeated(client, args)
+      if args.json:
+        print(json.dumps(summary))
+      else:
+        for name, value in summary.items():
+          print(f"{name:15}: {round(value, 2) if isinstance(value, float) else value}")
+      return 0 if summary["errors"] == 0 else 1
+
+    result = args.func(client, args)
+
+    if args.json:
+      print(json.dumps(result))
+    else:
+      TEXT_PRINTERS[args.command](result)
+    return 0
+
+  except ApiError as e:
+    if args.json:
+      print(json.dumps({"error": e.status_code, "url": e.url, "body": e.body}))
+    else:
+      print_api_error(e)
+    return 1
+
+  except Exception as e:
+    logging.error("**ERROR: " + args.command + " failed:")
+    logging.error(e)
+    return 1
+
 
-except Exception as e:
-  logging.error("**ERROR: main() failed:")
-  logging.error(e)
-  sys.exit(0)
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,420 @@
+#
+# metastore.py
+#
+# Structured storage of image metadata. The full metadata of an
+# image is serialized as canonical JSON (for the -metadata.json
+# results file), and its searchable fields are indexed into the
+# image_metadata table so clients can query across images
+# without downloading per-job results files. Images with a GPS
+# position are also indexed spatially, in image_locations.
+#
+
+import json
+import math
+import base64
+import datetime
+import datatier
+
+
+#
+# the filters search_metadata understands, and the SQL condition
+# each one adds:
+#
+SEARCH_FILTERS = {
+  'taken_after': "taken >= %s",
+  'taken_before': "taken <= %s",
+  'min_width': "width >= %s",
+  'max_width': "width <= %s",
+  'min_height': "height >= %s",
+  'max_height': "height <= %s",
+  'make': "make = %s",
+  'model': "model = %s",
+  'orientation': "orientation = %s"
+}
+
+SEARCH_LIMIT = 1000
+
+#
+# metres per degree of latitude (and of longitude at the
+# equator), for turning a radius into a bounding box:
+#
+METRES_PER_DEGREE = 111320.0
+
+#
+# locations are stored as SRID 4326 (WGS 84) points; we always
+# write them longitude first:
+#
+POINT_SQL = "ST_GeomFromText(%s, 4326, 'axis-order=long-lat')"
+
+
+###################################################################
+#
+# to_json_value:
+#
+# Converts a metadata value into something JSON can represent:
+# EXIF rationals become floats, raw bytes become base64 strings,
+# tuples become lists, and anything else unknown becomes a string.
+#
+def to_json_value(value):
+  if value is None or isinstance(value, (bool, int, str)):
+    return value
+
+  if isinstance(value, float):
+    return value if math.isfinite(value) else None
+
+  if isinstance(value, bytes):
+    return base64.b64encode(value).decode()
+
+  if isinstance(value, dict):
+    return {str(key): to_json_value(item) for key, item in value.items()}
+
+  if isinstance(value, (list, tuple)):
+    return [to_json_value(item) for item in value]
+
+  # PIL's IFDRational, and other number-like values:
+  try:
+    return to_json_value(float(value))
+  except (TypeError, ValueError, ZeroDivisionError):
+    return str(value)
+
+
+###################################################################
+#
+# canonical_json:
+#
+# Serializes metadata as canonical JSON: sorted keys and no
+# insignificant whitespace, so identical metadata always yields
+# identical bytes.
+#
+def canonical_json(metadata):
+  return json.dumps(to_json_value(metadata), sort_keys=True, separators=(",", ":"))
+
+
+###################################################################
+#
+# parse_exif_datetime:
+#
+# EXIF dates look like "2023:07:14 18:02:51"; returns a datetime,
+# or None if the value is missing or malformed.
+#
+def parse_exif_datetime(value):
+  if not isinstance(value, str):
+    return None
+
+  try:
+    return datetime.datetime.strptime(value.strip("\x00 ")[0:19], "%Y:%m:%d %H:%M:%S")
+  except ValueError:
+    return None
+
+
+###################################################################
+#
+# clean_text:
+#
+def clean_text(value, maxlen=64):
+  if not isinstance(value, str):
+    return None
+
+  value = value.strip("\x00 ")
+  return value[0:maxlen] if value != "" else None
+
+
+###################################################################
+#
+# index_fields:
+#
+# Picks the searchable fields out of an image's metadata (as
+# built by imaging.header_metadata).
+#
+def index_fields(metadata):
+  taken = parse_exif_datetime(metadata.get("DateTimeOriginal"))
+  if taken is None:
+    taken = parse_exif_datetime(metadata.get("DateTime"))
+
+  orientation = metadata.get("Orientation")
+
+  return {
+    'width': metadata.get("Image Width"),
+    'height': metadata.get("Image Height"),
+    'make': clean_text(metadata.get("Make")),
+    'model': clean_text(metadata.get("Model")),
+    'taken': taken,
+    'orientation': orientation if isinstance(orientation, int) else None
+  }
+
+
+###################################################################
+#
+# index_metadata:
+#
+# Indexes the searchable fields of an image's metadata into the
+# image_metadata table, for the job that owns the given
+# datafilekey. Re-indexing an image replaces its row.
+#
+def index_metadata(dbConn, datafilekey, metadata):
+  """
+  Indexes an image's metadata for searching
+
+  Parameters
+  ----------
+  dbConn : the database connection,
+  datafilekey : bucket key of the job's uploaded image (string),
+  metadata : the image's metadata (dictionary)
+
+  Returns
+  -------
+  number of rows modified
+  """
+  fields = index_fields(metadata)
+
+  sql = """
+    INSERT INTO image_metadata(jobid, width, height, make, model, taken, orientation)
+           SELECT jobid, %s, %s, %s, %s, %s, %s
+           FROM jobs
+           WHERE datafilekey = %s
+    ON DUPLICATE KEY UPDATE width = VALUES(width),
+                            height = VALUES(height),
+                            make = VALUES(make),
+                            model = VALUES(model),
+                            taken = VALUES(taken),
+                            orientation = VALUES(orientation);
+  """
+
+  return datatier.perform_action(dbConn, sql, [fields['width'], fields['height'],
+                                               fields['make'], fields['model'],
+                                               fields['taken'], fields['orientation'],
+                                               datafilekey])
+
+
+###################################################################
+#
+# search_metadata:
+#
+# Finds the images whose indexed metadata matches all of the
+# given filters (see SEARCH_FILTERS), e.g.
+#
+#   {'taken_after': '2023-01-01', 'min_width': 4000}
+#
+def search_metadata(dbConn, filters):
+  """
+  Searches the indexed image metadata
+
+  Parameters
+  ----------
+  dbConn : the database connection,
+  filters : dictionary of filter name -> value
+
+  Returns
+  -------
+  list of dictionaries, one per matching image, ordered by the
+  time the photo was taken (at most SEARCH_LIMIT)
+  """
+  conditions = []
+  parameters = []
+
+  for name, value in filters.items():
+    if name not in SEARCH_FILTERS:
+      raise Exception("unknown search filter '" + name + "'")
+    conditions.append(SEARCH_FILTERS[name])
+    parameters.append(value)
+
+  sql = """
+    SELECT jobid, width, height, make, model, taken, orientation
+    FROM image_metadata
+  """
+  if len(conditions) > 0:
+    sql += " WHERE " + " AND ".join(conditions)
+  sql += " ORDER BY taken, jobid LIMIT " + str(SEARCH_LIMIT) + ";"
+
+  rows = datatier.retrieve_all_rows(dbConn, sql, parameters)
+
+  results = []
+  for row in rows:
+    results.append({
+      'jobid': row[0],
+      'width': row[1],
+      'height': row[2],
+      'make': row[3],
+      'model': row[4],
+      'taken': row[5].isoformat() if row[5] is not None else None,
+      'orientation': row[6]
+    })
+
+  return results
+
+
+###################################################################
+#
+# wkt_point, wkt_box:
+#
+# Well-known-text geometries, longitude first.
+#
+def wkt_point(latitude, longitude):
+  return "POINT(" + repr(float(longitude)) + " " + repr(float(latitude)) + ")"
+
+
+def wkt_box(min_lat, min_lon, max_lat, max_lon):
+  corners = [(min_lon, min_lat), (max_lon, min_lat), (max_lon, max_lat),
+             (min_lon, max_lat), (min_lon, min_lat)]
+  return "POLYGON((" + ", ".join(repr(float(lon)) + " " + repr(float(lat))
+                                 for (lon, lat) in corners) + "))"
+
+
+###################################################################
+#
+# index_location:
+#
+# Indexes the GPS position of an image into the image_locations
+# table (which has a spatial index), for the job that owns the
+# given datafilekey. Images without a position are not indexed.
+#
+def index_location(dbConn, datafilekey, metadata):
+  """
+  Indexes an image's GPS position for spatial queries
+
+  Parameters
+  ----------
+  dbConn : the database connection,
+  datafilekey : bucket key of the job's uploaded image (string),
+  metadata : the image's metadata (dictionary)
+
+  Returns
+  -------
+  number of rows modified (0 if the image has no position)
+  """
+  latitude = metadata.get("Latitude")
+  longitude = metadata.get("Longitude")
+
+  if latitude is None or longitude is None:
+    return 0
+
+  sql = """
+    INSERT INTO image_locations(jobid, latitude, longitude, location)
+           SELECT jobid, %s, %s, """ + POINT_SQL + """
+           FROM jobs
+           WHERE datafilekey = %s
+    ON DUPLICATE KEY UPDATE latitude = VALUES(latitude),
+                            longitude = VALUES(longitude),
+                            location = VALUES(location);
+  """
+
+  return datatier.perform_action(dbConn, sql, [latitude, longitude,
+                                               wkt_point(latitude, longitude),
+                                               datafilekey])
+
+
+###################################################################
+#
+# search_bbox:
+#
+# Finds the images positioned inside a latitude/longitude box,
+# using the spatial index.
+#
+def search_bbox(dbConn, min_lat, min_lon, max_lat, max_lon):
+  """
+  Finds the images inside a bounding box
+
+  Parameters
+  ----------
+  dbConn : the database connection,
+  min_lat, min_lon, max_lat, max_lon : the box, in degrees
+
+  Returns
+  -------
+  list of {'jobid', 'latitude', 'longitude'} dictionaries (at
+  most SEARCH_LIMIT)
+  """
+  sql = """
+    SELECT jobid, latitude, longitude
+    FROM image_locations
+    WHERE MBRContains(""" + POINT_SQL + """, location)
+    ORDER BY jobid
+    LIMIT """ + str(SEARCH_LIMIT) + ";"
+
+  rows = datatier.retrieve_all_rows(dbConn, sql, [wkt_box(min_lat, min_lon, max_lat, max_lon)])
+
+  return [{'jobid': row[0], 'latitude': row[1], 'longitude': row[2]} for row in rows]
+
+
+###################################################################
+#
+# lon_ranges:
+#
+# The longitudes of a box from min_lon to max_lon, as ranges
+# within [-180, 180]: a box that crosses the antimeridian is
+# split in two, one range each side of it, and one that goes all
+# the way round is two halves (a single box from -180 to 180 has
+# no width on the sphere).
+#
+def lon_ranges(min_lon, max_lon):
+  if max_lon - min_lon >= 360.0:
+    return [(-180.0, 0.0), (0.0, 180.0)]
+  if min_lon < -180.0:
+    return [(min_lon + 360.0, 180.0), (-180.0, max_lon)]
+  if max_lon > 180.0:
+    return [(min_lon, 180.0), (-180.0, max_lon - 360.0)]
+  return [(min_lon, max_lon)]
+
+
+###################################################################
+#
+# search_radius:
+#
+# Finds the images within radius metres of a point, nearest
+# first. The spatial index narrows the search to the bounding
+# box of the circle (two boxes, if it crosses the antimeridian),
+# and the exact distance is checked on what remains.
+#
+def search_radius(dbConn, latitude, longitude, radius):
+  """
+  Finds the images within a radius of a point
+
+  Parameters
+  ----------
+  dbConn : the database connection,
+  latitude, longitude : the centre, in degrees,
+  radius : the radius, in metres
+
+  Returns
+  -------
+  list of {'jobid', 'latitude', 'longitude', 'distance'}
+  dictionaries (distance in metres), nearest first (at most
+  SEARCH_LIMIT)
+  """
+  dlat = radius / METRES_PER_DEGREE
+  dlon = radius / (METRES_PER_DEGREE * max(math.cos(math.radians(latitude)), 0.01))
+
+  min_lat = max(latitude - dlat, -90.0)
+  max_lat = min(latitude + dlat, 90.0)
+
+  # a circle around a pole takes in every longitude:
+  if latitude + dlat >= 90.0 or latitude - dlat <= -90.0:
+    dlon = 180.0
+
+  boxes = [wkt_box(min_lat, min_lon, max_lat, max_lon)
+           for (min_lon, max_lon) in lon_ranges(longitude - dlon, longitude + dlon)]
+
+  # a point on the edge between two boxes is in both, hence
+  # UNION rather than UNION ALL:
+  candidates = "\n      UNION".join(["""
+      SELECT jobid, latitude, longitude,
+             ST_Distance_Sphere(location, """ + POINT_SQL + """) AS distance
+      FROM image_locations
+      WHERE MBRContains(""" + POINT_SQL + """, location)"""] * len(boxes))
+
+  sql = """
+    SELECT jobid, latitude, longitude, distance
+    FROM (""" + candidates + """
+    ) AS candidates
+    WHERE distance <= %s
+    ORDER BY distance
+    LIMIT """ + str(SEARCH_LIMIT) + ";"
+
+  parameters = []
+  for box in boxes:
+    parameters += [wkt_point(latitude, longitude), box]
+
+  rows = datatier.retrieve_all_rows(dbConn, sql, parameters + [radius])
+
+  return [{'jobid': row[0], 'latitude': row[1], 'longitude': row[2], 'distance': row[3]}
+          for row in rows]
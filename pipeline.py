@@ -0,0 +1,380 @@
+#
+# pipeline.py
+#
+# Declarative definition of the image-processing pipeline, and
+# an orchestrator that runs its stages as soon as their
+# dependencies are satisfied. Stages with no dependencies on
+# each other run in parallel, so end-to-end latency is the
+# critical path through the pipeline rather than the sum of
+# its stages.
+#
+# Two invokers are provided: LambdaInvoker calls the deployed
+# lambda functions, LocalInvoker imports the handler modules
+# and calls them in-process (for testing and local runs).
+# LambdaInvoker also accepts localruntime.LocalLambdaRuntime in
+# place of a lambda client.
+#
+
+import json
+import time
+import uuid
+import importlib
+import urllib.parse
+import timing
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+###################################################################
+#
+# PIPELINE:
+#
+# Each stage names the lambda function that implements it, the
+# local module holding its lambda_handler, the stages it must
+# wait for ("after"), and how many times a failed attempt is
+# retried. Every stage receives the same payload:
+#
+#   {'bucket': bucketname, 'bucketkey': bucketkey}
+#
+PIPELINE = {
+  'compress': {
+    'function': 'finalproj_compress',
+    'module': 'finalproj_compress',
+    'after': [],
+    'retries': 2
+  },
+  'rekognition': {
+    'function': 'finalproj_rekog',
+    'module': 'finalproj_rekognition',
+    'after': [],
+    'retries': 2
+  },
+  'metadata': {
+    'function': 'finalproj_metadata',
+    'module': 'finalproj_metadata',
+    'after': [],
+    'retries': 2
+  }
+}
+
+
+###################################################################
+#
+# FUSED_PIPELINE:
+#
+# Optional single-stage pipeline: finalproj_fused downloads and
+# decodes the image once and produces all of the results the
+# stages above produce. Selected by setting "mode = fused" in
+# the [pipeline] section of config.ini.
+#
+FUSED_PIPELINE = {
+  'fused': {
+    'function': 'finalproj_fused',
+    'module': 'finalproj_fused',
+    'after': [],
+    'retries': 2
+  }
+}
+
+PIPELINES = {
+  'staged': PIPELINE,
+  'fused': FUSED_PIPELINE
+}
+
+
+###################################################################
+#
+# s3_objects:
+#
+# The objects an S3 notification event is about, as a list of
+# (bucket, key, etag); an event may carry several records. Keys
+# arrive URL-encoded.
+#
+def s3_objects(event):
+  objects = []
+
+  for record in event.get('Records', []):
+    if 's3' not in record:
+      continue
+    bucketname = record['s3']['bucket']['name']
+    bucketkey = urllib.parse.unquote_plus(record['s3']['object']['key'], encoding='utf-8')
+    objects.append((bucketname, bucketkey, record['s3']['object'].get('eTag', "")))
+
+  return objects
+
+
+###################################################################
+#
+# batch_response:
+#
+# Combines the responses for several objects (key -> response)
+# into one: 200 if every object succeeded, 400 otherwise, with
+# each object's body keyed by its key.
+#
+def batch_response(responses):
+  failed = [key for (key, response) in responses.items() if response['statusCode'] != 200]
+
+  return {
+    'statusCode': 200 if len(failed) == 0 else 400,
+    'body': json.dumps({key: json.loads(response['body']) for (key, response) in responses.items()})
+  }
+
+
+###################################################################
+#
+# StageFailed:
+#
+# Raised by an invoker when a stage returns an error response.
+#
+class StageFailed(Exception):
+  pass
+
+
+###################################################################
+#
+# StageBusy:
+#
+# Raised when a stage responds 409: another invocation holds its
+# claim (see claims.py) and is still running it. That isn't a
+# failed attempt; run_stage waits for the other invocation.
+#
+class StageBusy(StageFailed):
+  pass
+
+
+###################################################################
+#
+# check_response:
+#
+# Stage handlers respond in an HTTP-like way; anything other
+# than a 200 is treated as a failure of the stage.
+#
+def check_response(stage, response):
+  if isinstance(response, dict) and response.get('statusCode') == 409:
+    raise StageBusy(stage + " busy: " + str(response.get('body')))
+  if not isinstance(response, dict) or response.get('statusCode') != 200:
+    body = response.get('body') if isinstance(response, dict) else response
+    raise StageFailed(stage + " failed: " + str(body))
+  return response
+
+
+###################################################################
+#
+# LambdaInvoker:
+#
+# Invokes each stage's deployed lambda function synchronously
+# (RequestResponse), so the orchestrator can join on completion.
+#
+class LambdaInvoker:
+
+  def __init__(self, lambda_client, pipeline=PIPELINE):
+    self.lambda_client = lambda_client
+    self.pipeline = pipeline
+
+  def invoke(self, stage, payload):
+    response = self.lambda_client.invoke(FunctionName=self.pipeline[stage]['function'],
+                                         InvocationType='RequestResponse',
+                                         Payload=json.dumps(payload))
+
+    result = json.loads(response['Payload'].read())
+
+    if 'FunctionError' in response:
+      raise StageFailed(stage + " failed: " + str(result))
+
+    return check_response(stage, result)
+
+
+###################################################################
+#
+# LocalContext:
+#
+# Minimal stand-in for the lambda context object, for handlers
+# that log their function ARN or check their remaining time.
+#
+class LocalContext:
+
+  def __init__(self, function_name, timeout_secs=900):
+    self.function_name = function_name
+    self.invoked_function_arn = "local:" + function_name
+    self.aws_request_id = str(uuid.uuid4())
+    self.deadline = time.time() + timeout_secs
+
+  def get_remaining_time_in_millis(self):
+    return max(0, int((self.deadline - time.time()) * 1000))
+
+
+###################################################################
+#
+# LocalInvoker:
+#
+# Runs each stage's lambda_handler in this process.
+#
+class LocalInvoker:
+
+  def __init__(self, pipeline=PIPELINE):
+    self.pipeline = pipeline
+
+  def invoke(self, stage, payload):
+    module = importlib.import_module(self.pipeline[stage]['module'])
+    context = LocalContext(self.pipeline[stage]['function'])
+
+    return check_response(stage, module.lambda_handler(payload, context))
+
+
+###################################################################
+#
+# check_pipeline:
+#
+# Makes sure every dependency names a stage in the pipeline and
+# that the dependencies contain no cycles.
+#
+def check_pipeline(pipeline):
+  for name, stage in pipeline.items():
+    for dep in stage['after']:
+      if dep not in pipeline:
+        raise Exception("stage '" + name + "' depends on unknown stage '" + dep + "'")
+
+  done = set()
+  while len(done) < len(pipeline):
+    ready = [name for name, stage in pipeline.items()
+             if name not in done and set(stage['after']) <= done]
+    if len(ready) == 0:
+      raise Exception("pipeline has a dependency cycle")
+    done.update(ready)
+
+
+###################################################################
+#
+# run_stage:
+#
+# Invokes a single stage, retrying failed attempts with
+# exponential backoff. Returns a record of the outcome rather
+# than raising, so one failed stage doesn't abandon the others.
+#
+# A busy stage (another invocation is running it, perhaps our own
+# earlier attempt after a read timeout) isn't a failed attempt:
+# the stage is polled every BUSY_POLL_SECS, each poll costing the
+# stage one claim lookup, until the other invocation completes
+# it or its claim goes stale and the poll takes it over. If the
+# deadline (seconds since the epoch) comes first, the outcome is
+# 'busy'.
+#
+BUSY_POLL_SECS = 2.0
+
+
+def run_stage(invoker, stage, payload, retries, backoff_secs=0.5, deadline=None):
+  start = time.time()
+  attempts = 0
+  polls = 0
+
+  while True:
+    attempts += 1
+    try:
+      with timing.timed('stage.' + stage, attempt=attempts):
+        response = invoker.invoke(stage, payload)
+      return {
+        'stage': stage,
+        'status': 'completed',
+        'attempts': attempts,
+        'polls': polls,
+        'duration': time.time() - start,
+        'response': response
+      }
+
+    except StageBusy as err:
+      attempts -= 1
+      if deadline is not None and time.time() + BUSY_POLL_SECS > deadline:
+        print("**stage", stage, "still busy elsewhere, giving up waiting**")
+        return {
+          'stage': stage,
+          'status': 'busy',
+          'attempts': attempts,
+          'polls': polls,
+          'duration': time.time() - start,
+          'error': str(err)
+        }
+      polls += 1
+      time.sleep(BUSY_POLL_SECS)
+
+    except Exception as err:
+      print("**stage", stage, "attempt", attempts, "failed:", str(err))
+      if attempts > retries:
+        return {
+          'stage': stage,
+          'status': 'error',
+          'attempts': attempts,
+          'polls': polls,
+          'duration': time.time() - start,
+          'error': str(err)
+        }
+      time.sleep(backoff_secs * (2 ** (attempts - 1)))
+
+
+###################################################################
+#
+# run_pipeline:
+#
+# Runs every stage of the pipeline against the given payload,
+# starting each stage as soon as all of its dependencies have
+# completed. If a stage fails (after retries), or is still busy
+# elsewhere at the deadline, the stages that depend on it are
+# skipped. Returns a dictionary mapping stage name to its outcome
+# record.
+#
+def run_pipeline(invoker, payload, pipeline=PIPELINE, max_workers=None, deadline=None):
+  check_pipeline(pipeline)
+
+  results = {}
+  running = {}
+
+  if max_workers is None:
+    max_workers = len(pipeline)
+
+  with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    while len(results) < len(pipeline):
+      #
+      # start (or skip) every stage whose dependencies are done:
+      #
+      for name, stage in pipeline.items():
+        if name in results or name in running.values():
+          continue
+
+        deps = stage['after']
+
+        if any(dep in results and results[dep]['status'] != 'completed' for dep in deps):
+          results[name] = {'stage': name, 'status': 'skipped', 'attempts': 0, 'polls': 0, 'duration': 0.0}
+        elif all(dep in results for dep in deps):
+          future = timing.submit(executor, run_stage, invoker, name, payload, stage['retries'],
+                                 deadline=deadline)
+          running[future] = name
+
+      if len(running) == 0:
+        continue
+
+      #
+      # wait for at least one running stage to finish:
+      #
+      finished, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+      for future in finished:
+        results[running.pop(future)] = future.result()
+
+  return results
+
+
+###################################################################
+#
+# pipeline_succeeded:
+#
+def pipeline_succeeded(results):
+  return all(result['status'] == 'completed' for result in results.values())
+
+
+###################################################################
+#
+# pipeline_busy:
+#
+# Whether a stage was still running elsewhere at the deadline, so
+# the pipeline neither succeeded nor failed yet.
+#
+def pipeline_busy(results):
+  return any(result['status'] == 'busy' for result in results.values())
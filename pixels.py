@@ -0,0 +1,120 @@
+#
+# pixels.py
+#
+# Pixel operations on (height, width, channels) uint8 arrays,
+# worked in strips of rows so the temporaries numpy makes stay
+# small however big the image is.
+#
+
+import numpy as np
+
+
+#
+# pixels are processed in strips of about this many:
+#
+STRIP_PIXELS = 1024 * 1024
+
+
+###################################################################
+#
+# strips:
+#
+# Splits rows [0, height) into at most count strips of (nearly)
+# equal height, as (top, bottom) pairs.
+#
+def strips(height, count):
+  count = max(1, min(count, height))
+  bounds = [round(height * i / count) for i in range(count + 1)]
+  return [(bounds[i], bounds[i + 1]) for i in range(count)]
+
+
+###################################################################
+#
+# strip_count:
+#
+# How many strips to work on an image in, so each holds about
+# STRIP_PIXELS pixels; the temporaries numpy makes per strip then
+# stay the same size however big the image is.
+#
+def strip_count(image):
+  return max(1, -(-image.shape[0] * image.shape[1] // STRIP_PIXELS))
+
+
+###################################################################
+#
+# channel_histograms / map_channels:
+#
+# The per-strip work: histograms of each channel of a (rows,
+# width, channels) uint8 strip, as a (channels, 256) array of
+# counts; and mapping each channel through its lookup table
+# (luts is (channels, 256)), in place.
+#
+def channel_histograms(strip):
+  return np.stack([np.bincount(strip[:, :, c].ravel(), minlength=256)
+                   for c in range(strip.shape[2])])
+
+
+def map_channels(strip, luts):
+  for c in range(strip.shape[2]):
+    strip[:, :, c] = luts[c][strip[:, :, c]]
+
+
+###################################################################
+#
+# histograms:
+#
+# Per-channel histograms of a (height, width, channels) uint8
+# image, summed over its strips.
+#
+def histograms(image):
+  return sum(channel_histograms(image[top:bottom])
+             for (top, bottom) in strips(image.shape[0], strip_count(image)))
+
+
+###################################################################
+#
+# apply_luts:
+#
+# Maps each channel of a uint8 image through its lookup table,
+# in place, strip by strip.
+#
+def apply_luts(image, luts):
+  for (top, bottom) in strips(image.shape[0], strip_count(image)):
+    map_channels(image[top:bottom], luts)
+  return image
+
+
+###################################################################
+#
+# histogram_match:
+#
+# Maps the colours of the source image so its per-channel
+# histograms match the target's.
+#
+def histogram_match(source_im, target_im):
+  """
+  Matches the histogram of an image to another's
+
+  Parameters
+  ----------
+  source_im : (height, width, channels) uint8 array, modified
+              in place,
+  target_im : (height, width, channels) uint8 array
+
+  Returns
+  -------
+  source_im, with its colours mapped
+  """
+  source_hists = histograms(source_im)
+  target_hists = histograms(target_im)
+
+  # each channel's mapping depends only on that channel, so all
+  # of them can be computed before any pixels are changed:
+  luts = []
+  for c in range(source_im.shape[2]):
+    source_cdf = source_hists[c].cumsum() / (source_im.shape[0] * source_im.shape[1])
+    target_cdf = target_hists[c].cumsum() / (target_im.shape[0] * target_im.shape[1])
+    mapping = np.interp(source_cdf, target_cdf, np.arange(256))
+    luts.append(mapping.astype(np.uint8))
+
+  return apply_luts(source_im, np.stack(luts))
@@ -0,0 +1,142 @@
+#
+# poolbenchmark.py
+#
+# Measures how image throughput scales with the number of worker
+# processes (workerpool.py), from 1 up to the number of cores, to
+# pick the memory size (and so vCPUs) of the image lambdas:
+#
+#   python poolbenchmark.py --images 48 --sizes 1920x1080:3,4000x3000:1 \
+#     --out scaling.json
+#
+# For each pool size it reports images/sec through
+# imaging.compress_jpeg (decode, resample, encode), one image per
+# task, as a batch of uploads would run, along with the speedup
+# over one worker, and the inline (no pool) baseline the lambdas
+# fall back to on one vCPU.
+#
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+import imaging
+import workerpool
+
+from benchmark import make_jpeg, parse_sizes
+
+
+###################################################################
+#
+# default_workers:
+#
+# 1, 2, 4, ... up to and including the number of cores.
+#
+def default_workers():
+  cores = os.cpu_count() or 1
+  counts = []
+  n = 1
+  while n < cores:
+    counts.append(n)
+    n *= 2
+  counts.append(cores)
+  return counts
+
+
+###################################################################
+#
+# make_corpus:
+#
+# The images to compress, drawn from the weighted sizes.
+#
+def make_corpus(sizes, count, seed):
+  rng = random.Random(seed)
+  dims = [size for (size, weight) in sizes]
+  weights = [weight for (size, weight) in sizes]
+
+  return [make_jpeg(*rng.choices(dims, weights)[0], seed + i) for i in range(count)]
+
+
+###################################################################
+#
+# time_compress:
+#
+# Seconds to compress the corpus, with the given pool (None runs it
+# inline, as on a one-vCPU lambda).
+#
+def time_compress(workers, corpus):
+  start = time.time()
+  if workers is None:
+    for image_bytes in corpus:
+      imaging.compress_jpeg(image_bytes)
+  else:
+    workers.run_all(imaging.compress_jpeg, [(image_bytes,) for image_bytes in corpus])
+  return time.time() - start
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description="Benchmark image throughput against worker processes.")
+  parser.add_argument("--images", type=int, default=32)
+  parser.add_argument("--sizes", default="1920x1080:3,4000x3000:1",
+                      help="image sizes to compress, WIDTHxHEIGHT[:weight],...")
+  parser.add_argument("--workers", help="pool sizes to measure, e.g. 1,2,4 (default 1, 2, 4 ... cores)")
+  parser.add_argument("--seed", type=int, default=310)
+  parser.add_argument("--out", help="also write the JSON report to this file")
+
+  args = parser.parse_args(argv)
+
+  counts = default_workers() if args.workers is None else [int(n) for n in args.workers.split(",")]
+
+  print("**generating", args.images, "images**", file=sys.stderr)
+  corpus = make_corpus(parse_sizes(args.sizes), args.images, args.seed)
+
+  # the timing records would swamp the report:
+  os.environ['TIMING_OUTPUT'] = 'off'
+
+  inline_compress = time_compress(None, corpus)
+
+  results = []
+  for n in counts:
+    print("**measuring", n, "worker(s)**", file=sys.stderr)
+    workers = workerpool.WorkerPool(n)
+    try:
+      # warm up: fork, import and first-touch in every worker:
+      workers.run_all(imaging.compress_jpeg, [(corpus[0],)] * n)
+
+      compress_secs = time_compress(workers, corpus)
+    finally:
+      workers.shutdown()
+
+    results.append({
+      'workers': n,
+      'compress_images_per_sec': round(len(corpus) / compress_secs, 2)
+    })
+
+  baseline = results[0]
+  for result in results:
+    result['compress_speedup'] = round(result['compress_images_per_sec'] / baseline['compress_images_per_sec'], 2)
+    result['compress_efficiency'] = round(result['compress_speedup'] / (result['workers'] / baseline['workers']), 2)
+
+  report = {
+    'cores': os.cpu_count(),
+    'images': len(corpus),
+    'sizes': args.sizes,
+    'inline': {
+      'compress_images_per_sec': round(len(corpus) / inline_compress, 2)
+    },
+    'pools': results
+  }
+
+  print(json.dumps(report, indent=2))
+  if args.out is not None:
+    outfile = open(args.out, 'w')
+    json.dump(report, outfile, indent=2)
+    outfile.close()
+
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
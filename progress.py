@@ -0,0 +1,149 @@
+#
+# progress.py
+#
+# Per-stage progress of a job. Each pipeline stage records a row
+# in the jobstages table as it finishes, so clients can see which
+# results are already available while the job is still pending,
+# and so we can compute per-stage latency percentiles.
+#
+
+import time
+import datatier
+
+
+###################################################################
+#
+# record_stage:
+#
+# Records the outcome of a pipeline stage for the job that owns
+# the given datafilekey. The row is written by a single
+# INSERT ... ON DUPLICATE KEY UPDATE, so the record appears
+# atomically, and a retried stage overwrites its earlier attempt.
+#
+def record_stage(dbConn, datafilekey, stage, status, started, finished=None):
+  """
+  Records the outcome of a pipeline stage
+
+  Parameters
+  ----------
+  dbConn : the database connection,
+  datafilekey : bucket key of the job's uploaded image (string),
+  stage : name of the stage, as in pipeline.py (string),
+  status : 'completed', or an error message (string),
+  started : when the stage started (seconds since the epoch),
+  finished : when the stage finished (defaults to now)
+
+  Returns
+  -------
+  number of rows modified
+  """
+  if finished is None:
+    finished = time.time()
+
+  durationms = int(round((finished - started) * 1000))
+
+  sql = """
+    INSERT INTO jobstages(jobid, stage, status, started, finished, durationms)
+           SELECT jobid, %s, %s, FROM_UNIXTIME(%s), FROM_UNIXTIME(%s), %s
+           FROM jobs
+           WHERE datafilekey = %s
+    ON DUPLICATE KEY UPDATE status = VALUES(status),
+                            started = VALUES(started),
+                            finished = VALUES(finished),
+                            durationms = VALUES(durationms);
+  """
+
+  return datatier.perform_action(dbConn, sql, [stage, status[0:256], started, finished,
+                                               durationms, datafilekey])
+
+
+###################################################################
+#
+# get_stages:
+#
+# Returns the recorded stages of a job as a dictionary mapping
+# stage name to {'status', 'finished', 'durationms'}.
+#
+def get_stages(dbConn, jobid):
+  """
+  Returns the recorded stages of a job
+
+  Parameters
+  ----------
+  dbConn : the database connection,
+  jobid : the job (integer)
+
+  Returns
+  -------
+  dictionary mapping stage name to its status, finish time
+  (ISO format string) and duration in milliseconds
+  """
+  sql = """
+    SELECT stage, status, finished, durationms
+    FROM jobstages
+    WHERE jobid = %s;
+  """
+
+  rows = datatier.retrieve_all_rows(dbConn, sql, [jobid])
+
+  stages = {}
+  for row in rows:
+    stages[row[0]] = {
+      'status': row[1],
+      'finished': row[2].isoformat(),
+      'durationms': row[3]
+    }
+
+  return stages
+
+
+###################################################################
+#
+# stage_completed:
+#
+def stage_completed(stages, stage):
+  return stage in stages and stages[stage]['status'] == 'completed'
+
+
+###################################################################
+#
+# stage_latency_percentiles:
+#
+# Computes latency percentiles (nearest-rank) for each stage over
+# every successfully completed stage row.
+#
+def stage_latency_percentiles(dbConn, percentiles=[50, 95, 99]):
+  """
+  Computes per-stage latency percentiles
+
+  Parameters
+  ----------
+  dbConn : the database connection,
+  percentiles : list of percentiles to compute (0-100)
+
+  Returns
+  -------
+  dictionary mapping stage name to {'count', 'p50', 'p95', ...},
+  latencies in milliseconds
+  """
+  sql = """
+    SELECT stage, durationms
+    FROM jobstages
+    WHERE status = 'completed'
+    ORDER BY stage, durationms;
+  """
+
+  rows = datatier.retrieve_all_rows(dbConn, sql)
+
+  durations = {}
+  for row in rows:
+    durations.setdefault(row[0], []).append(row[1])
+
+  stats = {}
+  for stage, values in durations.items():
+    stats[stage] = {'count': len(values)}
+    for p in percentiles:
+      rank = max(1, -(-p * len(values) // 100))  # ceil(p/100 * n)
+      stats[stage]['p' + str(p)] = values[rank - 1]
+
+  return stats
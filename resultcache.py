@@ -0,0 +1,176 @@
+#
+# resultcache.py
+#
+# A cache of computed results (histogram matches) in the bucket,
+# under keys derived from everything the result depends on, so
+# asking for the same result again costs one GET:
+#
+#   cachekey = resultcache.cache_key('histmatch', HISTMATCH_VERSION, source_key, target_key)
+#   body = resultcache.lookup(s3, dbConn, bucketname, cachekey)
+#   if body is None:
+#     body = ... compute ...
+#     resultcache.store(s3, dbConn, bucketname, cachekey, body, budget_bytes)
+#
+# The resultcache table tracks the size and last use of each
+# entry; when the cache outgrows its budget, the least recently
+# used entries are deleted until it fits again.
+#
+
+import json
+import hashlib
+import datatier
+import timing
+import transfer
+
+from botocore.exceptions import ClientError
+
+
+CACHE_PREFIX = "resultcache/"
+
+#
+# S3's DeleteObjects takes at most this many keys:
+#
+DELETE_BATCH = 1000
+
+
+###################################################################
+#
+# cache_key:
+#
+# The bucket key of a result, from its kind and the parts
+# (anything JSON can serialize) it depends on. It has no .jpg
+# extension, so storing it doesn't start the pipeline.
+#
+def cache_key(kind, *parts):
+  digest = hashlib.sha256(json.dumps([kind] + list(parts), sort_keys=True).encode())
+  return CACHE_PREFIX + kind + "/" + digest.hexdigest()
+
+
+###################################################################
+#
+# lookup:
+#
+def lookup(s3, dbConn, bucketname, cachekey):
+  """
+  Fetches a cached result, and marks it as used
+
+  Parameters
+  ----------
+  s3 : boto3 S3 client,
+  dbConn : the database connection,
+  bucketname : the bucket (string),
+  cachekey : key of the result, from cache_key (string)
+
+  Returns
+  -------
+  the result (bytes), or None if it isn't cached, or can't be
+  read: like store, the cache is best-effort, and a failed probe
+  (a 403 for a missing key without ListBucket, a transient 5xx)
+  just means computing the result
+  """
+  try:
+    body = transfer.get_bytes(s3, bucketname, cachekey)
+  except Exception as err:
+    if isinstance(err, ClientError) and err.response['Error']['Code'] in ['NoSuchKey', '404']:
+      print("**Result cache miss:", cachekey, "**")
+    else:
+      print("**Result cache lookup failed, treating as a miss:", str(err), "**")
+    return None
+
+  print("**Result cache hit:", cachekey, "**")
+
+  sql = """
+    UPDATE resultcache SET lastused = NOW(3), hits = hits + 1
+    WHERE cachekey = %s;
+  """
+
+  try:
+    datatier.perform_action(dbConn, sql, [cachekey])
+  except Exception as err:
+    # only the eviction order suffers:
+    print("**Result cache hit not recorded:", str(err), "**")
+
+  return body
+
+
+###################################################################
+#
+# store:
+#
+def store(s3, dbConn, bucketname, cachekey, body, budget_bytes, content_type="image/jpeg"):
+  """
+  Caches a result, evicting least recently used results if the
+  cache is then over its budget
+
+  Parameters
+  ----------
+  s3 : boto3 S3 client,
+  dbConn : the database connection,
+  bucketname : the bucket (string),
+  cachekey : key of the result, from cache_key (string),
+  body : the result (bytes),
+  budget_bytes : how big the whole cache may get,
+  content_type : Content-Type of the result
+
+  Returns
+  -------
+  number of results evicted
+  """
+  transfer.put_bytes(s3, bucketname, cachekey, body, content_type=content_type)
+
+  sql = """
+    INSERT INTO resultcache(cachekey, size, created, lastused, hits)
+           VALUES(%s, %s, NOW(3), NOW(3), 0)
+    ON DUPLICATE KEY UPDATE size = VALUES(size),
+                            lastused = VALUES(lastused);
+  """
+
+  datatier.perform_action(dbConn, sql, [cachekey, len(body)])
+
+  return evict(s3, dbConn, bucketname, budget_bytes)
+
+
+###################################################################
+#
+# evict:
+#
+# Deletes the least recently used results until the cache fits
+# in budget_bytes, and returns how many were deleted.
+#
+@timing.timed_function('resultcache.evict')
+def evict(s3, dbConn, bucketname, budget_bytes):
+  sql = "SELECT SUM(size) FROM resultcache;"
+
+  row = datatier.retrieve_one_row(dbConn, sql)
+  total = int(row[0] or 0)
+
+  if total <= budget_bytes:
+    return 0
+
+  sql = """
+    SELECT cachekey, size
+    FROM resultcache
+    ORDER BY lastused ASC;
+  """
+
+  rows = datatier.retrieve_all_rows(dbConn, sql)
+
+  victims = []
+  for (cachekey, size) in rows:
+    if total <= budget_bytes:
+      break
+    victims.append(cachekey)
+    total -= size
+
+  print("**Result cache over budget, evicting", len(victims), "result(s)**")
+
+  for i in range(0, len(victims), DELETE_BATCH):
+    batch = victims[i:i + DELETE_BATCH]
+
+    s3.delete_objects(Bucket=bucketname,
+                      Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True})
+
+    sql = "DELETE FROM resultcache WHERE cachekey IN (" + ", ".join(["%s"] * len(batch)) + ");"
+    datatier.perform_action(dbConn, sql, batch)
+
+  return len(victims)
@@ -0,0 +1,268 @@
+#
+# rowcache.py
+#
+# Per-container cache of database rows that don't change (or
+# change rarely): users, and jobs once they are completed, with
+# their artifact manifests. A warm lambda keeps its module state
+# between invocations, so a hot lookup costs no database round
+# trip at all; with a datatier.LazyConnection, no connection
+# either:
+#
+#   dbConn = datatier.LazyConnection(rds_endpoint, ...)
+#   row = rowcache.get_job(dbConn, jobid)
+#
+# Only rows that can't change are cached: users, and completed
+# jobs (a pending job changes when its pipeline finishes, in
+# another container). The one thing that does change them is
+# finalproj_reset, which empties the tables so that job ids start
+# over; it runs in a container of its own, so it can't clear ours.
+# Instead it bumps the reset generation (the resets table), and
+# entries are keyed by the generation they were read in. The
+# generation itself is cached for GENERATION_TTL_SECS, so a
+# container may serve rows from before a reset for that long,
+# and no longer; entries also expire after a TTL, to bound the
+# memory of rows no longer asked for.
+#
+
+import time
+import threading
+import collections
+import datatier
+import timing
+import artifacts
+
+
+###################################################################
+#
+# RowCache:
+#
+class RowCache:
+  """
+  A thread-safe LRU cache whose entries expire after a TTL,
+  counting hits and misses.
+
+  Parameters
+  ----------
+  name : name of the cache, for the timing records,
+  maxsize : most entries to keep,
+  ttl_secs : how long an entry stays valid
+  """
+
+  def __init__(self, name, maxsize, ttl_secs):
+    self.name = name
+    self.maxsize = maxsize
+    self.ttl_secs = ttl_secs
+    self.entries = collections.OrderedDict()
+    self.lock = threading.Lock()
+    self.counts = {'hits': 0, 'misses': 0, 'expired': 0, 'evicted': 0, 'invalidated': 0}
+
+  def get(self, key):
+    """
+    Returns (True, value) if key is cached, otherwise
+    (False, None).
+    """
+    now = time.monotonic()
+
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is not None and entry[0] <= now:
+        del self.entries[key]
+        self.counts['expired'] += 1
+        entry = None
+
+      if entry is None:
+        self.counts['misses'] += 1
+        return (False, None)
+
+      self.entries.move_to_end(key)
+      self.counts['hits'] += 1
+      return (True, entry[1])
+
+  def put(self, key, value):
+    with self.lock:
+      self.entries[key] = (time.monotonic() + self.ttl_secs, value)
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.maxsize:
+        self.entries.popitem(last=False)
+        self.counts['evicted'] += 1
+
+  def invalidate(self, key):
+    with self.lock:
+      if self.entries.pop(key, None) is not None:
+        self.counts['invalidated'] += 1
+
+  def clear(self):
+    with self.lock:
+      self.counts['invalidated'] += len(self.entries)
+      self.entries.clear()
+
+  def stats(self):
+    with self.lock:
+      stats = dict(self.counts)
+      stats['size'] = len(self.entries)
+
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = round(stats['hits'] / lookups, 3) if lookups > 0 else None
+    return stats
+
+
+USERS = RowCache('users', maxsize=1024, ttl_secs=300)
+JOBS = RowCache('jobs', maxsize=4096, ttl_secs=600)
+MANIFESTS = RowCache('manifests', maxsize=4096, ttl_secs=600)
+
+#
+# how long a container trusts the reset generation it last read:
+#
+GENERATION_TTL_SECS = 5
+GENERATIONS = RowCache('generation', maxsize=1, ttl_secs=GENERATION_TTL_SECS)
+
+CACHES = [USERS, JOBS, MANIFESTS, GENERATIONS]
+
+
+###################################################################
+#
+# cached:
+#
+# Looks key up in cache, calling load() on a miss; the result is
+# cached if keep(result) says so.
+#
+def cached(cache, key, load, keep):
+  with timing.timed('rowcache.get', cache=cache.name) as step:
+    (found, value) = cache.get(key)
+    step['hit'] = found
+
+  if found:
+    return value
+
+  value = load()
+  if keep(value):
+    cache.put(key, value)
+  return value
+
+
+###################################################################
+#
+# generation / row_key:
+#
+# The current reset generation (see finalproj_reset), and the
+# cache key of a row read in it.
+#
+def generation(dbConn):
+  sql = "SELECT generation FROM resets WHERE id = 1;"
+
+  def load():
+    row = datatier.retrieve_one_row(dbConn, sql)
+    return row[0] if row != () else 0
+
+  return cached(GENERATIONS, 'generation', load, lambda value: True)
+
+
+def row_key(dbConn, rowid):
+  return str(generation(dbConn)) + ":" + str(rowid)
+
+
+###################################################################
+#
+# next_generation:
+#
+# Starts a new reset generation, so every container stops
+# trusting the rows it cached (within GENERATION_TTL_SECS).
+#
+def next_generation(dbConn):
+  sql = "UPDATE resets SET generation = generation + 1 WHERE id = 1;"
+
+  datatier.perform_action(dbConn, sql)
+  clear()
+
+
+###################################################################
+#
+# get_user:
+#
+# The users row of userid, or () if there is no such user.
+#
+def get_user(dbConn, userid):
+  sql = "SELECT * FROM users WHERE userid = %s;"
+
+  return cached(USERS, row_key(dbConn, userid),
+                lambda: datatier.retrieve_one_row(dbConn, sql, [userid]),
+                lambda row: row != ())
+
+
+###################################################################
+#
+# get_job / get_jobs:
+#
+# The jobs row of jobid, or () if there is no such job; and the
+# rows of several jobs, as a dictionary of jobid (string) -> row,
+# in one query for those not cached.
+#
+def completed(row):
+  return row != () and row[2] == 'completed'
+
+
+def get_job(dbConn, jobid):
+  sql = "SELECT * FROM jobs WHERE jobid = %s;"
+
+  return cached(JOBS, row_key(dbConn, jobid),
+                lambda: datatier.retrieve_one_row(dbConn, sql, [jobid]),
+                completed)
+
+
+def get_jobs(dbConn, jobids):
+  jobs = {}
+  missing = []
+  current = str(generation(dbConn)) + ":"
+
+  for jobid in jobids:
+    with timing.timed('rowcache.get', cache=JOBS.name) as step:
+      (found, row) = JOBS.get(current + str(jobid))
+      step['hit'] = found
+    if found:
+      jobs[str(jobid)] = row
+    else:
+      missing.append(jobid)
+
+  if len(missing) > 0:
+    sql = "SELECT * FROM jobs WHERE jobid IN (" + ", ".join(["%s"] * len(missing)) + ");"
+
+    for row in datatier.retrieve_all_rows(dbConn, sql, missing):
+      jobs[str(row[0])] = row
+      if completed(row):
+        JOBS.put(current + str(row[0]), row)
+
+  return jobs
+
+
+###################################################################
+#
+# get_manifest:
+#
+# The artifact manifest of a job (see artifacts.get_artifacts),
+# cached once the job is completed.
+#
+def get_manifest(dbConn, jobid, job_completed):
+  return cached(MANIFESTS, row_key(dbConn, jobid),
+                lambda: artifacts.get_artifacts(dbConn, jobid),
+                lambda manifest: job_completed)
+
+
+###################################################################
+#
+# clear:
+#
+# Forgets everything this container has cached.
+#
+def clear():
+  for cache in CACHES:
+    cache.clear()
+
+
+###################################################################
+#
+# stats:
+#
+# Hit-rate counters of each cache, since the container started.
+#
+def stats():
+  return {cache.name: cache.stats() for cache in CACHES}
@@ -0,0 +1,240 @@
+#
+# scratchverify.py
+#
+# Checks that the scratch-file path for huge images (see
+# imaging.ScratchImage) gives exactly the same results as
+# decoding into memory, and measures how much memory each takes:
+#
+#   python scratchverify.py --sizes 640x480,1001x777,8000x6000 --memory
+#
+# For each image of a corpus of synthetic JPEGs (colour and
+# greyscale, at each size) it compares:
+#
+#   compress: imaging.compress_jpeg vs compress_jpeg_scratch,
+#     byte for byte;
+#   thumbnail: finalproj_histmatch's cv2.imread thumbnail vs
+#     load_thumbnail_scratch, pixel for pixel;
+#   luts: pixels.apply_luts strip by strip vs in one go.
+#
+# With --memory, each path also runs in a fresh worker process,
+# reporting its peak anonymous memory (RssAnon, sampled; the
+# scratch file's pages don't count, since the kernel can write
+# them out). Exits 1 if any result differs.
+#
+
+import argparse
+import io
+import json
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+import cv2
+from PIL import Image
+
+import imaging
+import pixels
+import workerpool
+import finalproj_histmatch
+
+from benchmark import make_jpeg, parse_sizes
+
+
+###################################################################
+#
+# make_corpus:
+#
+# (name, jpeg bytes) for a colour and a greyscale image of each
+# size, plus a progressive JPEG, which must be left to the
+# in-memory path.
+#
+def make_corpus(sizes, seed):
+  corpus = []
+
+  for (i, ((width, height), _)) in enumerate(sizes):
+    colour = make_jpeg(width, height, seed + i)
+    corpus.append((str(width) + "x" + str(height) + " RGB", colour, False))
+
+    grey = io.BytesIO()
+    Image.open(io.BytesIO(colour)).convert("L").save(grey, format="JPEG", quality=90)
+    corpus.append((str(width) + "x" + str(height) + " L", grey.getvalue(), False))
+
+  ((width, height), _) = sizes[0]
+  progressive = io.BytesIO()
+  Image.open(io.BytesIO(make_jpeg(width, height, seed))).save(progressive, format="JPEG", progressive=True)
+  corpus.append((str(width) + "x" + str(height) + " RGB progressive", progressive.getvalue(), True))
+
+  return corpus
+
+
+###################################################################
+#
+# rss_anon_kb:
+#
+def rss_anon_kb():
+  infile = open("/proc/self/status")
+  lines = infile.readlines()
+  infile.close()
+
+  for line in lines:
+    if line.startswith("RssAnon:"):
+      return int(line.split()[1])
+  return 0
+
+
+###################################################################
+#
+# measure:
+#
+# Runs func(*args) (in a worker), sampling anonymous memory as it
+# runs, and returns the peak growth in MB.
+#
+def measure(func, *args):
+  peak = {'kb': rss_anon_kb()}
+  base = peak['kb']
+  done = threading.Event()
+
+  def sample():
+    while not done.is_set():
+      peak['kb'] = max(peak['kb'], rss_anon_kb())
+      time.sleep(0.002)
+
+  sampler = threading.Thread(target=sample)
+  sampler.start()
+  try:
+    func(*args)
+  finally:
+    done.set()
+    sampler.join()
+
+  return round((peak['kb'] - base) / 1024, 1)
+
+
+###################################################################
+#
+# peak_mb:
+#
+# measure() in a fresh process, so memory freed by earlier runs
+# can't hide this one's.
+#
+def peak_mb(func, *args):
+  workers = workerpool.WorkerPool(1)
+  try:
+    return workers.run(measure, func, *args)
+  finally:
+    workers.shutdown()
+
+
+def load_thumbnail_memory(local_filename):
+  return cv2.resize(cv2.imread(local_filename), (128, 128))
+
+
+###################################################################
+#
+# verify_luts:
+#
+# apply_luts strip by strip (with tiny strips) against mapping
+# the whole image at once.
+#
+def verify_luts(jpg):
+  image = np.array(Image.open(io.BytesIO(jpg)).convert("RGB"))
+  luts = np.stack([np.arange(256)[::-1], np.arange(256) // 2, np.arange(256)]).astype(np.uint8)
+
+  expected = image.copy()
+  for c in range(3):
+    expected[:, :, c] = luts[c][expected[:, :, c]]
+
+  strip_pixels = pixels.STRIP_PIXELS
+  pixels.STRIP_PIXELS = max(1, image.shape[1] * 7)
+  try:
+    result = pixels.apply_luts(image, luts)
+  finally:
+    pixels.STRIP_PIXELS = strip_pixels
+
+  return bool((result == expected).all())
+
+
+def verify(name, jpg, progressive, local_filename, memory):
+  result = {'image': name}
+
+  if progressive:
+    # not streamable, so these must stay in memory however big:
+    min_pixels = imaging.SCRATCH_MIN_PIXELS
+    imaging.SCRATCH_MIN_PIXELS = 0
+    try:
+      result['needs_scratch'] = imaging.needs_scratch(jpg)
+    finally:
+      imaging.SCRATCH_MIN_PIXELS = min_pixels
+
+    result['ok'] = not result['needs_scratch']
+    return result
+
+  result['compress_identical'] = imaging.compress_jpeg(jpg) == imaging.compress_jpeg_scratch(jpg)
+
+  outfile = open(local_filename, "wb")
+  outfile.write(jpg)
+  outfile.close()
+
+  expected = load_thumbnail_memory(local_filename)
+  thumbnail = finalproj_histmatch.load_thumbnail_scratch(local_filename)
+  result['thumbnail_identical'] = bool((expected == thumbnail).all())
+  if not result['thumbnail_identical']:
+    result['thumbnail_max_difference'] = int(np.abs(expected.astype(int) - thumbnail).max())
+
+  result['luts_identical'] = verify_luts(jpg)
+
+  if memory:
+    result['peak_anon_mb'] = {
+      'compress': peak_mb(imaging.compress_jpeg, jpg),
+      'compress_scratch': peak_mb(imaging.compress_jpeg_scratch, jpg),
+      'thumbnail': peak_mb(load_thumbnail_memory, local_filename),
+      'thumbnail_scratch': peak_mb(finalproj_histmatch.load_thumbnail_scratch, local_filename)
+    }
+
+  result['ok'] = result['compress_identical'] and result['thumbnail_identical'] and result['luts_identical']
+  return result
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description="Verify the scratch-file path for huge images.")
+  parser.add_argument("--sizes", default="640x480,1001x777,2999x2001",
+                      help="image sizes, WIDTHxHEIGHT,...")
+  parser.add_argument("--memory", action="store_true",
+                      help="also measure peak memory of each path")
+  parser.add_argument("--seed", type=int, default=310)
+  parser.add_argument("--out", help="also write the JSON report to this file")
+
+  args = parser.parse_args(argv)
+
+  # the timing records would swamp the report:
+  os.environ['TIMING_OUTPUT'] = 'off'
+
+  local_filename = os.path.join(imaging.SCRATCH_DIR, "scratchverify-" + str(os.getpid()) + ".jpg")
+
+  results = []
+  try:
+    for (name, jpg, progressive) in make_corpus(parse_sizes(args.sizes), args.seed):
+      print("**verifying", name, "**", file=sys.stderr)
+      results.append(verify(name, jpg, progressive, local_filename, args.memory))
+  finally:
+    if os.path.exists(local_filename):
+      os.remove(local_filename)
+
+  report = {
+    'ok': all(result['ok'] for result in results),
+    'images': results
+  }
+
+  print(json.dumps(report, indent=2))
+  if args.out is not None:
+    outfile = open(args.out, 'w')
+    json.dump(report, outfile, indent=2)
+    outfile.close()
+
+  return 0 if report['ok'] else 1
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,279 @@
+#
+# timing.py
+#
+# Lightweight timing instrumentation for the lambda handlers.
+# Wrap a handler with @timing.instrumented and the steps inside
+# it with timing.timed():
+#
+#   @timing.instrumented
+#   def lambda_handler(event, context):
+#     with timing.timed('s3.download', key=bucketkey):
+#       bucket.download_file(bucketkey, local_img)
+#
+# A step that moves data can report how much, and its record and
+# the summary then include the throughput:
+#
+#   with timing.timed('s3.get', key=bucketkey) as step:
+#     body = s3.get_object(Bucket=bucketname, Key=bucketkey)['Body'].read()
+#     step['bytes'] = len(body)
+#
+# Each timed step prints a structured JSON record as it finishes,
+# and when the handler returns a per-invocation summary is
+# printed with the total time spent in each kind of step, so the
+# CloudWatch logs show where the milliseconds go. datatier times
+# every connect and SQL statement, transfer times S3 gets and
+# puts, and imaging and jpegheader time their decode/encode,
+# Rekognition and header fetches.
+#
+# Output is controlled by environment variables (set on the
+# lambda function), since timing starts before config.ini is
+# read:
+#
+#   TIMING_OUTPUT = all (default) | summary | off
+#   TIMING_FORMAT = json (default) | emf
+#
+# With emf, records are written in CloudWatch Embedded Metric
+# Format, so CloudWatch turns them into metrics (namespace
+# TIMING_NAMESPACE) without any extra API calls.
+#
+
+import os
+import json
+import time
+import uuid
+import functools
+import threading
+import contextlib
+import contextvars
+
+
+TIMING_NAMESPACE = "finalproj"
+
+#
+# EMF units of the metrics that aren't durations:
+#
+METRIC_UNITS = {'bytes': 'Bytes', 'mb_per_sec': 'Megabytes/Second'}
+
+#
+# the invocation being timed; a context variable rather than a
+# global, since the local runtime runs many invocations at once
+# in one process:
+#
+current = contextvars.ContextVar('timing_invocation', default=None)
+
+
+###################################################################
+#
+# Invocation:
+#
+# Accumulates the time spent in each kind of step during one
+# invocation of a handler. Steps may finish on several threads
+# (see submit), hence the lock.
+#
+class Invocation:
+
+  def __init__(self, function_name, request_id):
+    self.function_name = function_name
+    self.request_id = request_id
+    self.start = time.time()
+    self.phases = {}
+    self.lock = threading.Lock()
+
+  def add(self, name, ms, nbytes=0):
+    with self.lock:
+      phase = self.phases.setdefault(name, {'count': 0, 'ms': 0.0, 'bytes': 0})
+      phase['count'] += 1
+      phase['ms'] += ms
+      phase['bytes'] += nbytes
+
+  def summary(self, status):
+    total_ms = (time.time() - self.start) * 1000
+    phases = {}
+    for (name, phase) in sorted(self.phases.items()):
+      phases[name] = {'count': phase['count'], 'ms': round(phase['ms'], 3)}
+      if phase['bytes'] > 0:
+        phases[name]['bytes'] = phase['bytes']
+        phases[name]['mb_per_sec'] = throughput(phase['bytes'], phase['ms'])
+
+    # steps can overlap (threads), so this can go negative:
+    accounted_ms = sum(phase['ms'] for phase in self.phases.values())
+
+    return {
+      'type': 'invocation',
+      'function': self.function_name,
+      'request_id': self.request_id,
+      'status': status,
+      'total_ms': round(total_ms, 3),
+      'unaccounted_ms': round(total_ms - accounted_ms, 3),
+      'phases': phases
+    }
+
+
+###################################################################
+#
+# throughput:
+#
+# MB (10^6 bytes) per second, for a step that moved nbytes in ms.
+#
+def throughput(nbytes, ms):
+  if ms <= 0:
+    return None
+  return round(nbytes / 1000000 / (ms / 1000), 3)
+
+
+###################################################################
+#
+# output settings:
+#
+def output_level():
+  return os.environ.get('TIMING_OUTPUT', 'all')
+
+
+def output_format():
+  return os.environ.get('TIMING_FORMAT', 'json')
+
+
+###################################################################
+#
+# emf:
+#
+# Wraps a record in CloudWatch Embedded Metric Format, publishing
+# the given metrics (name -> milliseconds) with the record's
+# function (and step name, if any) as dimensions.
+#
+def emf(record, metrics):
+  dimensions = ['function'] if 'name' not in record else ['function', 'name']
+
+  document = dict(record)
+  document.update(metrics)
+  document['_aws'] = {
+    'Timestamp': int(time.time() * 1000),
+    'CloudWatchMetrics': [{
+      'Namespace': TIMING_NAMESPACE,
+      'Dimensions': [dimensions],
+      'Metrics': [{'Name': name, 'Unit': METRIC_UNITS.get(name, 'Milliseconds')} for name in metrics]
+    }]
+  }
+  return document
+
+
+###################################################################
+#
+# emit:
+#
+def emit(record, metrics):
+  if output_format() == 'emf':
+    record = emf(record, metrics)
+  print(json.dumps(record, default=str))
+
+
+###################################################################
+#
+# timed:
+#
+# Context manager timing one step. Extra keyword arguments (a
+# bucket key, a SQL verb, ...) are included in the record. It
+# yields a dictionary of those fields, which the step can add to;
+# setting 'bytes' adds the step's throughput.
+#
+@contextlib.contextmanager
+def timed(name, **fields):
+  invocation = current.get()
+  start = time.time()
+  status = 'ok'
+
+  try:
+    yield fields
+  except BaseException:
+    status = 'error'
+    raise
+  finally:
+    ms = (time.time() - start) * 1000
+    nbytes = fields.get('bytes', 0)
+
+    if invocation is not None:
+      invocation.add(name, ms, nbytes)
+
+    if output_level() == 'all':
+      record = {'type': 'timing', 'name': name, 'ms': round(ms, 3), 'status': status}
+      if invocation is not None:
+        record['function'] = invocation.function_name
+        record['request_id'] = invocation.request_id
+      record.update(fields)
+
+      metrics = {'duration': round(ms, 3)}
+      if nbytes > 0:
+        record['mb_per_sec'] = throughput(nbytes, ms)
+        metrics['bytes'] = nbytes
+        if record['mb_per_sec'] is not None:
+          metrics['mb_per_sec'] = record['mb_per_sec']
+      emit(record, metrics)
+
+
+###################################################################
+#
+# timed_function:
+#
+# Decorator form of timed(), for helper functions:
+#
+#   @timing.timed_function('image.encode')
+#   def compress_image(img): ...
+#
+def timed_function(name):
+  def decorator(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+      with timed(name):
+        return func(*args, **kwargs)
+    return wrapper
+  return decorator
+
+
+###################################################################
+#
+# instrumented:
+#
+# Decorator for a lambda_handler: times the whole invocation, and
+# prints its summary when it returns (or raises).
+#
+def instrumented(handler):
+  @functools.wraps(handler)
+  def wrapper(event, context):
+    function_name = getattr(context, 'function_name', handler.__module__)
+    request_id = getattr(context, 'aws_request_id', None) or str(uuid.uuid4())
+
+    invocation = Invocation(function_name, request_id)
+    token = current.set(invocation)
+    status = 'error'
+
+    try:
+      response = handler(event, context)
+      if isinstance(response, dict) and 'statusCode' in response:
+        status = str(response['statusCode'])
+      else:
+        status = 'ok'
+      return response
+
+    finally:
+      current.reset(token)
+
+      if output_level() != 'off':
+        summary = invocation.summary(status)
+        metrics = {'total': summary['total_ms']}
+        for (name, phase) in summary['phases'].items():
+          metrics[name] = phase['ms']
+        emit(summary, metrics)
+
+  return wrapper
+
+
+###################################################################
+#
+# submit:
+#
+# Submits work to an executor so that the steps it times count
+# towards the current invocation (threads don't inherit context
+# variables on their own).
+#
+def submit(executor, func, *args, **kwargs):
+  return executor.submit(contextvars.copy_context().run, func, *args, **kwargs)
@@ -0,0 +1,351 @@
+#
+# transfer.py
+#
+# S3 transfers for the lambda handlers, tuned for the object sizes
+# we see (labels and metadata of a few KB, images of a few MB, the
+# occasional panorama of tens of MB):
+#
+#   body = transfer.get_bytes(s3, bucketname, bucketkey)
+#   transfer.put_bytes(s3, bucketname, resultkey, body, 'image/jpeg', 'public-read')
+#
+# Small objects are read into memory with a single GET, with no
+# temporary file and no HEAD request first. Larger objects are
+# fetched as concurrent ranged GETs, all pinned to the ETag of the
+# first so a concurrent overwrite can't give us a mix of two
+# versions. Uploads go through boto3's managed transfer with
+# TRANSFER_CONFIG, so big ones are multipart and parallel.
+#
+# Every transfer is timed (see timing.py) with the number of bytes
+# moved, so the logs show the throughput of each.
+#
+# Handlers that need a file on disk get a name from temp_path(),
+# which is unique per call: a warm lambda (or the local runtime)
+# may run several invocations in one process at once.
+#
+
+import io
+import os
+import re
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+
+import timing
+
+
+#
+# objects up to this size come back in the first GET, and are
+# kept in memory by get(); larger ones are fetched in ranges of
+# RANGE_BYTES, MAX_CONCURRENCY at a time:
+#
+RANGE_BYTES = 8 * 1024 * 1024
+IN_MEMORY_MAX_BYTES = 16 * 1024 * 1024
+MAX_CONCURRENCY = 8
+
+#
+# uploads: single PUT up to the threshold, then multipart in
+# 8MB parts (S3's minimum part size is 5MB):
+#
+MULTIPART_THRESHOLD = 16 * 1024 * 1024
+
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=MULTIPART_THRESHOLD,
+                                 multipart_chunksize=RANGE_BYTES,
+                                 max_concurrency=MAX_CONCURRENCY,
+                                 use_threads=True)
+
+TEMP_DIR = "/tmp"
+
+
+###################################################################
+#
+# temp_path / discard:
+#
+# A local filename no other invocation will use, ending in name;
+# and removing it (if it was ever written) once done with it.
+#
+def temp_path(name):
+  return os.path.join(TEMP_DIR, uuid.uuid4().hex + "-" + name)
+
+
+def discard(local_filename):
+  if local_filename is not None and os.path.exists(local_filename):
+    os.remove(local_filename)
+
+
+###################################################################
+#
+# object_size:
+#
+# The total size of an object, from the Content-Range of a ranged
+# GET ("bytes 0-8388607/31457280").
+#
+def object_size(response):
+  match = re.match(r"bytes \d+-\d+/(\d+)", response.get('ContentRange', ""))
+  if match is None:
+    return response['ContentLength']
+  return int(match.group(1))
+
+
+###################################################################
+#
+# get_first:
+#
+# The first GET of an object: up to RANGE_BYTES of it, which for
+# most objects is all of it. Returns (body, size, etag).
+#
+# S3 answers a range of an empty object with 416 InvalidRange, so
+# an empty object takes a second, plain GET (for its ETag).
+#
+def get_first(s3, bucketname, bucketkey):
+  try:
+    response = s3.get_object(Bucket=bucketname, Key=bucketkey, Range="bytes=0-" + str(RANGE_BYTES - 1))
+  except ClientError as err:
+    if err.response['Error']['Code'] != 'InvalidRange':
+      raise
+    response = s3.get_object(Bucket=bucketname, Key=bucketkey)
+
+  body = response['Body'].read()
+  return (body, object_size(response), response['ETag'])
+
+
+###################################################################
+#
+# get_ranges:
+#
+# Fetches bytes [start, size) of an object in concurrent ranged
+# GETs, passing each (offset, data) to write as it arrives.
+#
+def get_ranges(s3, bucketname, bucketkey, etag, start, size, write):
+  if start >= size:
+    return
+
+  def get_range(offset):
+    end = min(offset + RANGE_BYTES, size) - 1
+    response = s3.get_object(Bucket=bucketname, Key=bucketkey, IfMatch=etag,
+                             Range="bytes=" + str(offset) + "-" + str(end))
+    write(offset, response['Body'].read())
+
+  with ThreadPoolExecutor(max_workers=MAX_CONCURRENCY) as executor:
+    futures = [timing.submit(executor, get_range, offset)
+               for offset in range(start, size, RANGE_BYTES)]
+    for future in futures:
+      future.result()
+
+
+###################################################################
+#
+# read_rest / write_rest:
+#
+# The rest of an object, given its first GET: assembled in
+# memory, or written into place in a local file as the ranges
+# arrive.
+#
+def read_rest(s3, bucketname, bucketkey, first):
+  (head, size, etag) = first
+  if len(head) >= size:
+    return head
+
+  body = bytearray(size)
+  body[0:len(head)] = head
+
+  def write(offset, data):
+    body[offset:offset + len(data)] = data
+
+  get_ranges(s3, bucketname, bucketkey, etag, len(head), size, write)
+  return bytes(body)
+
+
+def write_rest(s3, bucketname, bucketkey, first, local_filename):
+  (head, size, etag) = first
+
+  outfile = open(local_filename, "wb")
+  try:
+    outfile.write(head)
+    outfile.truncate(size)
+
+    def write(offset, data):
+      os.pwrite(outfile.fileno(), data, offset)
+
+    get_ranges(s3, bucketname, bucketkey, etag, len(head), size, write)
+  finally:
+    outfile.close()
+
+  return local_filename
+
+
+###################################################################
+#
+# ranges:
+#
+# How many GETs an object of size bytes takes.
+#
+def ranges(size):
+  return max(1, -(-size // RANGE_BYTES))
+
+
+###################################################################
+#
+# get_bytes:
+#
+# Reads an object into memory.
+#
+def get_bytes(s3, bucketname, bucketkey):
+  """
+  Reads an S3 object into memory, with concurrent ranged GETs if
+  it is large
+
+  Parameters
+  ----------
+  s3 : boto3 S3 client,
+  bucketname : bucket holding the object (string),
+  bucketkey : key of the object (string)
+
+  Returns
+  -------
+  the object's contents (bytes)
+  """
+  with timing.timed('s3.get', key=bucketkey) as step:
+    first = get_first(s3, bucketname, bucketkey)
+    body = read_rest(s3, bucketname, bucketkey, first)
+
+    step['ranges'] = ranges(len(body))
+    step['bytes'] = len(body)
+    return body
+
+
+###################################################################
+#
+# get_any:
+#
+# Reads the first of several keys that exists into memory, for an
+# object that may be under any of them (an artifact written under
+# an older name, say). Raises the error for the first key if none
+# of them do; a missing key is a 403 rather than a 404 without
+# ListBucket permission, so both count as missing.
+#
+MISSING_CODES = ['NoSuchKey', '404', '403', 'AccessDenied']
+
+def get_any(s3, bucketname, bucketkeys):
+  first_err = None
+
+  for bucketkey in bucketkeys:
+    try:
+      return get_bytes(s3, bucketname, bucketkey)
+    except ClientError as err:
+      if err.response['Error']['Code'] not in MISSING_CODES:
+        raise
+      if first_err is None:
+        first_err = err
+
+  raise first_err
+
+
+###################################################################
+#
+# download_file:
+#
+# Downloads an object to a local file.
+#
+def download_file(s3, bucketname, bucketkey, local_filename):
+  with timing.timed('s3.download', key=bucketkey) as step:
+    first = get_first(s3, bucketname, bucketkey)
+    write_rest(s3, bucketname, bucketkey, first, local_filename)
+
+    step['ranges'] = ranges(first[1])
+    step['bytes'] = first[1]
+    return local_filename
+
+
+###################################################################
+#
+# get:
+#
+# Fetches an object into memory if it is small, or into a local
+# file if not.
+#
+def get(s3, bucketname, bucketkey, local_filename):
+  """
+  Fetches an S3 object, into memory or to disk depending on its
+  size
+
+  Parameters
+  ----------
+  s3 : boto3 S3 client,
+  bucketname : bucket holding the object (string),
+  bucketkey : key of the object (string),
+  local_filename : where to put the object if it's too big to
+                   keep in memory (see temp_path)
+
+  Returns
+  -------
+  the object's contents (bytes) if it is at most
+  IN_MEMORY_MAX_BYTES, otherwise local_filename
+  """
+  with timing.timed('s3.get', key=bucketkey) as step:
+    first = get_first(s3, bucketname, bucketkey)
+    size = first[1]
+
+    step['ranges'] = ranges(size)
+    step['bytes'] = size
+
+    if size <= IN_MEMORY_MAX_BYTES:
+      return read_rest(s3, bucketname, bucketkey, first)
+
+    step['local'] = True
+    return write_rest(s3, bucketname, bucketkey, first, local_filename)
+
+
+###################################################################
+#
+# put_bytes / put_file:
+#
+# Uploads from memory or from a local file; multipart, in
+# parallel, above MULTIPART_THRESHOLD.
+#
+def extra_args(content_type, acl):
+  args = {}
+  if content_type is not None:
+    args['ContentType'] = content_type
+  if acl is not None:
+    args['ACL'] = acl
+  return args
+
+
+def put_bytes(s3, bucketname, bucketkey, body, content_type=None, acl=None):
+  """
+  Uploads an S3 object from memory
+
+  Parameters
+  ----------
+  s3 : boto3 S3 client,
+  bucketname : bucket to upload to (string),
+  bucketkey : key of the object (string),
+  body : the contents (bytes or string),
+  content_type : Content-Type of the object, or None,
+  acl : canned ACL of the object, or None
+
+  Returns
+  -------
+  the ETag of the new object (string)
+  """
+  if isinstance(body, str):
+    body = body.encode()
+
+  with timing.timed('s3.put', key=bucketkey, bytes=len(body)):
+    if len(body) < MULTIPART_THRESHOLD:
+      response = s3.put_object(Bucket=bucketname, Key=bucketkey, Body=body, **extra_args(content_type, acl))
+      return response['ETag']
+
+    # a managed upload doesn't tell us the ETag, so ask:
+    s3.upload_fileobj(io.BytesIO(body), bucketname, bucketkey,
+                      ExtraArgs=extra_args(content_type, acl), Config=TRANSFER_CONFIG)
+    return s3.head_object(Bucket=bucketname, Key=bucketkey)['ETag']
+
+
+def put_file(s3, bucketname, bucketkey, local_filename, content_type=None, acl=None):
+  with timing.timed('s3.upload', key=bucketkey, bytes=os.path.getsize(local_filename)):
+    s3.upload_file(local_filename, bucketname, bucketkey,
+                   ExtraArgs=extra_args(content_type, acl), Config=TRANSFER_CONFIG)
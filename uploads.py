@@ -0,0 +1,88 @@
+#
+# uploads.py
+#
+# Registering uploads as jobs, for finalproj_upload and
+# finalproj_upload_batch: a unique bucket key for each file, and
+# a pending jobs row for each, all added by one multi-row INSERT:
+#
+#   keys = [uploads.make_bucketkey(username, filename) for filename in filenames]
+#   jobids = uploads.create_jobs(dbConn, userid, list(zip(filenames, keys)))
+#
+# The jobids come from the INSERT itself. MySQL reports the id of
+# the first row of a multi-row INSERT, and the rows of a "simple
+# insert" (one whose row count is known up front, as a VALUES
+# list is) get consecutive ids, in the order listed, in every
+# innodb_autoinc_lock_mode; the gaps interleaved mode can leave
+# are only in bulk inserts (INSERT ... SELECT). This assumes
+# auto_increment_increment is 1, the default.
+#
+
+import uuid
+import pathlib
+import datatier
+
+
+#
+# most jobs one INSERT may add:
+#
+MAX_JOBS_PER_INSERT = 100
+
+
+###################################################################
+#
+# make_bucketkey:
+#
+# A bucket key no other upload will have, for a user's file:
+# "cat.jpg" -> "username/cat-<uuid>.jpg". Only .jpg files may be
+# uploaded.
+#
+def make_bucketkey(username, filename):
+  basename = pathlib.Path(filename).stem
+  extension = pathlib.Path(filename).suffix
+
+  if extension != ".jpg":
+    raise Exception("expecting filename to have .jpg extension")
+
+  return username + "/" + basename + "-" + str(uuid.uuid4()) + ".jpg"
+
+
+###################################################################
+#
+# create_jobs:
+#
+def create_jobs(dbConn, userid, files):
+  """
+  Adds a pending jobs row for each of a user's uploads, with one
+  INSERT
+
+  Parameters
+  ----------
+  dbConn : the database connection,
+  userid : the user uploading,
+  files : list of (filename, bucketkey) pairs, one per upload
+
+  Returns
+  -------
+  the jobid of each upload, in the order given
+  """
+  if len(files) == 0:
+    return []
+
+  if len(files) > MAX_JOBS_PER_INSERT:
+    raise Exception("at most " + str(MAX_JOBS_PER_INSERT) + " jobs may be created at once")
+
+  sql = """
+    INSERT INTO jobs(userid, status, originaldatafile, datafilekey, resultsfilekey)
+                VALUES
+  """ + ",\n".join(["(%s, 'pending', %s, %s, '')"] * len(files)) + ";"
+
+  parameters = []
+  for (filename, bucketkey) in files:
+    parameters += [userid, filename, bucketkey]
+
+  (rowcount, first_jobid) = datatier.perform_insert(dbConn, sql, parameters)
+
+  if rowcount != len(files):
+    raise Exception("expected to insert " + str(len(files)) + " jobs, inserted " + str(rowcount))
+
+  return [first_jobid + i for i in range(len(files))]
@@ -0,0 +1,273 @@
+#
+# workerpool.py
+#
+# A pool of worker processes for CPU-bound image work (decode,
+# resize, encode, histogram matching), so a lambda provisioned
+# with several vCPUs (or a container) uses all of them:
+#
+#   compressed_bytes = workerpool.run(imaging.compress_jpeg, image_bytes)
+#
+#   thumbnails = workerpool.run_all(load_thumbnail, [(source,), (target,)])
+#
+# The pool is kept for the lifetime of the process, so warm
+# invocations reuse it. Handlers start it when they are imported
+# (workerpool.start()), at cold start, before any thread exists:
+# forking a process that has other threads running can leave the
+# child holding locks (stdout, logging, urllib3's) that no thread
+# of its own will ever release. A pool that is started later
+# anyway (first use, or a process that already has threads) uses
+# the forkserver start method instead. It is sized to
+# os.cpu_count(), or the IMAGE_WORKERS environment variable; with
+# one worker (a lambda with a single vCPU) there is no pool, and
+# the work runs inline in the calling thread.
+#
+# Lambda has no /dev/shm, so multiprocessing.Pool and Queue
+# (which need POSIX semaphores) don't work there; each worker is
+# driven over its own Pipe instead. Tasks and results are
+# pickled, so pass encoded images or file names rather than
+# pixel arrays.
+#
+# run() may be called from several threads at once (e.g. the
+# batch worker's pool); each call waits for a free worker.
+#
+
+import os
+import queue
+import threading
+import traceback
+import multiprocessing
+
+from concurrent.futures import ThreadPoolExecutor
+
+import timing
+
+
+###################################################################
+#
+# WorkerError:
+#
+# A task raised an exception in a worker, or the worker died.
+#
+class WorkerError(Exception):
+  pass
+
+
+###################################################################
+#
+# worker_main:
+#
+# The loop each worker process runs: receive (func, args), call
+# it, send back (True, result) or (False, error).
+#
+def worker_main(conn):
+  # a forked worker inherits the invocation being timed when
+  # the pool started; its records don't belong to it:
+  timing.current.set(None)
+
+  while True:
+    try:
+      (func, args) = conn.recv()
+    except EOFError:
+      return
+
+    try:
+      conn.send((True, func(*args)))
+    except Exception as err:
+      conn.send((False, type(err).__name__ + ": " + str(err) + "\n" + traceback.format_exc()))
+
+
+###################################################################
+#
+# WorkerPool:
+#
+class WorkerPool:
+  """
+  A fixed number of worker processes running picklable,
+  module-level functions.
+
+  Parameters
+  ----------
+  processes : number of workers (default os.cpu_count())
+  """
+
+  def __init__(self, processes=None):
+    self.size = processes or os.cpu_count() or 1
+
+    self.mp = multiprocessing.get_context(start_method())
+
+    self.lock = threading.Lock()
+    self.workers = {}
+    self.idle = queue.Queue()
+
+    for i in range(self.size):
+      self.idle.put(self.start_worker())
+
+  def start_worker(self):
+    (conn, child_conn) = self.mp.Pipe()
+    process = self.mp.Process(target=worker_main, args=(child_conn,), daemon=True)
+    process.start()
+    child_conn.close()
+
+    with self.lock:
+      self.workers[conn] = process
+    return conn
+
+  def replace_worker(self, conn):
+    with self.lock:
+      process = self.workers.pop(conn, None)
+    conn.close()
+    if process is not None:
+      process.kill()
+      process.join()
+    return self.start_worker()
+
+  def run(self, func, *args):
+    """
+    Runs func(*args) in a worker, and returns its result.
+    """
+    conn = self.idle.get()
+    done = False
+
+    try:
+      conn.send((func, args))
+      (ok, result) = conn.recv()
+      done = True
+    except (EOFError, OSError) as err:
+      # the worker died (e.g. out of memory):
+      raise WorkerError("worker died running " + func.__name__ + ": " + str(err))
+    finally:
+      # the connection goes back on every path, or the pool would
+      # shrink with each failure until run() blocks for good. If
+      # the call didn't finish (the worker died, the arguments
+      # couldn't be pickled, we were interrupted) the pipe may
+      # still hold a reply, so it gets a fresh worker; should that
+      # fail to start, the dead connection goes back, and the next
+      # run() to get it tries again:
+      if not done:
+        try:
+          conn = self.replace_worker(conn)
+        finally:
+          self.idle.put(conn)
+      else:
+        self.idle.put(conn)
+
+    if not ok:
+      raise WorkerError(result)
+    return result
+
+  def run_all(self, func, arglists):
+    """
+    Runs func(*args) for each args in arglists, spread across the
+    workers, and returns the results in the same order.
+    """
+    with ThreadPoolExecutor(max_workers=self.size) as executor:
+      futures = [executor.submit(self.run, func, *args) for args in arglists]
+      return [future.result() for future in futures]
+
+  def shutdown(self):
+    with self.lock:
+      workers = list(self.workers.items())
+      self.workers = {}
+
+    for (conn, process) in workers:
+      conn.close()
+      process.join(timeout=5)
+      if process.is_alive():
+        process.kill()
+
+
+###################################################################
+#
+# start_method:
+#
+# fork is cheap and doesn't re-import the handler, but is only
+# safe while this is the only thread; otherwise workers come
+# from a forkserver (a clean, single-threaded process), or are
+# spawned where neither exists.
+#
+def start_method():
+  methods = multiprocessing.get_all_start_methods()
+
+  if 'fork' in methods and threading.active_count() == 1:
+    return 'fork'
+  if 'forkserver' in methods:
+    return 'forkserver'
+  return 'spawn'
+
+
+#
+# the process-wide pool, started by start() (or on first use):
+#
+pool = None
+pool_lock = threading.Lock()
+
+
+###################################################################
+#
+# pool_size:
+#
+def pool_size():
+  return int(os.environ.get('IMAGE_WORKERS', os.cpu_count() or 1))
+
+
+###################################################################
+#
+# get_pool:
+#
+# Returns the process-wide pool, or None if there is only one
+# worker (so the work is best done inline).
+#
+def get_pool():
+  global pool
+
+  if pool_size() <= 1:
+    return None
+
+  with pool_lock:
+    if pool is None:
+      pool = WorkerPool(pool_size())
+    return pool
+
+
+###################################################################
+#
+# start:
+#
+# Starts the process-wide pool now, if there is to be one; for
+# handler modules to call at import, while the process has a
+# single thread.
+#
+def start():
+  return get_pool()
+
+
+###################################################################
+#
+# run:
+#
+# Runs func(*args) in the pool, or inline if there is no pool.
+#
+def run(func, *args):
+  workers = get_pool()
+
+  with timing.timed('worker.' + func.__name__, inline=workers is None):
+    if workers is None:
+      return func(*args)
+    return workers.run(func, *args)
+
+
+###################################################################
+#
+# run_all:
+#
+# Runs func(*args) for each args in arglists, in parallel across
+# the pool (or one after another inline), returning the results
+# in order.
+#
+def run_all(func, arglists):
+  workers = get_pool()
+
+  with timing.timed('worker.' + func.__name__, inline=workers is None, tasks=len(arglists)):
+    if workers is None:
+      return [func(*args) for args in arglists]
+    return workers.run_all(func, arglists)